@@ -0,0 +1,91 @@
+"""Peak memory of one image-heavy EPUB build.
+
+Each measurement runs in a fresh subprocess that imports the app, serves
+--images large JPEGs from a local stub, and downloads the article's
+export.epub through the test client. The peak RSS of the worker process
+and of the largest image transcoding child are reported separately;
+--transcode-workers 0 keeps all Pillow work in the worker.
+
+    python bench/bench_epub_memory.py --images 25
+    python bench/bench_epub_memory.py --images 25 --code /tmp/baseline/code
+"""
+import argparse
+import glob
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def rss_kb():
+    with open("/proc/self/status") as fh:
+        for line in fh:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def child(args):
+    sys.path.insert(0, HERE)
+    from bench_images import make_jpeg, start_stub
+    from bench_sync import load_app
+
+    os.environ["WBIP_IMAGE_TRANSCODE_WORKERS"] = str(args.transcode_workers)
+    os.environ["WBIP_IMAGE_CACHE_SIZE"] = "0"
+    os.environ["WBIP_PREFETCH_WORKERS"] = "0"
+    tmp = tempfile.mkdtemp()
+    os.environ["WBIP_EPUB_CACHE_DIR"] = tmp
+    server = start_stub(0.0, make_jpeg((3000, 2000)))
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    app = load_app(os.path.abspath(args.code), os.path.join(tmp, "sqlite3.db"))
+    wrapper = sys.modules["wbip_wrapper"]
+    html = "<p>text</p>" * 200 + "".join(
+        f'<p><img src="{base}/{i}.jpg"/></p>' for i in range(args.images))
+    wrapper.get_api_data = lambda url, *a, **kw: html
+    from backend.common import Bookmark
+    wrapper.g_storage_backend.update_bookmark(
+        Bookmark(4242, "Bench", "mailto:bench", ""))
+    for old in glob.glob("/tmp/4242.epub"):
+        os.unlink(old)
+
+    client = app.test_client()
+    before = rss_kb()
+    start = time.perf_counter()
+    r = client.get("/api/entries/4242/export.epub",
+                   headers={"Authorization": "Bearer oauth_token=t&oauth_token_secret=s"})
+    size = len(r.get_data())
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"status {r.status_code}  epub {size / 1024:6.0f} KiB  "
+          f"build {elapsed:5.2f}s  rss before {before / 1024:6.1f} MiB  "
+          f"peak {peak / 1024:6.1f} MiB  growth {(peak - before) / 1024:6.1f} MiB")
+    pipeline = getattr(wrapper, "g_image_pipeline", None)
+    if pipeline is not None and pipeline._transcode_pool is not None:
+        pipeline._transcode_pool.shutdown()
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        print(f"largest transcode child peak {children / 1024:6.1f} MiB")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=25)
+    parser.add_argument("--code", default=os.path.join(HERE, "..", "code"))
+    parser.add_argument("--transcode-workers", type=int, default=2)
+    parser.add_argument("--child", action="store_true")
+    args = parser.parse_args()
+    if args.child:
+        child(args)
+        return
+    subprocess.run([sys.executable, __file__, "--child",
+                    "--images", str(args.images), "--code", args.code,
+                    "--transcode-workers", str(args.transcode_workers)],
+                   check=True, stderr=subprocess.DEVNULL)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+"""CPU time of turning article HTML into an EPUB chapter.
+
+Runs every article of a corpus through the HTML pipeline with each
+parser (and through the old BeautifulSoup/html5lib path if bs4 is
+installed), including the final XHTML serialization, and checks that
+each chapter parses as XML, has no element names html5lib escaped
+(<oU0003Ap> for <o:p>) and no paragraph inside a paragraph. Images are not downloaded: each one is
+treated as embedded.
+
+Save articles as .html files (e.g. the output of Instapaper's
+/bookmarks/get_text) into a directory and pass it as --corpus; without
+one, a synthetic corpus of long articles with images, junk images,
+comments, prefixed tags and control characters is generated.
+
+    python bench/bench_html.py
+    python bench/bench_html.py --corpus ~/saved-articles
+"""
+import argparse
+import glob
+import os
+import random
+import statistics
+import sys
+import time
+
+from lxml import etree
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CODE = os.path.join(HERE, "..", "code")
+sys.path.insert(0, CODE)
+
+import epubwriter  # noqa: E402
+import htmlpipeline  # noqa: E402
+
+
+def synthetic_corpus(count, paragraphs):
+    rng = random.Random(1)
+    words = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+             "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+    articles = []
+    for n in range(count):
+        parts = []
+        for p in range(paragraphs):
+            text = " ".join(rng.choice(words) for _ in range(rng.randint(40, 120)))
+            parts.append(f'<p class="c{p % 7}">{text} <a href="https://example.com/{p}">'
+                         f'link</a> <em>{rng.choice(words)}</em>&nbsp;&amp;</p>')
+            roll = rng.random()
+            if roll < 0.15:
+                parts.append(f'<figure><img src="https://img.example.com/{n}/{p}.jpg%2C" '
+                             f'srcset="https://img.example.com/{n}/{p}@2x.jpg 2x">'
+                             f'<figcaption>{text[:40]}</figcaption></figure>')
+            elif roll < 0.18:
+                parts.append('<img src="data:image/gif;base64,R0lGODlhAQABAAAAACw=">')
+            elif roll < 0.20:
+                parts.append('<img src="denied:https://tracker.example.com/p.gif">')
+            elif roll < 0.22:
+                parts.append('<!-- ad -- slot --><p>Pasted from Word<o:p>&nbsp;</o:p></p>')
+            elif roll < 0.24:
+                parts.append('<table><tr><td>1</td><td>2</td></tr></table>')
+            elif roll < 0.26:
+                parts.append('<p>pasted\x0bfrom a\x0cword processor\x01</p>')
+        articles.append((f"synthetic-{n}", "".join(parts)))
+    return articles
+
+
+def load_corpus(directory):
+    articles = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.htm*"))):
+        with open(path, encoding="utf-8", errors="replace") as f:
+            articles.append((os.path.basename(path), f.read()))
+    return articles
+
+
+def pipeline(parser):
+    def run(html):
+        article = htmlpipeline.Article(html, parser=parser)
+        article.finish({src: f"{n}.jpg" for n, src in enumerate(article.images)})
+        return epubwriter.xhtml_document("t", article.body)
+    return run
+
+
+# What build_epub did before the HTML pipeline
+def soup(html):
+    from bs4 import BeautifulSoup
+    document = BeautifulSoup(f"<html><body>{html}</body></html>", "html5lib")
+    count = 0
+    for img in document.find_all("img"):
+        src = img.get("src")
+        if not src or src.startswith("denied:") or src.startswith("data:"):
+            img.decompose()
+            continue
+        count += 1
+        if count > 25:
+            break
+        img["src"] = f"{count}.jpg"
+        img["style"] = "max-width: 100%"
+    return epubwriter.xhtml_document("t", document.body.decode_contents())
+
+
+def valid_xhtml(chapter) -> bool:
+    try:
+        root = etree.fromstring(chapter)
+    except etree.XMLSyntaxError:
+        return False
+    for el in root.iter():
+        if not isinstance(el.tag, str):
+            continue
+        if htmlpipeline.ESCAPED_CHAR.search(el.tag):
+            return False
+        if etree.QName(el).localname == "p" and any(
+                etree.QName(parent).localname == "p" for parent in el.iterancestors()):
+            return False
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", help="directory of saved .html articles")
+    parser.add_argument("--articles", type=int, default=50,
+                        help="synthetic articles without --corpus")
+    parser.add_argument("--paragraphs", type=int, default=150)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.corpus:
+        corpus = load_corpus(args.corpus)
+    else:
+        corpus = synthetic_corpus(args.articles, args.paragraphs)
+    size = sum(len(html) for _, html in corpus)
+    print(f"{len(corpus)} articles, {size / len(corpus) / 1024:.0f} KiB average")
+
+    variants = {f"pipeline/{name}": pipeline(name) for name in htmlpipeline.PARSERS}
+    try:
+        import bs4  # noqa: F401
+        variants["beautifulsoup/html5lib"] = soup
+    except ImportError:
+        print("bs4 not installed, skipping the old BeautifulSoup path")
+
+    for name, run in variants.items():
+        samples = []
+        invalid = 0
+        for _ in range(args.rounds):
+            for label, html in corpus:
+                start = time.process_time()
+                chapter = run(html)
+                samples.append(time.process_time() - start)
+                if not valid_xhtml(chapter):
+                    invalid += 1
+        samples.sort()
+        print(f"{name:24s} p50 {statistics.median(samples) * 1000:7.1f} ms   "
+              f"p99 {samples[len(samples) * 99 // 100 - 1] * 1000:7.1f} ms   "
+              f"total {sum(samples) / args.rounds:6.2f} s   "
+              f"{invalid // args.rounds} invalid XHTML")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Compare the serial image loop with the concurrent ImagePipeline.
+
+Serves generated JPEGs from a local stub server with artificial latency,
+then times both approaches over the same set of URLs. Finally checks that
+downloads still running when an article's deadline passes give back
+their fetch slots, so later builds still get images.
+
+    python bench/bench_images.py --images 25 --latency 0.2
+"""
+import argparse
+import io
+import os
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "code"))
+
+import requests  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import images  # noqa: E402
+import upstreams  # noqa: E402
+
+PROFILE = images.PROFILES["default"]
+
+
+def make_jpeg(size=(1600, 1200)):
+    buf = io.BytesIO()
+    Image.effect_noise(size, 64).convert("RGB").save(buf, "jpeg")
+    return buf.getvalue()
+
+
+def start_stub(latency, payload):
+    def respond(path, body, headers):
+        time.sleep(latency)
+        return 200, {"Content-Type": "image/jpeg"}, payload
+
+    return upstreams.start_stub(respond)
+
+
+def serial(urls):
+    out = {}
+    for name, src in urls.items():
+        content = requests.get(src, timeout=images.FETCH_TIMEOUT).content
+        data = images.transcode(content, PROFILE)
+        if data:
+            out[name] = data
+    return out
+
+
+def check_deadline(base, payload):
+    slow = start_stub(1.0, payload)
+    pipeline = images.ImagePipeline(2, 1, deadline=0.3)
+    got = pipeline.process(
+        {f"slow{i}.jpg": f"http://127.0.0.1:{slow.server_port}/{i}.jpg"
+         for i in range(2)}, PROFILE, lambda key, data: None)
+    assert not got, "slow images should miss the deadline"
+    time.sleep(1.5)
+    pipeline.deadline = 5.0
+    got = pipeline.process({"fast.jpg": f"{base}/fast.jpg"}, PROFILE,
+                           lambda key, data: None)
+    assert got == {"fast.jpg"}, "fetch slots leaked after a missed deadline"
+    slow.shutdown()
+    pipeline._get_transcode_pool().shutdown()
+    print("deadline:   missed downloads release their slots")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--images", type=int, default=25)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--fetch-workers", type=int, default=8)
+    parser.add_argument("--transcode-workers", type=int, default=2)
+    args = parser.parse_args()
+
+    server = start_stub(args.latency, make_jpeg())
+    base = f"http://127.0.0.1:{server.server_port}"
+    urls = {f"{i}.jpg": f"{base}/{i}.jpg" for i in range(args.images)}
+
+    start = time.perf_counter()
+    got = serial(urls)
+    serial_time = time.perf_counter() - start
+    print(f"serial:     {len(got):3d} images in {serial_time:6.2f}s")
+
+    pipeline = images.ImagePipeline(args.fetch_workers, args.transcode_workers,
+                                    deadline=60.0)
+    # warm the process pool so its startup isn't counted
+    pipeline.process({"warm.jpg": f"{base}/warm.jpg"}, PROFILE,
+                     lambda key, data: None)
+    start = time.perf_counter()
+    got = pipeline.process(urls, PROFILE, lambda key, data: None)
+    pipeline_time = time.perf_counter() - start
+    print(f"pipeline:   {len(got):3d} images in {pipeline_time:6.2f}s")
+    print(f"speed-up:   {serial_time / pipeline_time:6.2f}x")
+    pipeline._get_transcode_pool().shutdown()
+    check_deadline(base, make_jpeg())
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
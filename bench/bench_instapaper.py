@@ -0,0 +1,76 @@
+"""Per-call latency of the old per-call oauth.Client against InstapaperClient.
+
+Runs a local stand-in for the Instapaper API and issues the same number
+of signed POSTs through both transports. Loopback connections are nearly
+free, so the stub delays every new connection by --handshake ms to stand
+in for the TCP and TLS round trips to www.instapaper.com.
+
+    python bench/bench_instapaper.py --calls 200 --handshake 60
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from urllib.parse import urlencode
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(HERE, "..", "code"))
+
+import oauth2 as oauth  # noqa: E402
+
+import instapaper  # noqa: E402
+import upstreams  # noqa: E402
+
+BODY = json.dumps([{"type": "meta"}]).encode()
+
+
+def start_stub(handshake):
+    return upstreams.start_stub(
+        lambda path, body, headers: (200, {"Content-Type": "application/json"}, BODY),
+        handshake)
+
+
+def timed(calls, fn):
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return statistics.mean(samples), samples[len(samples) * 99 // 100 - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--handshake", type=float, default=60.0)
+    args = parser.parse_args()
+
+    server = start_stub(args.handshake / 1000)
+    base = f"http://127.0.0.1:{server.server_port}"
+    consumer = oauth.Consumer("key", "secret")
+    header = "Bearer oauth_token=token&oauth_token_secret=secret"
+    url = "/api/1/bookmarks/list"
+    params = {"limit": 30}
+
+    def old():
+        token = oauth.Token("token", "secret")
+        oauth.Client(consumer, token).request(
+            f"{base}{url}", "POST", urlencode(params))
+
+    client = instapaper.InstapaperClient(consumer, base)
+
+    def new():
+        client.post(url, params, client.token(header))
+
+    for name, fn in (("oauth.Client per call", old), ("InstapaperClient", new)):
+        mean, p99 = timed(args.calls, fn)
+        print(f"{name:24s} mean {mean:6.2f} ms   p99 {p99:6.2f} ms")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""Latency of /api/entries.json with a large listing.
+
+A local stand-in for Instapaper's /bookmarks/list returns --entries
+bookmarks; the app stores them all and answers the wallabag listing.
+The first request inserts every bookmark, later ones find them unchanged.
+
+    python bench/bench_listing.py --entries 500
+    python bench/bench_listing.py --entries 500 --code /tmp/baseline/code
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import upstreams  # noqa: E402
+from bench_sync import load_app  # noqa: E402
+
+
+def start_stub(entries):
+    listing = json.dumps([{"type": "meta"}] + [
+        {"type": "bookmark", "bookmark_id": i, "title": f"Article {i}",
+         "url": f"https://example.com/{i}", "tags": [{"name": "bench"}],
+         "time": 1700000000 + i, "progress": 0, "hash": f"h{i}"}
+        for i in range(1, entries + 1)]).encode()
+    return upstreams.start_stub(
+        lambda path, body, headers: (200, {"Content-Type": "application/json"}, listing))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--entries", type=int, default=500)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--code", default=os.path.join(HERE, "..", "code"))
+    args = parser.parse_args()
+
+    server = start_stub(args.entries)
+    base = f"http://127.0.0.1:{server.server_port}"
+    os.environ["WBIP_INSTAPAPER_URL"] = base
+    os.environ["WBIP_PREFETCH_WORKERS"] = "0"
+    app = load_app(os.path.abspath(args.code),
+                   os.path.join(tempfile.mkdtemp(), "sqlite3.db"))
+    # older versions read the module constant on every call
+    sys.modules["wbip_wrapper"].BASE_URL = base
+    client = app.test_client()
+    headers = {"Authorization": "Bearer oauth_token=t&oauth_token_secret=s"}
+
+    samples = []
+    for _ in range(args.requests):
+        start = time.perf_counter()
+        r = client.get(f"/api/entries.json?perPage={args.entries}",
+                       headers=headers)
+        samples.append(time.perf_counter() - start)
+        assert r.status_code == 200, r.data
+        assert len(r.get_json()["_embedded"]["items"]) == args.entries
+
+    print(f"first listing     {samples[0] * 1000:8.1f} ms")
+    rest = sorted(samples[1:])
+    print(f"repeat listings   p50 {statistics.median(rest) * 1000:8.1f} ms   "
+          f"max {rest[-1] * 1000:8.1f} ms")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
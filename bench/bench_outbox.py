@@ -0,0 +1,108 @@
+"""Archiving against an Instapaper stand-in that fails intermittently.
+
+The stub answers --latency ms late and fails --failure of all calls,
+half with a 503 and half by dropping the connection. Every archive is
+PATCHed through the app; the script reports how long KOReader waited
+for the answer, then how long the outbox took to get every call
+through, and checks that each bookmark was archived exactly once.
+
+    python bench/bench_outbox.py --archives 200 --failure 0.3
+    python bench/bench_outbox.py --archives 200 --failure 0.3 --code /tmp/baseline/code
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import upstreams  # noqa: E402
+from bench_sync import load_app  # noqa: E402
+
+
+def start_stub(latency, failure):
+    archived = Counter()
+    lock = threading.Lock()
+
+    def respond(path, body, headers):
+        form = parse_qs(body.decode())
+        time.sleep(latency)
+        roll = random.random()
+        if roll < failure / 2:
+            return None
+        if roll < failure:
+            return 503, {}, b""
+        if path.endswith("/bookmarks/archive"):
+            with lock:
+                archived[form["bookmark_id"][0]] += 1
+        return 200, {"Content-Type": "application/json"}, b"[]"
+
+    return upstreams.start_stub(respond), archived
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--archives", type=int, default=200)
+    parser.add_argument("--failure", type=float, default=0.3)
+    parser.add_argument("--latency", type=float, default=20,
+                        help="ms per Instapaper call")
+    parser.add_argument("--timeout", type=float, default=120,
+                        help="seconds to wait for the outbox to drain")
+    parser.add_argument("--code", default=os.path.join(HERE, "..", "code"))
+    args = parser.parse_args()
+
+    server, archived = start_stub(args.latency / 1000, args.failure)
+    base = f"http://127.0.0.1:{server.server_port}"
+    os.environ["WBIP_INSTAPAPER_URL"] = base
+    os.environ["WBIP_PREFETCH_WORKERS"] = "0"
+    os.environ["WBIP_OUTBOX_INTERVAL"] = "0.1"
+    app = load_app(os.path.abspath(args.code),
+                   os.path.join(tempfile.mkdtemp(), "sqlite3.db"))
+    wrapper = sys.modules["wbip_wrapper"]
+    # older versions read the module constant on every call
+    wrapper.BASE_URL = base
+    outbox = getattr(wrapper, "g_outbox", None)
+    if outbox is not None:
+        # retry within the run instead of after minutes
+        outbox.backoff = 0.2
+        outbox.max_backoff = 1.0
+    client = app.test_client()
+    headers = {"Authorization": "Bearer oauth_token=t&oauth_token_secret=s"}
+
+    samples = []
+    errors = 0
+    start = time.perf_counter()
+    for id in range(1, args.archives + 1):
+        t = time.perf_counter()
+        r = client.patch(f"/api/entries/{id}.json", json={"archive": 1},
+                         headers=headers)
+        samples.append(time.perf_counter() - t)
+        errors += r.status_code != 200
+    samples.sort()
+    print(f"acknowledged      p50 {statistics.median(samples) * 1000:8.1f} ms   "
+          f"max {samples[-1] * 1000:8.1f} ms   {errors} errors")
+
+    if outbox is not None:
+        deadline = time.monotonic() + args.timeout
+        while client.get("/outbox/status").get_json()["pending"]:
+            if time.monotonic() > deadline:
+                break
+            time.sleep(0.05)
+        print(f"all sent after    {time.perf_counter() - start:8.1f} s")
+        print(f"outbox            {client.get('/outbox/status').get_json()}")
+
+    once = sum(1 for n in archived.values() if n == 1)
+    print(f"archived          {len(archived)} of {args.archives} "
+          f"({once} exactly once)")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""EPUB size and build time per image profile.
+
+Builds one article through export.epub for every profile the app offers,
+with images served by a local stub: large color photos as JPEG and PNG,
+a few-color PNG diagram, a transparent PNG logo and small greyscale
+JPEGs that are already fit for e-ink. The image cache is disabled so
+every build transcodes from scratch. Older versions without profiles
+get a single build.
+
+    python bench/bench_profiles.py
+    python bench/bench_profiles.py --code /tmp/baseline/code
+"""
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import upstreams  # noqa: E402
+from bench_sync import load_app  # noqa: E402
+
+
+def photo(size):
+    width, height = size
+    im = Image.merge("RGB", (
+        Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 100),
+        Image.linear_gradient("L").resize(size),
+        Image.radial_gradient("L").resize(size)))
+    return Image.blend(im, Image.effect_noise(size, 24).convert("RGB"), 0.15)
+
+
+def diagram(size):
+    im = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(im)
+    for i in range(0, size[0], 60):
+        draw.rectangle((i, size[1] - i // 2 - 50, i + 40, size[1]), fill=(40, 90, 200))
+        draw.line((0, i // 2, size[0], size[1] - i // 3), fill="black", width=3)
+    draw.text((20, 20), "Throughput by quarter", fill="black")
+    return im
+
+
+def logo(size):
+    im = Image.new("RGBA", size, (0, 0, 0, 0))
+    ImageDraw.Draw(im).ellipse((10, 10, size[0] - 10, size[1] - 10),
+                               fill=(200, 30, 30, 255))
+    return im
+
+
+def encode(im, fmt, **kw):
+    buf = io.BytesIO()
+    im.save(buf, fmt, **kw)
+    return buf.getvalue()
+
+
+def payloads():
+    return {
+        "photo.jpg": encode(photo((3000, 2000)), "JPEG", quality=90),
+        "photo.png": encode(photo((2000, 1500)), "PNG"),
+        "chart.png": encode(diagram((1200, 800)), "PNG"),
+        "logo.png": encode(logo((400, 400)), "PNG"),
+        "small.jpg": encode(photo((600, 400)).convert("L"), "JPEG", quality=75),
+    }
+
+
+def start_stub(files):
+    return upstreams.start_stub(lambda path, body, headers: (
+        200, {}, files[path.rsplit("/", 1)[1].split("-", 1)[1]]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--copies", type=int, default=4,
+                        help="times each kind of image appears in the article")
+    parser.add_argument("--code", default=os.path.join(HERE, "..", "code"))
+    args = parser.parse_args()
+
+    files = payloads()
+    server = start_stub(files)
+    base = f"http://127.0.0.1:{server.server_port}"
+    tmp = tempfile.mkdtemp()
+    os.environ["WBIP_IMAGE_CACHE_SIZE"] = "0"
+    os.environ["WBIP_PREFETCH_WORKERS"] = "0"
+    os.environ["WBIP_EPUB_CACHE_DIR"] = tmp
+    app = load_app(os.path.abspath(args.code), os.path.join(tmp, "sqlite3.db"))
+    wrapper = sys.modules["wbip_wrapper"]
+    html = "<p>text</p>" * 50 + "".join(
+        f'<p><img src="{base}/{n}-{name}"/></p>'
+        for n in range(args.copies) for name in files)
+    wrapper.get_api_data = lambda url, *a, **kw: html
+    from backend.common import Bookmark
+    wrapper.g_storage_backend.update_bookmark(
+        Bookmark(4242, "Bench", "mailto:bench", ""))
+
+    client = app.test_client()
+    headers = {"Authorization": "Bearer oauth_token=t&oauth_token_secret=s"}
+    r = client.get("/profiles")
+    names = list(r.get_json()["profiles"]) if r.status_code == 200 else [None]
+    print(f"{len(files) * args.copies} images, "
+          f"{sum(len(b) for b in files.values()) * args.copies / 1024 / 1024:.1f} MiB downloaded per build")
+    for name in names:
+        query = f"?profile={name}" if name else ""
+        start = time.perf_counter()
+        r = client.get(f"/api/entries/4242/export.epub{query}", headers=headers)
+        size = len(r.get_data())
+        elapsed = time.perf_counter() - start
+        print(f"{name or 'build':12s} status {r.status_code}  epub {size / 1024:7.0f} KiB  "
+              f"build {elapsed:5.2f} s")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Scaling benchmark of the sync tables with a large documents table.
+
+Fills a fresh database with --documents rows spread over --users users
+(written straight into the tables, so any schema version can be loaded),
+then times the backend's per-request operations.
+
+    python bench/bench_schema.py --documents 100000
+    python bench/bench_schema.py --documents 100000 --code /tmp/baseline/code
+"""
+import argparse
+import os
+import random
+import statistics
+import sqlite3
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def timed(name, n, fn):
+    samples = []
+    for i in range(n):
+        start = time.perf_counter()
+        fn(i)
+        samples.append(time.perf_counter() - start)
+    samples.sort()
+    print(f"{name:16s} p50 {statistics.median(samples) * 1000:8.3f} ms   "
+          f"p99 {samples[len(samples) * 99 // 100 - 1] * 1000:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=100000)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--ops", type=int, default=500)
+    parser.add_argument("--code", default=os.path.join(HERE, "..", "code"))
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.abspath(args.code))
+    from backend.common import Document
+    from backend.sqlite import BackendSQLite
+
+    db = os.path.join(tempfile.mkdtemp(), "sqlite3.db")
+    backend = BackendSQLite(db)
+
+    start = time.perf_counter()
+    connection = sqlite3.connect(db)
+    connection.executemany(
+        "INSERT INTO users VALUES (?, ?)",
+        ((f"user{u}", "key") for u in range(args.users)))
+    connection.executemany(
+        "INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)",
+        ((f"user{d % args.users}", f"doc{d}", "/body", 0.5, "dev", "dev", d)
+         for d in range(args.documents)))
+    connection.commit()
+    connection.close()
+    print(f"loaded {args.documents} documents in {time.perf_counter() - start:.1f}s")
+
+    rnd = random.Random(1)
+
+    def pick():
+        d = rnd.randrange(args.documents)
+        return f"user{d % args.users}", f"doc{d}"
+
+    timed("check_login", args.ops,
+          lambda i: backend.check_login(f"user{i % args.users}", "key"))
+    timed("get_document", args.ops,
+          lambda i: backend.get_document(*pick()))
+
+    def update(i):
+        username, document = pick()
+        backend.update_document(username, Document(
+            document, "/body/p", 0.7, "dev", "dev", int(time.time())))
+    timed("update_document", args.ops, update)
+
+
+if __name__ == "__main__":
+    main()
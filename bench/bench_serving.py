@@ -0,0 +1,129 @@
+"""Throughput of gunicorn's sync worker against the threaded (gthread) mode.
+
+Starts the app under gunicorn once per mode, with a local Instapaper
+stand-in that answers after --latency seconds, and hammers it with
+--clients concurrent clients mixing entry listings, archive calls and
+progress syncs.
+
+    python bench/bench_serving.py --clients 32 --duration 10
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CODE = os.path.join(HERE, "..", "code")
+sys.path.insert(0, HERE)
+
+import upstreams  # noqa: E402
+
+AUTH = {"Authorization": "Bearer oauth_token=t&oauth_token_secret=s"}
+SYNC = {"x-auth-user": "bench", "x-auth-key": "key"}
+
+
+def start_instapaper(latency):
+    listing = json.dumps([{"type": "meta"}] + [
+        {"type": "bookmark", "bookmark_id": i, "title": f"Article {i}",
+         "url": f"https://example.com/{i}", "tags": [], "time": i,
+         "hash": f"h{i}"} for i in range(1, 31)]).encode()
+
+    def respond(path, body, headers):
+        time.sleep(latency)
+        return 200, {"Content-Type": "application/json"}, (
+            listing if path.endswith("/bookmarks/list") else b"[]")
+
+    return upstreams.start_stub(respond)
+
+
+def call(base, method, path, headers, body=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base + path, data=data, method=method,
+                                 headers=dict(headers, **{"Content-Type": "application/json"}))
+    with urllib.request.urlopen(req, timeout=60) as r:
+        r.read()
+
+
+def workload(base, i):
+    kind = i % 3
+    if kind == 0:
+        call(base, "GET", "/api/entries.json?perPage=30", AUTH)
+    elif kind == 1:
+        call(base, "PATCH", f"/api/entries/{i % 30 + 1}.json", AUTH, {"archive": 1})
+    else:
+        call(base, "PUT", "/syncs/progress", SYNC,
+             {"document": "doc", "progress": "/p", "percentage": 0.5,
+              "device": "bench", "device_id": "bench"})
+    return kind
+
+
+def run(base, clients, duration):
+    results = {0: [], 1: [], 2: []}
+    lock = threading.Lock()
+    stop = time.monotonic() + duration
+
+    def client(n):
+        i = n
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            kind = workload(base, i)
+            with lock:
+                results[kind].append(time.perf_counter() - start)
+            i += clients
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--latency", type=float, default=0.1)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    stub = start_instapaper(args.latency)
+    secrets = tempfile.mkdtemp()
+    with open(os.path.join(secrets, "my_secrets.py"), "w") as fh:
+        fh.write('oauth_creds = {"key": "key", "secret": "secret"}\n')
+
+    for mode in ("sync", "gthread"):
+        tmp = tempfile.mkdtemp()
+        env = dict(os.environ,
+                   PYTHONPATH=os.pathsep.join([CODE, secrets]),
+                   KOSYNC_SQLITE3_DB=os.path.join(tmp, "sqlite3.db"),
+                   WBIP_INSTAPAPER_URL=f"http://127.0.0.1:{stub.server_port}",
+                   WBIP_PREFETCH_WORKERS="0",
+                   WBIP_WORKER_CLASS=mode)
+        if mode != "sync":
+            env["WBIP_THREADS"] = str(args.threads)
+        proc, base = upstreams.start_gunicorn(CODE, env)
+        try:
+            call(base, "POST", "/users/create", {},
+                 {"username": "bench", "password": "key"})
+            results = run(base, args.clients, args.duration)
+        finally:
+            proc.terminate()
+            proc.wait()
+        total = sum(len(v) for v in results.values())
+        print(f"{mode:8s} {total / args.duration:8.1f} req/s")
+        for kind, name in ((0, "listing"), (1, "archive"), (2, "progress")):
+            samples = sorted(results[kind])
+            if samples:
+                print(f"  {name:9s} p50 {statistics.median(samples) * 1000:8.1f} ms   "
+                      f"p99 {samples[len(samples) * 99 // 100 - 1] * 1000:8.1f} ms")
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Import time, time to first request and worker memory.
+
+Measures how long `import wbip_wrapper` takes in a fresh interpreter,
+then starts the app under gunicorn with --workers workers, with and
+without WBIP_PRELOAD, against the upstream stand-ins of upstreams.py,
+and reports:
+
+    ready      process start until `/` answers
+    sync       first progress sync (/users/create, then PUT /syncs/progress)
+    listing    first /api/entries.json
+    epub       first export.epub build, which loads the EPUB and image code
+    respawn    a killed worker until the server answers again
+    memory     proportional set size of master and workers together, so
+               pages shared after a preload count once
+
+    python bench/bench_startup.py
+    python bench/bench_startup.py --code /tmp/old/code
+"""
+import argparse
+import http.client
+import json
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import upstreams  # noqa: E402
+
+AUTH = {"Authorization": "Bearer oauth_token=t&oauth_token_secret=s"}
+
+
+def import_seconds(code, env):
+    out = subprocess.run(
+        [sys.executable, "-c",
+         "import time; start = time.perf_counter(); import wbip_wrapper; "
+         "print(time.perf_counter() - start)"],
+        cwd=code, env=env, capture_output=True, text=True, check=True)
+    return float(out.stdout.split()[-1])
+
+
+def request(port, method, path, body=None, headers=None):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    headers = dict(headers or {})
+    data = None
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    connection.request(method, path, data, headers)
+    response = connection.getresponse()
+    response.read()
+    connection.close()
+    return response.status
+
+
+def wait_ready(port, timeout=30):
+    stop = time.monotonic() + timeout
+    while time.monotonic() < stop:
+        try:
+            if request(port, "GET", "/") == 200:
+                return
+        except OSError:
+            time.sleep(0.005)
+    raise RuntimeError("gunicorn did not answer")
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+def workers(master):
+    pids = []
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == master:
+                    pids.append(int(pid))
+        except (OSError, ValueError, IndexError):
+            continue
+    return pids
+
+
+def pss_mib(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        total += int(line.split()[1])
+        except OSError:
+            continue
+    return total / 1024
+
+
+def run_server(args, env):
+    port = upstreams.free_port()
+    start = time.perf_counter()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{port}",
+         "--workers", str(args.workers), "wbip_wrapper:app"],
+        cwd=args.code, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(port)
+        result = {"ready": time.perf_counter() - start}
+        sync = {"x-auth-user": "bench", "x-auth-key": "key"}
+        result["sync"] = timed(lambda: (
+            request(port, "POST", "/users/create", {"username": "bench", "password": "key"}),
+            request(port, "PUT", "/syncs/progress",
+                    {"document": "doc", "progress": "/p", "percentage": 0.5,
+                     "device": "bench", "device_id": "bench"}, sync)))
+        result["listing"] = timed(lambda: request(port, "GET", "/api/entries.json", headers=AUTH))
+        result["epub"] = timed(lambda: request(port, "GET", "/api/entries/1/export.epub",
+                                               headers=AUTH))
+        # Every worker has served a request by now, or at least started
+        time.sleep(0.5)
+        result["memory"] = pss_mib([proc.pid] + workers(proc.pid))
+
+        for pid in workers(proc.pid):
+            os.kill(pid, signal.SIGKILL)
+        start = time.perf_counter()
+        time.sleep(0.01)
+        wait_ready(port)
+        result["respawn"] = time.perf_counter() - start
+        return result
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--code", default=os.path.join(HERE, "..", "code"))
+    args = parser.parse_args()
+    args.code = os.path.abspath(args.code)
+
+    instapaper, postlight, image_host = upstreams.start(entries=5, images=2)
+    secrets = tempfile.mkdtemp()
+    with open(os.path.join(secrets, "my_secrets.py"), "w") as fh:
+        fh.write('oauth_creds = {"key": "key", "secret": "secret"}\n')
+
+    def environment(**extra):
+        tmp = tempfile.mkdtemp()
+        return dict(os.environ,
+                    PYTHONPATH=os.pathsep.join([args.code, secrets]),
+                    KOSYNC_SQLITE3_DB=os.path.join(tmp, "sqlite3.db"),
+                    WBIP_INSTAPAPER_URL=instapaper.url,
+                    WBIP_POSTLIGHT_URL=f"{postlight.url}/parse-html",
+                    WBIP_EPUB_CACHE_DIR=os.path.join(tmp, "epubs"),
+                    WBIP_IMAGE_CACHE_DIR=os.path.join(tmp, "images"),
+                    WBIP_PREFETCH_WORKERS="0", **extra)
+
+    samples = [import_seconds(args.code, environment()) for _ in range(args.rounds)]
+    print(f"import wbip_wrapper  median {statistics.median(samples) * 1000:7.1f} ms   "
+          f"min {min(samples) * 1000:7.1f} ms")
+
+    for mode, extra in (("default", {}), ("preload", {"WBIP_PRELOAD": "true"})):
+        rounds = [run_server(args, environment(**extra)) for _ in range(args.rounds)]
+        print(f"{mode}, {args.workers} workers:")
+        for key in ("ready", "sync", "listing", "epub", "respawn"):
+            print(f"  {key:8s} median {statistics.median(r[key] for r in rounds) * 1000:7.1f} ms")
+        print(f"  memory   median {statistics.median(r['memory'] for r in rounds):7.1f} MiB PSS")
+
+
+if __name__ == "__main__":
+    main()
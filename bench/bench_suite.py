@@ -0,0 +1,528 @@
+"""End-to-end benchmark of KOReader workloads against local upstreams.
+
+Runs the app under gunicorn, against the Instapaper, Postlight and image
+host stand-ins of upstreams.py, and drives it with --clients concurrent
+clients doing what KOReader does:
+
+    listing    log in, then page through /api/entries.json
+    epub       download every entry's export.epub, then all of them again
+               from the cache
+    export     download every entry in one export.zip per client, then
+               again from the cache
+    progress   a progress sync storm: every client is a device that
+               authenticates and pushes/pulls /syncs/progress
+    archive    archive every entry, then wait for Instapaper to have
+               received each archive
+    reading    every client downloads a book, links its sync user to the
+               account and turns its pages, syncing progress on each turn; then wait for Instapaper to have the
+               last progress of every book, and count the calls it got
+    contention one account downloads the first half of the entries on
+               --clients connections at once, while another reads the
+               last few one at a time (waiting out any 503's Retry-After)
+               and two devices keep syncing progress
+
+Each workload gets a fresh server, database and caches, so the peak RSS
+reported for it (the largest worker's high-water mark) is its own. The
+report has requests, errors, throughput and p50/p99 latency per endpoint.
+Upstreams are seeded, so runs with the same options replay the same
+failures in the same mix.
+
+--save writes the results as JSON; --compare checks a run against such a
+file and exits with status 1 if any endpoint lost more than --tolerance
+of its throughput or gained as much p99 latency or peak RSS.
+
+    python bench/bench_suite.py
+    python bench/bench_suite.py --latency 0.05 --fail 0.1 --drop 0.05
+    python bench/bench_suite.py --save before.json --code /tmp/old/code
+    python bench/bench_suite.py --compare before.json
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, HERE)
+
+import upstreams  # noqa: E402
+
+
+class Client:
+    # One keep-alive connection, the way KOReader's HTTP client holds one
+    def __init__(self, base, results):
+        self.host = base.split("//", 1)[1]
+        self.results = results
+        self.connection = None
+        self.headers = {}
+
+    def call(self, label, method, path, body=None, headers=None):
+        headers = dict(self.headers, **(headers or {}))
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers["Content-Type"] = "application/json"
+        start = time.perf_counter()
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, timeout=120)
+            self.connection.request(method, path, data, headers)
+            response = self.connection.getresponse()
+            payload = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.connection = None
+            status, payload = None, b""
+        self.results.record(label, time.perf_counter() - start, status, len(payload))
+        return status, payload
+
+
+class Results:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+        # Workload specific numbers, reported as they are
+        self.notes = {}
+
+    def record(self, label, seconds, status, size):
+        end = time.perf_counter()
+        with self._lock:
+            stats = self.endpoints.setdefault(
+                label, {"samples": [], "errors": 0, "bytes": 0,
+                        "first": end - seconds, "last": end})
+            stats["last"] = end
+            if status is None or status >= 400:
+                stats["errors"] += 1
+            else:
+                stats["samples"].append(seconds)
+                stats["bytes"] += size
+
+    # Throughput is over the time an endpoint was being called
+    def summary(self):
+        summary = {}
+        for label, stats in self.endpoints.items():
+            samples = sorted(stats["samples"])
+            elapsed = stats["last"] - stats["first"]
+            summary[label] = {
+                "requests": len(samples) + stats["errors"],
+                "errors": stats["errors"],
+                "per_second": len(samples) / elapsed if elapsed else 0.0,
+                "p50_ms": statistics.median(samples) * 1000 if samples else None,
+                "p99_ms": (samples[max(0, len(samples) * 99 // 100 - 1)] * 1000
+                           if samples else None),
+                "mib": stats["bytes"] / 1024 / 1024,
+            }
+        return summary
+
+
+def in_parallel(clients, fn):
+    threads = [threading.Thread(target=fn, args=(n,)) for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def login(client):
+    status, token = client.call("POST /oauth/v2/token", "POST", "/oauth/v2/token",
+                                {"username": "bench", "password": "bench",
+                                 "grant_type": "password", "client_id": "koreader",
+                                 "client_secret": "koreader"})
+    if status != 200:
+        raise RuntimeError(f"login failed with {status}")
+    access_token = json.loads(token)["access_token"]
+    client.headers = {"Authorization": f"Bearer {access_token}"}
+
+
+def list_all(client, per_page=30):
+    ids = []
+    page = 1
+    while True:
+        status, body = client.call("GET /api/entries.json", "GET",
+                                   f"/api/entries.json?perPage={per_page}&page={page}")
+        if status != 200:
+            break
+        listing = json.loads(body)
+        ids += [entry["id"] for entry in listing["_embedded"]["items"]]
+        if page >= listing["pages"]:
+            break
+        page += 1
+    return ids
+
+
+def listing(base, args, results, upstream):
+    stop = time.monotonic() + args.duration
+
+    def run(n):
+        client = Client(base, results)
+        login(client)
+        while time.monotonic() < stop:
+            list_all(client)
+    in_parallel(args.clients, run)
+
+
+def epub(base, args, results, upstream):
+    setup = Client(base, Results())
+    login(setup)
+    ids = list_all(setup)
+
+    for label in ("GET export.epub (built)", "GET export.epub (cached)"):
+        def run(n):
+            client = Client(base, results)
+            client.headers = setup.headers
+            for id in ids[n::args.clients]:
+                client.call(label, "GET", f"/api/entries/{id}/export.epub")
+        in_parallel(args.clients, run)
+
+
+def export(base, args, results, upstream):
+    setup = Client(base, Results())
+    login(setup)
+    list_all(setup)
+
+    for label in ("GET export.zip (built)", "GET export.zip (cached)"):
+        def run(n):
+            client = Client(base, results)
+            client.headers = setup.headers
+            client.call(label, "GET", "/api/entries/export.zip")
+        in_parallel(args.clients, run)
+
+
+def progress(base, args, results, upstream):
+    stop = time.monotonic() + args.duration
+
+    def run(n):
+        client = Client(base, results)
+        user = {"x-auth-user": f"device{n}", "x-auth-key": "key"}
+        client.call("POST /users/create", "POST", "/users/create",
+                    {"username": f"device{n}", "password": "key"})
+        i = 0
+        while time.monotonic() < stop:
+            document = f"doc{i % 20}"
+            client.call("GET /users/auth", "GET", "/users/auth", headers=user)
+            client.call("PUT /syncs/progress", "PUT", "/syncs/progress",
+                        {"document": document, "progress": f"/body/p[{i}]",
+                         "percentage": (i % 100) / 100, "device": "bench",
+                         "device_id": f"device{n}"}, user)
+            client.call("GET /syncs/progress/<document>", "GET",
+                        f"/syncs/progress/{document}", headers=user)
+            i += 1
+    in_parallel(args.clients, run)
+
+
+def archive(base, args, results, upstream):
+    setup = Client(base, Results())
+    login(setup)
+    ids = list_all(setup)
+
+    def run(n):
+        client = Client(base, results)
+        client.headers = setup.headers
+        for id in ids[n::args.clients]:
+            client.call("PATCH /api/entries/<id>.json", "PATCH",
+                        f"/api/entries/{id}.json", {"archive": 1})
+    in_parallel(args.clients, run)
+
+    # Archives may be sent in the background
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.drain_timeout:
+        if all(upstream.archived[id] for id in ids):
+            break
+        time.sleep(0.05)
+    results.notes["drain_seconds"] = round(time.perf_counter() - start, 2)
+    results.notes["archives_lost"] = sum(1 for id in ids if not upstream.archived[id])
+    results.notes["archives_repeated"] = sum(1 for id in ids if upstream.archived[id] > 1)
+
+
+# The hash KOReader syncs a downloaded book's progress under
+def koreader_hash(data):
+    md5 = hashlib.md5()
+    for offset in [0] + [1024 << (2 * i) for i in range(11)]:
+        if offset >= len(data):
+            break
+        md5.update(data[offset:offset + 1024])
+    return md5.hexdigest()
+
+
+def reading(base, args, results, upstream):
+    setup = Client(base, Results())
+    login(setup)
+    ids = list_all(setup)[:args.clients]
+    stop = time.monotonic() + args.duration
+    last = {}
+
+    def run(n):
+        client = Client(base, results)
+        client.headers = setup.headers
+        status, book = client.call("GET export.epub (built)", "GET",
+                                   f"/api/entries/{ids[n]}/export.epub")
+        # KOReader logs in with the MD5 of the password
+        userkey = hashlib.md5(b"key").hexdigest()
+        user = {"x-auth-user": f"reader{n}", "x-auth-key": userkey}
+        client.call("POST /users/create", "POST", "/users/create",
+                    {"username": f"reader{n}", "password": userkey})
+        client.call("PUT /progress/link", "PUT", "/progress/link",
+                    {"username": f"reader{n}", "password": "key"})
+        document = koreader_hash(book)
+        page = 0
+        while time.monotonic() < stop:
+            page += 1
+            client.call("PUT /syncs/progress", "PUT", "/syncs/progress",
+                        {"document": document, "progress": f"/body/p[{page}]",
+                         "percentage": page / 100000, "device": "bench",
+                         "device_id": f"reader{n}"}, user)
+            time.sleep(args.page_turn)
+        last[ids[n]] = page / 100000
+    in_parallel(min(args.clients, len(ids)), run)
+
+    start = time.perf_counter()
+    while time.perf_counter() - start < args.drain_timeout:
+        if all(upstream.progress.get(id) == value for id, value in last.items()):
+            break
+        time.sleep(0.05)
+    calls = sum(count for (path, outcome), count in upstream.calls.items()
+                if path.endswith("/update_read_progress"))
+    results.notes["drain_seconds"] = round(time.perf_counter() - start, 2)
+    results.notes["page_turns"] = sum(round(value * 100000) for value in last.values())
+    results.notes["progress_calls"] = calls
+    results.notes["progress_lost"] = sum(1 for id, value in last.items()
+                                         if upstream.progress.get(id) != value)
+
+
+def contention(base, args, results, upstream):
+    setup = Client(base, Results())
+    login(setup)
+    ids = list_all(setup)
+    bulk, reader = ids[:len(ids) // 2], ids[-4:]
+    done = threading.Event()
+
+    def download(n):
+        client = Client(base, results)
+        client.headers = {"Authorization": "Bearer oauth_token=bulk&oauth_token_secret=s"}
+        for id in bulk[n::args.clients]:
+            client.call("GET export.epub (bulk)", "GET", f"/api/entries/{id}/export.epub")
+
+    def read():
+        client = Client(base, results)
+        client.headers = {"Authorization": "Bearer oauth_token=reader&oauth_token_secret=s"}
+        start = time.perf_counter()
+        for id in reader:
+            while True:
+                status, _ = client.call("GET export.epub (reader)", "GET",
+                                        f"/api/entries/{id}/export.epub")
+                if status != 503:
+                    break
+                time.sleep(1)
+        results.notes["reader_seconds"] = round(time.perf_counter() - start, 2)
+
+    def sync(n):
+        client = Client(base, results)
+        user = {"x-auth-user": f"device{n}", "x-auth-key": "key"}
+        client.call("POST /users/create", "POST", "/users/create",
+                    {"username": f"device{n}", "password": "key"})
+        i = 0
+        while not done.is_set():
+            client.call("PUT /syncs/progress", "PUT", "/syncs/progress",
+                        {"document": f"doc{n}", "progress": f"/body/p[{i}]",
+                         "percentage": (i % 100) / 100, "device": "bench",
+                         "device_id": f"device{n}"}, user)
+            i += 1
+            time.sleep(0.05)
+
+    syncing = [threading.Thread(target=sync, args=(n,)) for n in range(2)]
+    for t in syncing:
+        t.start()
+    reading = threading.Thread(target=read)
+    reading.start()
+    in_parallel(args.clients, download)
+    reading.join()
+    done.set()
+    for t in syncing:
+        t.join()
+
+
+WORKLOADS = {
+    "listing": listing,
+    "epub": epub,
+    "export": export,
+    "progress": progress,
+    "archive": archive,
+    "reading": reading,
+    "contention": contention,
+}
+
+
+# Largest peak RSS among gunicorn's workers, in MiB
+def peak_rss(master):
+    peak = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                parent = int(f.read().rsplit(")", 1)[1].split()[1])
+            if parent != master:
+                continue
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        peak = max(peak, int(line.split()[1]))
+        except (OSError, ValueError, IndexError):
+            continue
+    return peak / 1024
+
+
+def run_workload(name, args, secrets):
+    instapaper, postlight, image_host = upstreams.start(
+        entries=args.entries, images=args.images, paragraphs=args.paragraphs,
+        latency=args.latency, jitter=args.jitter, fail=args.fail, drop=args.drop,
+        seed=args.seed)
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join([args.code, secrets]),
+               KOSYNC_SQLITE3_DB=os.path.join(tmp, "sqlite3.db"),
+               WBIP_INSTAPAPER_URL=instapaper.url,
+               WBIP_POSTLIGHT_URL=f"{postlight.url}/parse-html",
+               WBIP_EPUB_CACHE_DIR=os.path.join(tmp, "epubs"),
+               WBIP_IMAGE_CACHE_DIR=os.path.join(tmp, "images"),
+               WBIP_PREFETCH_WORKERS=str(args.prefetch),
+               WBIP_WORKERS=str(args.workers),
+               WBIP_WORKER_CLASS=args.worker_class,
+               WBIP_PROGRESS_INTERVAL=str(args.progress_interval))
+    proc, base = upstreams.start_gunicorn(args.code, env)
+    results = Results()
+    try:
+        start = time.perf_counter()
+        WORKLOADS[name](base, args, results, instapaper)
+        elapsed = time.perf_counter() - start
+        rss = peak_rss(proc.pid)
+    finally:
+        proc.terminate()
+        proc.wait()
+        for upstream in (instapaper, postlight, image_host):
+            upstream.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+    return {"seconds": elapsed, "peak_rss_mib": rss,
+            "endpoints": results.summary(), "notes": results.notes}
+
+
+def report(name, result):
+    print(f"{name}: {result['seconds']:.1f} s, peak worker RSS "
+          f"{result['peak_rss_mib']:.0f} MiB")
+    for label, stats in result["endpoints"].items():
+        latency = "no successful requests"
+        if stats["p50_ms"] is not None:
+            latency = (f"p50 {stats['p50_ms']:8.1f} ms   "
+                       f"p99 {stats['p99_ms']:8.1f} ms")
+        print(f"  {label:32s} {stats['requests']:6d} req  {stats['errors']:5d} err  "
+              f"{stats['per_second']:8.1f} req/s   {latency}")
+    if result["notes"]:
+        print("  " + ", ".join(f"{k} {v}" for k, v in result["notes"].items()))
+
+
+# Lists what got worse than `baseline` by more than `tolerance`
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        if result["peak_rss_mib"] > before["peak_rss_mib"] * (1 + tolerance):
+            found.append(f"{name}: peak RSS {before['peak_rss_mib']:.0f} -> "
+                         f"{result['peak_rss_mib']:.0f} MiB")
+        for label, stats in result["endpoints"].items():
+            old = before["endpoints"].get(label)
+            if old is None:
+                continue
+            if stats["per_second"] < old["per_second"] * (1 - tolerance):
+                found.append(f"{name} {label}: {old['per_second']:.1f} -> "
+                             f"{stats['per_second']:.1f} req/s")
+            if (stats["p99_ms"] is not None and old["p99_ms"] is not None
+                    and stats["p99_ms"] > old["p99_ms"] * (1 + tolerance)):
+                found.append(f"{name} {label}: p99 {old['p99_ms']:.1f} -> "
+                             f"{stats['p99_ms']:.1f} ms")
+            if stats["errors"] > old["errors"] * (1 + tolerance) + 1:
+                found.append(f"{name} {label}: errors {old['errors']} -> "
+                             f"{stats['errors']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("workloads", nargs="*", default=list(WORKLOADS),
+                        help=f"any of {', '.join(WORKLOADS)}, all by default")
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--duration", type=float, default=10,
+                        help="seconds for the listing, progress and reading workloads")
+    parser.add_argument("--entries", type=int, default=60,
+                        help="unread bookmarks in the Instapaper stand-in")
+    parser.add_argument("--images", type=int, default=4, help="images per article")
+    parser.add_argument("--paragraphs", type=int, default=40)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="seconds every upstream waits before answering")
+    parser.add_argument("--jitter", type=float, default=0.02,
+                        help="up to this many more seconds, at random")
+    parser.add_argument("--fail", type=float, default=0.0,
+                        help="share of upstream calls answered with a 503")
+    parser.add_argument("--drop", type=float, default=0.0,
+                        help="share of upstream calls dropped without an answer")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--worker-class", default="gthread")
+    parser.add_argument("--prefetch", type=int, default=0,
+                        help="background EPUB builds per worker while listing")
+    parser.add_argument("--page-turn", type=float, default=0.05,
+                        help="seconds between page turns in the reading workload")
+    parser.add_argument("--progress-interval", type=float, default=2,
+                        help="WBIP_PROGRESS_INTERVAL for the reading workload")
+    parser.add_argument("--drain-timeout", type=float, default=120)
+    parser.add_argument("--code", default=os.path.join(HERE, "..", "code"))
+    parser.add_argument("--save", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON file of an earlier --save")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+    args.code = os.path.abspath(args.code)
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            parser.error(f"unknown workload {name}")
+
+    secrets = tempfile.mkdtemp()
+    with open(os.path.join(secrets, "my_secrets.py"), "w") as fh:
+        fh.write('oauth_creds = {"key": "key", "secret": "secret"}\n')
+
+    options = {k: v for k, v in vars(args).items()
+               if k not in ("code", "save", "compare", "tolerance", "workloads")}
+    print(f"Python {platform.python_version()}, {os.cpu_count()} CPUs, "
+          + ", ".join(f"{k}={v}" for k, v in options.items()))
+    results = {}
+    for name in args.workloads:
+        results[name] = run_workload(name, args, secrets)
+        report(name, results[name])
+    shutil.rmtree(secrets, ignore_errors=True)
+
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump({"options": options, "results": results}, fh, indent=2)
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        if baseline["options"] != options:
+            print("warning: the baseline was run with different options")
+        found = regressions(results, baseline["results"], args.tolerance)
+        for line in found:
+            print(f"REGRESSION {line}")
+        if found:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Load benchmark of the KOReader /users/auth and /syncs/progress PUT/GET cycle.
+
+Drives the Flask app in-process with its test client against a fresh
+SQLite database. Point --code at another checkout's code/ directory
+(e.g. a `git worktree` of an older commit) to get the "before" numbers.
+
+    python bench/bench_sync.py --cycles 2000
+    python bench/bench_sync.py --cycles 2000 --code /tmp/baseline/code
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_app(code_dir, db):
+    os.environ["KOSYNC_SQLITE3_DB"] = db
+    os.chdir(code_dir)
+    sys.path.insert(0, code_dir)
+    if "my_secrets" not in sys.modules:
+        try:
+            import my_secrets  # noqa: F401
+        except ImportError:
+            stub = types.ModuleType("my_secrets")
+            stub.oauth_creds = {"key": "key", "secret": "secret"}
+            sys.modules["my_secrets"] = stub
+    import wbip_wrapper
+    return wbip_wrapper.app
+
+
+def report(name, samples):
+    samples.sort()
+    total = sum(samples)
+    print(f"{name:5s} {len(samples) / total:8.0f} req/s   "
+          f"p50 {statistics.median(samples) * 1000:6.3f} ms   "
+          f"p99 {samples[len(samples) * 99 // 100 - 1] * 1000:6.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cycles", type=int, default=2000)
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--code", default=os.path.join(HERE, "..", "code"))
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    app = load_app(os.path.abspath(args.code), os.path.join(tmp, "sqlite3.db"))
+    client = app.test_client()
+    client.post("/users/create", json={"username": "bench", "password": "key"})
+    headers = {"x-auth-user": "bench", "x-auth-key": "key"}
+
+    auths, puts, gets = [], [], []
+    for i in range(args.cycles):
+        document = f"doc{i % args.documents}"
+        body = {"document": document, "progress": f"/body/p[{i}]",
+                "percentage": (i % 100) / 100, "device": "bench",
+                "device_id": "bench"}
+        start = time.perf_counter()
+        r = client.get("/users/auth", headers=headers)
+        auths.append(time.perf_counter() - start)
+        assert r.status_code == 200, r.data
+
+        start = time.perf_counter()
+        r = client.put("/syncs/progress", json=body, headers=headers)
+        puts.append(time.perf_counter() - start)
+        assert r.status_code == 200, r.data
+
+        start = time.perf_counter()
+        r = client.get(f"/syncs/progress/{document}", headers=headers)
+        gets.append(time.perf_counter() - start)
+        assert r.status_code == 200, r.data
+
+    report("AUTH", auths)
+    report("PUT", puts)
+    report("GET", gets)
+
+
+if __name__ == "__main__":
+    main()
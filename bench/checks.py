@@ -0,0 +1,340 @@
+"""Checks of the behaviour the benchmarks only measure.
+
+Each check drives the code against the stand-ins of upstreams.py and a
+fresh SQLite database and fails with an AssertionError when the
+behaviour is off. Give check names to run only those.
+
+    python bench/checks.py
+    python bench/checks.py enrich
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CODE = os.path.join(HERE, "..", "code")
+sys.path.insert(0, HERE)
+sys.path.insert(0, CODE)
+
+import enrich  # noqa: E402
+import images  # noqa: E402
+import outbox  # noqa: E402
+import progress  # noqa: E402
+import scheduler  # noqa: E402
+import upstreams  # noqa: E402
+from backend.common import Document, Operation  # noqa: E402
+from backend.sqlite import BackendSQLite  # noqa: E402
+from instapaper import InstapaperClient, Token  # noqa: E402
+
+PROGRESS = progress.PROGRESS_PATH
+ARCHIVE = progress.ARCHIVE_PATH
+
+
+def fresh_backend():
+    return BackendSQLite(os.path.join(tempfile.mkdtemp(), "sqlite3.db"))
+
+
+def instapaper_outbox(instapaper, **kw):
+    client = InstapaperClient(Token("key", "secret"), base_url=instapaper.url,
+                              timeout=2)
+    return outbox.Outbox(fresh_backend(), client, **kw)
+
+
+# Waits for the outbox to send or drop everything
+def drain(outbox, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while outbox.backend.get_outbox_stats()[0]:
+        assert time.monotonic() < deadline, outbox.status()
+        time.sleep(0.05)
+
+
+# Postlight results are cached for `ttl`, pages it can't parse for
+# `negative_ttl`, and Postlight failing opens the breaker without being
+# cached against the page
+def check_enrich():
+    postlight = upstreams.Postlight()
+    enricher = enrich.Enricher(fresh_backend(), postlight.url + "/parse-html",
+                               ttl=1, negative_ttl=1, timeout=2,
+                               max_failures=2, cooldown=1)
+    calls = lambda: sum(postlight.calls.values())  # noqa: E731
+
+    # TTL: cached until it runs out
+    data = enricher.enrich("http://example.com/a")
+    assert data["author"] == "Bench Author" and "content" not in data, data
+    assert enricher.enrich("http://example.com/a") == data
+    assert calls() == 1, postlight.calls
+    time.sleep(2.1)
+    assert enricher.enrich("http://example.com/a") == data
+    assert calls() == 2, postlight.calls
+
+    # Negative cache: a page Postlight can't parse isn't asked about again
+    # until `negative_ttl` runs out
+    assert enricher.enrich("http://example.com/broken") == {}
+    assert enricher.enrich("http://example.com/broken") == {}
+    assert calls() == 3, postlight.calls
+    time.sleep(2.1)
+    assert enricher.enrich("http://example.com/broken") == {}
+    assert calls() == 4, postlight.calls
+
+    # Breaker: 5xx answers count as failures and are not cached, so the
+    # page is enriched once Postlight is back
+    postlight.fail = 1.0
+    assert enricher.enrich("http://example.com/b") == {}
+    assert enricher.backend.get_enrichment("http://example.com/b") is None
+    assert enricher.enrich("http://example.com/b") == {}
+    assert calls() == 6, postlight.calls
+    # Open: Postlight is skipped
+    assert enricher.enrich("http://example.com/b") == {}
+    assert calls() == 6, postlight.calls
+    postlight.fail = 0.0
+    time.sleep(1.1)
+    assert enricher.enrich("http://example.com/b")["author"] == "Bench Author"
+    assert calls() == 7, postlight.calls
+
+    # Unreachable counts as well
+    postlight.stop()
+    enricher.url = "http://127.0.0.1:9/parse-html"
+    enricher.max_failures = 1
+    assert enricher.enrich("http://example.com/c") == {}
+    assert enricher.backend.get_enrichment("http://example.com/c") is None
+    assert time.monotonic() < enricher._open_until
+
+
+# A failing call is retried after `backoff`, doubling, until
+# `max_attempts`, and is then dropped
+def check_outbox_retry():
+    instapaper = upstreams.Instapaper(entries=1, fail=1.0)
+    outbox = instapaper_outbox(instapaper, interval=0.05, backoff=0.3,
+                               max_backoff=10, max_attempts=4)
+    sent = lambda: instapaper.calls[PROGRESS, 503]  # noqa: E731
+
+    start = time.monotonic()
+    outbox.enqueue(Token("a", "s"), PROGRESS, {"bookmark_id": 1, "progress": 0.5})
+    # Tries at 0, 0.3, 0.9 and 2.1 seconds
+    for at, tries in ((0.15, 1), (0.6, 2), (1.5, 3), (2.7, 4), (3.5, 4)):
+        time.sleep(max(start + at - time.monotonic(), 0))
+        assert sent() == tries, (at, instapaper.calls)
+    assert outbox.status()["dropped"] == 1, outbox.status()
+    assert outbox.status()["retried"] == 3, outbox.status()
+    assert outbox.backend.get_outbox_stats()[0] == 0
+
+
+# Every call reaches Instapaper exactly once through failures and dropped
+# connections, the calls for a bookmark in the order they were made
+def check_outbox_delivery():
+    instapaper = upstreams.Instapaper(entries=40, fail=0.3, drop=0.1,
+                                      latency=0.005, jitter=0.01)
+    outbox = instapaper_outbox(instapaper, interval=0.05, backoff=0.05,
+                               max_backoff=0.2, concurrency=8)
+    token = Token("a", "s")
+    for id in range(1, 41):
+        outbox.enqueue(token, PROGRESS, {"bookmark_id": id, "progress": 1.0},
+                       replace=True)
+        outbox.enqueue(token, ARCHIVE, {"bookmark_id": id})
+    drain(outbox)
+
+    assert outbox.status()["retried"] > 0, outbox.status()
+    assert outbox.status()["dropped"] == 0, outbox.status()
+    for id in range(1, 41):
+        calls = [name for name, bookmark in instapaper.log if bookmark == id]
+        assert calls == ["update_read_progress", "archive"], (id, calls)
+        assert instapaper.progress[id] == 1.0, id
+
+
+def write_book(path, seed):
+    with open(path, "wb") as fh:
+        fh.write(os.urandom(64 * 1024) if seed is None else bytes([seed]) * 64 * 1024)
+
+
+def archive_op(token, bookmark):
+    return Operation(None, token.key, token.secret, bookmark, ARCHIVE,
+                     json.dumps({"bookmark_id": bookmark}), time.time(), 0)
+
+
+# Page turns reported between flushes become one progress call per
+# book, only for sync users linked to the book's account, and never over
+# a pending archive
+def check_bridge():
+    instapaper = upstreams.Instapaper(entries=3)
+    outbox = instapaper_outbox(instapaper, interval=0.05)
+    bridge = progress.ProgressBridge(outbox.backend, outbox, interval=3600)
+    token = Token("account", "secret")
+    books = tempfile.mkdtemp()
+    documents = {}
+    for id in (1, 2, 3):
+        path = os.path.join(books, f"{id}.epub")
+        write_book(path, id)
+        bridge.register(path, f"{id}.epub", id, token, "color")
+        documents[id] = progress.partial_md5(path)
+    bridge.link_user("reader", token)
+
+    for turn in range(1, 101):
+        for id in (1, 2):
+            bridge.push("reader", Document(documents[id], f"/p[{turn}]",
+                                           turn / 100, "d", "d", turn))
+    # Not linked to the account
+    bridge.push("stranger", Document(documents[3], "/p", 0.5, "d", "d", 1))
+    bridge.flush()
+    drain(outbox)
+    assert instapaper.calls[PROGRESS, 200] == 2, instapaper.calls
+    assert instapaper.progress == {1: 1.0, 2: 1.0}, instapaper.progress
+
+    # An archive pending keeps the progress it set
+    outbox.interval = 3600
+    time.sleep(0.1)
+    outbox.backend.enqueue_operation(archive_op(token, 1))
+    bridge.push("reader", Document(documents[1], "/p", 0.2, "d", "d", 200))
+    bridge.flush()
+    assert outbox.backend.get_pending_bookmarks("account", ARCHIVE) == {1}
+    assert outbox.backend.get_pending_bookmarks("account", PROGRESS) == set()
+    bridge.close()
+
+
+# A bookmark's books are told apart per image profile: building it for
+# another profile or rebuilding it keeps the other profile's books and
+# the latest BUILDS_KEPT builds of its own
+def check_profiles():
+    backend = fresh_backend()
+    bridge = progress.ProgressBridge(backend, None)
+    token = Token("account", "secret")
+    path = os.path.join(tempfile.mkdtemp(), "book.epub")
+
+    def build(profile):
+        write_book(path, None)
+        bridge.register(path, "book.epub", 7, token, profile)
+        return progress.partial_md5(path)
+
+    gray = build("gray")
+    color = [build("color") for _ in range(progress.BUILDS_KEPT + 2)]
+    for document, profile in [(gray, "gray")] + [
+            (document, "color") for document in color[-progress.BUILDS_KEPT:]]:
+        book = backend.get_book(document)
+        assert book is not None and book.profile == profile, (document, profile)
+        assert book.bookmark == 7 and book.account == "account", book
+    for document in color[:-progress.BUILDS_KEPT]:
+        assert backend.get_book(document) is None, document
+    assert backend.get_book(progress.filename_md5("book.epub")) is not None
+
+
+# Bytes of downloads that turn out not to decode go back to the
+# article's budget, so the images after them still fit
+def check_image_budget():
+    import io
+    from PIL import Image
+
+    buf = io.BytesIO()
+    Image.effect_noise((400, 300), 64).convert("RGB").save(buf, "jpeg")
+    good = buf.getvalue()
+    broken = (b"\xff\xd8 not a jpeg " * len(good))[:len(good)]
+
+    def respond(path, body, headers):
+        if "broken" in path:
+            return 200, {"Content-Type": "image/jpeg"}, broken
+        # Later than the transcodes of the broken ones
+        time.sleep(0.3)
+        return 200, {"Content-Type": "image/jpeg"}, good
+
+    host = upstreams.start_stub(respond)
+    base = f"http://127.0.0.1:{host.server_port}"
+    urls = {name: f"{base}/{name}.jpg" for name in ("broken0", "broken1", "good0", "good1")}
+    for transcode_workers in (0, 2):
+        pipeline = images.ImagePipeline(
+            fetch_workers=1, transcode_workers=transcode_workers,
+            article_bytes=2 * len(good) + 10)
+        delivered = pipeline.process(urls, images.PROFILES["default"],
+                                     lambda key, data: None)
+        assert delivered == {"good0", "good1"}, (transcode_workers, delivered)
+    host.shutdown()
+
+
+def _build_in_worker(slot_dir, running, peak, builds, lane, max_wait):
+    builds_scheduler = scheduler.BuildScheduler(max_running=2, max_wait=max_wait,
+                                                slot_dir=slot_dir)
+
+    def build(n):
+        try:
+            with builds_scheduler.slot(f"user{n}", lane):
+                with running.get_lock():
+                    running.value += 1
+                    peak.value = max(peak.value, running.value)
+                # A process forked during the build, like the transcoding
+                # pool, outlives it without keeping its slot
+                if os.fork() == 0:
+                    time.sleep(1.0)
+                    os._exit(0)
+                time.sleep(0.2)
+                with running.get_lock():
+                    running.value -= 1
+                    builds.value += 1
+        except scheduler.Busy:
+            pass
+
+    threads = [threading.Thread(target=build, args=(n,)) for n in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+# Workers sharing a slot directory run no more than `max_running` builds
+# between them, and an interactive build that can't get a shared slot in
+# time is refused
+def check_scheduler():
+    context = multiprocessing.get_context("fork")
+    slot_dir = tempfile.mkdtemp()
+    running, peak, builds = (context.Value("i", 0) for _ in range(3))
+
+    def run(workers, lane, max_wait):
+        processes = [context.Process(target=_build_in_worker, args=(
+            slot_dir, running, peak, builds, lane, max_wait)) for _ in range(workers)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+
+    start = time.monotonic()
+    run(3, "background", 30.0)
+    assert builds.value == 9, builds.value
+    assert peak.value == 2, peak.value
+    assert time.monotonic() - start < 2.5, time.monotonic() - start
+
+    # Six builds for two slots, 0.2 s each, with 0.3 s to get one
+    builds.value = peak.value = 0
+    run(2, "interactive", 0.3)
+    assert peak.value == 2, peak.value
+    assert 2 <= builds.value < 6, builds.value
+
+
+CHECKS = {name[len("check_"):]: check for name, check in globals().items()
+          if name.startswith("check_")}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checks", nargs="*", metavar="check",
+                        help=", ".join(sorted(CHECKS)))
+    args = parser.parse_args()
+    unknown = set(args.checks) - set(CHECKS)
+    if unknown:
+        parser.error(f"unknown checks: {', '.join(sorted(unknown))}")
+
+    failed = 0
+    for name in args.checks or sorted(CHECKS):
+        start = time.perf_counter()
+        try:
+            CHECKS[name]()
+        except AssertionError as e:
+            failed += 1
+            print(f"{name:12s} FAIL {e!r}")
+            continue
+        print(f"{name:12s} ok   {time.perf_counter() - start:.1f}s")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""Local stand-ins for the services the app talks to.
+
+Instapaper (`/api/1/oauth/access_token` and `/api/1/bookmarks/*`),
+Postlight (`/parse-html`) and an image host each run on their own port
+in a background thread. Every one of them can answer late (`latency`
+plus up to `jitter` seconds), fail with a 503 (`fail`) or drop the
+connection without answering (`drop`), decided per request by a seeded
+random generator. Each counts the calls it got per path and outcome in
+`calls`.
+
+The Instapaper stand-in keeps a listing of `entries` unread bookmarks:
+`have` is honoured the way Instapaper does, archived bookmarks leave the
+listing and come back as `delete_ids` (with every archive and progress
+update also kept in order in `log`), and every article links `images`
+pictures on the image host. Postlight answers with an error for urls
+ending in `/broken`, as it does for pages it cannot parse.
+
+`start_stub` serves any other canned answer the same way, and
+`start_gunicorn` runs the app itself on a free port.
+"""
+import hashlib
+import http.client
+import io
+import json
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from PIL import Image
+
+WORDS = ("lorem ipsum dolor sit amet consectetur adipiscing elit sed do "
+         "eiusmod tempor incididunt ut labore et dolore magna aliqua").split()
+
+
+class Upstream:
+    # Seconds added to every answer, plus up to `jitter` more
+    latency: float
+    jitter: float
+    # Share of calls answered with a 503, and dropped without an answer
+    fail: float
+    drop: float
+    # Calls received, by (path, outcome)
+    calls: Counter
+
+    def __init__(self, latency=0.0, jitter=0.0, fail=0.0, drop=0.0, seed=1):
+        self.latency = latency
+        self.jitter = jitter
+        self.fail = fail
+        self.drop = drop
+        self.calls = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = start_stub(self._handle)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handle(self, path, body, headers):
+        path = path.split("?", 1)[0]
+        with self._lock:
+            roll = self._random.random()
+            delay = self.latency + self._random.random() * self.jitter
+        time.sleep(delay)
+        if roll < self.drop:
+            self._count(path, "dropped")
+            return None
+        if roll < self.drop + self.fail:
+            self._count(path, 503)
+            return 503, {}, b""
+        status, headers, payload = self.answer(path, body, headers)
+        self._count(path, status)
+        return status, headers, payload
+
+    def _count(self, path, outcome):
+        with self._lock:
+            self.calls[path, outcome] += 1
+
+    # Returns (status, headers, body) for a call that isn't failed
+    def answer(self, path, body, headers):
+        raise NotImplementedError
+
+
+def _json(data):
+    return 200, {"Content-Type": "application/json"}, json.dumps(data).encode()
+
+
+# Serves HTTP/1.1 with keep-alive on a free local port, in a background
+# thread. `respond(path, body, headers)` answers every GET and POST with
+# (status, headers, body), or None to drop the connection unanswered.
+# Every new connection takes `handshake` seconds to set up.
+def start_stub(respond, handshake=0.0) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def setup(self):
+            time.sleep(handshake)
+            super().setup()
+
+        def do_GET(self):
+            self._answer(b"")
+
+        def do_POST(self):
+            self._answer(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+
+        def _answer(self, body):
+            answer = respond(self.path, body, self.headers)
+            if answer is None:
+                self.close_connection = True
+                return
+            status, headers, payload = answer
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# Runs the app in `code` under gunicorn on a free port, configured by
+# `env`. Returns the process and the base url once it answers.
+def start_gunicorn(code, env) -> tuple:
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-b", f"127.0.0.1:{port}",
+         "wbip_wrapper:app"],
+        cwd=code, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f"http://127.0.0.1:{port}"
+    for _ in range(200):
+        try:
+            connection = http.client.HTTPConnection(f"127.0.0.1:{port}", timeout=1)
+            connection.request("GET", "/")
+            connection.getresponse().read()
+            return proc, base
+        except OSError:
+            time.sleep(0.1)
+        if proc.poll() is not None:
+            break
+    proc.kill()
+    raise RuntimeError("gunicorn did not start")
+
+
+class Instapaper(Upstream):
+    def __init__(self, entries=100, images=4, paragraphs=40, image_host="", **kw):
+        super().__init__(**kw)
+        self.image_host = image_host
+        self.images = images
+        self.paragraphs = paragraphs
+        self.archived = Counter()
+        self.progress = {}
+        # (call, bookmark) of the archive and progress updates, in order
+        self.log = []
+        self.marks = {
+            i: {"type": "bookmark", "bookmark_id": i, "title": f"Article {i}",
+                "url": f"https://news{i % 7}.example.com/2024/article-{i}",
+                "description": "", "tags": [{"name": "bench"}] if i % 5 == 0 else [],
+                "time": 1700000000 + i, "progress": 0.0, "progress_timestamp": 0,
+                "starred": "0", "private_source": "", "hash": f"h{i}"}
+            for i in range(1, entries + 1)}
+
+    def answer(self, path, body, headers):
+        form = {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        name = path.rsplit("/", 1)[1]
+        if name == "access_token":
+            return 200, {}, b"oauth_token=bench&oauth_token_secret=bench"
+        if name == "list":
+            return _json(self._list(form))
+        if name == "get_text":
+            return 200, {"Content-Type": "text/html"}, self._text(
+                int(form["bookmark_id"])).encode()
+        if name == "archive":
+            with self._lock:
+                self.archived[int(form["bookmark_id"])] += 1
+                self.log.append((name, int(form["bookmark_id"])))
+            return _json([self.marks.get(int(form["bookmark_id"]), {})])
+        if name == "update_read_progress":
+            with self._lock:
+                self.progress[int(form["bookmark_id"])] = float(form["progress"])
+                self.log.append((name, int(form["bookmark_id"])))
+            return _json([self.marks.get(int(form["bookmark_id"]), {})])
+        if name == "add":
+            return _json([{"type": "bookmark", "bookmark_id": 0,
+                           "url": form.get("url", "")}])
+        return 404, {}, b"[]"
+
+    def _list(self, form):
+        have = {}
+        for item in form.get("have", "").split(","):
+            id, _, hash = item.partition(":")
+            if id:
+                have[int(id)] = hash
+        limit = int(form.get("limit", 25))
+        with self._lock:
+            unread = [mark for id, mark in self.marks.items()
+                      if id not in self.archived][:limit]
+            deleted = [id for id in have if id in self.archived]
+        listing = [{"type": "meta"},
+                   {"type": "user", "user_id": 1, "username": "bench"}]
+        listing += [mark for mark in unread
+                    if have.get(mark["bookmark_id"]) != mark["hash"]]
+        if deleted:
+            listing[0]["delete_ids"] = ",".join(map(str, deleted))
+        return listing
+
+    def _text(self, id):
+        rng = random.Random(id)
+        parts = []
+        for p in range(self.paragraphs):
+            text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(40, 120)))
+            parts.append(f'<p>{text} <a href="https://example.com/{p}">link</a></p>')
+        step = max(1, self.paragraphs // (self.images + 1))
+        for n in range(self.images):
+            ext = "png" if n % 3 == 2 else "jpg"
+            parts.insert((n + 1) * step + n,
+                         f'<figure><img src="{self.image_host}/img/{id}/{n}.{ext}"/>'
+                         f'<figcaption>Figure {n}</figcaption></figure>')
+        return "".join(parts)
+
+
+class Postlight(Upstream):
+    def answer(self, path, body, headers):
+        url = json.loads(body or b"{}").get("url", "")
+        # Postlight's answer for a page it can't parse
+        if url.endswith("/broken"):
+            return _json({"error": True, "messages": "Resource returned a response status code of 404"})
+        domain = url.split("/")[2] if url.count("/") >= 2 else ""
+        return _json({"title": url.rsplit("/", 1)[-1], "author": "Bench Author",
+                      "domain": domain, "excerpt": "An article",
+                      "content": "<p>" + "text " * 2000 + "</p>",
+                      "word_count": 2000, "lead_image_url": None})
+
+
+class ImageHost(Upstream):
+    def __init__(self, **kw):
+        super().__init__(**kw)
+        self.payloads = {}
+        for n, size in enumerate(((2400, 1600), (1600, 1200), (800, 600))):
+            im = Image.merge("RGB", (
+                Image.effect_mandelbrot(size, (-2.0, -1.2, 1.0, 1.2), 60 + n * 20),
+                Image.linear_gradient("L").resize(size),
+                Image.radial_gradient("L").resize(size)))
+            for fmt, ext in (("JPEG", "jpg"), ("PNG", "png")):
+                buf = io.BytesIO()
+                im.save(buf, fmt, **({"quality": 88} if fmt == "JPEG" else {}))
+                self.payloads.setdefault(ext, []).append(buf.getvalue())
+
+    def answer(self, path, body, headers):
+        ext = path.rsplit(".", 1)[-1]
+        if ext not in self.payloads:
+            return 404, {}, b""
+        choices = self.payloads[ext]
+        data = choices[int(hashlib.md5(path.encode()).hexdigest(), 16) % len(choices)]
+        etag = '"' + hashlib.md5(data).hexdigest() + '"'
+        if headers.get("If-None-Match") == etag:
+            return 304, {"ETag": etag}, b""
+        return 200, {"Content-Type": f"image/{'jpeg' if ext == 'jpg' else ext}",
+                     "ETag": etag, "Cache-Control": "max-age=86400"}, data
+
+
+# Starts all three stand-ins with the same latency and failure settings
+def start(entries=100, images=4, paragraphs=40, **kw):
+    image_host = ImageHost(**kw)
+    return (Instapaper(entries, images, paragraphs, image_host.url, **kw),
+            Postlight(**kw), image_host)
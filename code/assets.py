@@ -0,0 +1,44 @@
+import json
+import logging
+import os
+from dataclasses import dataclass
+from types import MappingProxyType
+
+# Static files used while building books, read once at startup.
+# The registry is immutable, so with gunicorn's preload_app it is loaded
+# once in the master and shared by every forked worker.
+
+logger = logging.getLogger(__name__)
+
+# Where the files ship, next to this module
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+@dataclass(frozen=True)
+class Assets:
+    # Stylesheet linked from every chapter
+    stylesheet: bytes
+    # Names shown instead of some domains, e.g. "nytimes.com"
+    domain_map: MappingProxyType
+
+
+# Reads the assets from `directory`. A missing domain map only means no
+# domain gets renamed; an unreadable one raises ValueError.
+def load(directory: str = DIRECTORY) -> Assets:
+    with open(os.path.join(directory, "nook-glowlight-3.css"), "rb") as fh:
+        stylesheet = fh.read()
+
+    path = os.path.join(directory, "domain_map.json")
+    try:
+        with open(path) as fh:
+            domain_map = json.load(fh)
+    except FileNotFoundError:
+        logger.info(f"No {path}, domains are shown as they are")
+        domain_map = {}
+    except ValueError as e:
+        raise ValueError(f"Cannot parse {path}: {e}")
+    if not isinstance(domain_map, dict) or not all(
+            isinstance(v, str) for v in domain_map.values()):
+        raise ValueError(f"{path} must map domains to names")
+    logger.debug(f"domain_map: {domain_map}")
+    return Assets(stylesheet, MappingProxyType(domain_map))
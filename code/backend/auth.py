@@ -0,0 +1,74 @@
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Credential hashing and the verified-login cache used by the backends.
+
+# Stored userkeys look like pbkdf2_sha256$<iterations>$<salt>$<hash>
+HASH_SCHEME = "pbkdf2_sha256"
+HASH_ITERATIONS = 100000
+
+
+def hash_userkey(userkey: str, salt: bytes = None,
+                 iterations: int = HASH_ITERATIONS) -> str:
+    if salt is None:
+        salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac("sha256", userkey.encode(), salt, iterations)
+    return f"{HASH_SCHEME}${iterations}${salt.hex()}${digest.hex()}"
+
+
+def is_hashed(stored: str) -> bool:
+    return stored.startswith(HASH_SCHEME + "$")
+
+
+# Checks a userkey against its stored hash, in constant time.
+def verify_userkey(userkey: str, stored: str) -> bool:
+    try:
+        scheme, iterations, salt, _ = stored.split("$")
+        expected = hash_userkey(userkey, bytes.fromhex(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(expected, stored)
+
+
+# Bounded cache of recently verified logins.
+# Only a digest of the userkey is kept in memory, and entries expire
+# after `ttl` seconds so changes made by other workers are picked up.
+class LoginCache:
+    def __init__(self, max_entries: int = 1024, ttl: float = 300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _key(self, username: str, userkey: str) -> tuple:
+        return username, hashlib.sha256(userkey.encode()).digest()
+
+    def hit(self, username: str, userkey: str) -> bool:
+        key = self._key(username, userkey)
+        with self._lock:
+            expires = self._entries.get(key)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._entries[key]
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+    def add(self, username: str, userkey: str):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[self._key(username, userkey)] = time.monotonic() + self.ttl
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    # Drop every cached login for a user
+    def forget(self, username: str):
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == username]:
+                del self._entries[key]
@@ -20,3 +20,57 @@ class Bookmark:
     title: str
     url: str
     tags: str
+
+
+# A listed bookmark as last seen on Instapaper, kept per account so
+# listings can be synced incrementally. `entry` is the wallabag JSON.
+
+
+@dataclass
+class Entry:
+    id: int
+    hash: str
+    time: int
+    entry: str
+
+
+# Cached Postlight metadata for an article url. `data` is JSON, and
+# `ok` is False for a remembered failure.
+
+
+@dataclass
+class Enrichment:
+    url: str
+    data: str
+    ok: bool
+    fetched_at: int
+
+
+# A pending Instapaper call in the outbox. `account` and `secret` are
+# the oauth token to send it with, `parameters` is JSON.
+
+
+@dataclass
+class Operation:
+    id: int
+    account: str
+    secret: str
+    bookmark: int
+    path: str
+    parameters: str
+    created_at: float
+    attempts: int
+
+
+# A book we built, by the hash KOReader identifies it with when syncing
+# progress. `account` is the Instapaper account it was built for,
+# `profile` the image profile and `built_at` when.
+
+
+@dataclass
+class Book:
+    document: str
+    bookmark: int
+    account: str
+    profile: str
+    built_at: float
@@ -1,164 +1,529 @@
-from backend.common import Document, Bookmark
+from backend.auth import LoginCache, hash_userkey, is_hashed, verify_userkey
+from backend.common import Document, Bookmark, Book, Entry, Enrichment, Operation
+from contextlib import contextmanager
+import atexit
+import os
 import sqlite3
+import threading
+import time
+import weakref
+
+import metrics
 
 # SQLite3 backend, stores data in a local .db file
 
+# Applied to every new connection
+PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -8192",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+)
+
+
+# Replaces userkeys stored in plain text by older versions with hashes
+def _hash_plain_userkeys(cursor):
+    cursor.execute("SELECT username, userkey FROM users")
+    plain = [(hash_userkey(userkey), username)
+             for username, userkey in cursor.fetchall()
+             if not is_hashed(userkey)]
+    cursor.executemany("UPDATE users SET userkey = ? WHERE username = ?", plain)
+
+
+# Schema migrations, applied in order. The database's `user_version`
+# records how many have run, so add new steps at the end and never edit
+# one that has shipped. A step is a list of statements, or of functions
+# called with the cursor for changes SQL can't make.
+MIGRATIONS = (
+    # 1: the original tables
+    ("""CREATE TABLE IF NOT EXISTS users
+        (username text, userkey text)""",
+     """CREATE TABLE IF NOT EXISTS documents
+        (username text, document text, progress text,
+         percentage float, device text, device_id text,
+         timestamp int)""",
+     """CREATE TABLE IF NOT EXISTS bookmarks
+        (id int primary key, title text, url text, tags text)"""),
+    # 2: primary keys on users and documents, keeping the newest row
+    # of any duplicates
+    ("""CREATE TABLE users_new
+        (username text PRIMARY KEY, userkey text)""",
+     """INSERT OR REPLACE INTO users_new
+        SELECT username, userkey FROM users ORDER BY rowid""",
+     "DROP TABLE users",
+     "ALTER TABLE users_new RENAME TO users",
+     """CREATE TABLE documents_new
+        (username text, document text, progress text,
+         percentage float, device text, device_id text,
+         timestamp int, PRIMARY KEY (username, document))""",
+     """INSERT OR REPLACE INTO documents_new
+        SELECT username, document, progress, percentage, device,
+               device_id, timestamp
+        FROM documents ORDER BY timestamp, rowid""",
+     "DROP TABLE documents",
+     "ALTER TABLE documents_new RENAME TO documents"),
+    # 3: local copy of each account's listing for incremental sync
+    ("""CREATE TABLE entries
+        (account text, id int, hash text, time int, entry text,
+         PRIMARY KEY (account, id))""",
+     "CREATE INDEX entries_by_time ON entries (account, time DESC, id DESC)"),
+    # 4: cached Postlight metadata
+    ("""CREATE TABLE enrichments
+        (url text PRIMARY KEY, data text, ok int, fetched_at int)""",),
+    # 5: Instapaper calls waiting to be sent
+    ("""CREATE TABLE outbox
+        (id integer PRIMARY KEY, account text, secret text, bookmark int,
+         path text, parameters text, created_at float, attempts int,
+         next_attempt float, error text)""",
+     "CREATE INDEX outbox_by_due ON outbox (next_attempt)",
+     "CREATE INDEX outbox_by_bookmark ON outbox (account, bookmark, path)"),
+    # 6: image profile chosen per account
+    ("""CREATE TABLE profiles
+        (account text PRIMARY KEY, profile text)""",),
+    # 7: KOReader document hashes of the books we built
+    ("""CREATE TABLE books
+        (document text PRIMARY KEY, bookmark int, account text, secret text)""",),
+    # 8: finding the books of a bookmark to replace them
+    ("CREATE INDEX books_by_bookmark ON books (account, bookmark)",),
+    # 9: books are kept per image profile and build
+    ("ALTER TABLE books ADD COLUMN profile text",
+     "ALTER TABLE books ADD COLUMN built_at float",
+     "DROP INDEX books_by_bookmark",
+     "CREATE INDEX books_by_build ON books (account, bookmark, profile, built_at)"),
+    # 10: progress goes to an account only from the sync users linked to
+    # it, sent with the token kept with the link rather than with books
+    ("""CREATE TABLE sync_links
+        (username text, account text, secret text,
+         PRIMARY KEY (username, account))""",
+     """CREATE TABLE books_new
+        (document text PRIMARY KEY, bookmark int, account text,
+         profile text, built_at float)""",
+     """INSERT INTO books_new
+        SELECT document, bookmark, account, profile, built_at FROM books""",
+     "DROP TABLE books",
+     "ALTER TABLE books_new RENAME TO books",
+     "CREATE INDEX books_by_build ON books (account, bookmark, profile, built_at)"),
+    # 11: userkeys are stored hashed
+    (_hash_plain_userkeys,),
+)
+
+
+# Closes a connection, unless it was opened before a fork: the parent
+# still uses it, and closing it here could checkpoint or remove the WAL
+# under the parent's feet
+def _close(connection: sqlite3.Connection, pid: int):
+    if pid != os.getpid():
+        return
+    try:
+        connection.close()
+    except sqlite3.Error:
+        pass
+
+
+# Owns one thread's connection. Only the thread's local storage refers
+# to it, so it goes away with the thread and the connection is closed.
+class _ThreadConnection:
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.pid = os.getpid()
+        self.close = weakref.finalize(self, _close, connection, self.pid)
+
 
 class BackendSQLite:
     # The database location
     database: str
 
     # Errors will be propagated to the object's creator
-    def __init__(self, database: str):
-        # Initialize the database and get a cursor
-        connection = sqlite3.connect(database)
-        cursor = connection.cursor()
-
-        # Create the users table if it doesn't exist
-        cursor.execute('''CREATE TABLE IF NOT EXISTS users
-                          (username text, userkey text)''')
-        # Create the documents table if it doesn't exist
-        cursor.execute('''CREATE TABLE IF NOT EXISTS documents
-                          (username text, document text, progress text,
-                           percentage float, device text, device_id text,
-                           timestamp int)''')
-
-        # Create the Bookmarks table if it doesn't exist
-        cursor.execute('''CREATE TABLE IF NOT EXISTS bookmarks
-                          (id int primary key, title text, url text, tags text)''')
-        # Commit and free the cursor and connection
-        cursor.close()
-        connection.commit()
-        connection.close()
-
+    def __init__(self, database: str, login_ttl: float = 300):
         # Save the database file location
         self.database = database
 
+        # Recently verified logins skip the database and the key hashing
+        self._logins = LoginCache(ttl=login_ttl)
+
+        # One long-lived connection per thread, see _connection()
+        self._local = threading.local()
+        self._connections = weakref.WeakSet()
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+        # WAL lets readers carry on while a worker writes
+        self._connection().execute("PRAGMA journal_mode = WAL")
+
+        with self._cursor("migrate") as cursor:
+            self._migrate(cursor)
+
+    # Brings the schema up to date in place.
+    # Runs in one IMMEDIATE transaction, so concurrently starting workers
+    # wait for each other and a failed step leaves the database untouched.
+    def _migrate(self, cursor):
+        cursor.execute("BEGIN IMMEDIATE")
+        version = cursor.execute("PRAGMA user_version").fetchone()[0]
+        for step, statements in enumerate(MIGRATIONS[version:], version + 1):
+            for statement in statements:
+                if callable(statement):
+                    statement(cursor)
+                else:
+                    cursor.execute(statement)
+            cursor.execute(f"PRAGMA user_version = {step}")
+
+    # Returns this thread's connection, opening it on first use.
+    # Connections are never shared across threads or forked processes,
+    # and are closed when their thread ends, so short-lived threads such
+    # as streamed EPUB builds don't leave connections behind.
+    def _connection(self) -> sqlite3.Connection:
+        holder = getattr(self._local, "holder", None)
+        if holder is not None and holder.pid == os.getpid():
+            return holder.connection
+        # The sqlite3 module keeps a per-connection cache of prepared
+        # statements, so reusing the connection reuses them too.
+        connection = sqlite3.connect(self.database, cached_statements=64,
+                                     check_same_thread=False)
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        holder = _ThreadConnection(connection)
+        self._local.holder = holder
+        with self._lock:
+            self._connections.add(holder)
+        return connection
+
+    # Runs the body in one transaction: commits on success, rolls back
+    # on error, and always frees the cursor. The time taken is recorded
+    # under `op`.
+    @contextmanager
+    def _cursor(self, op: str):
+        connection = self._connection()
+        cursor = connection.cursor()
+        start = time.perf_counter()
+        try:
+            yield cursor
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        finally:
+            cursor.close()
+            metrics.observe("wbip_sqlite_seconds", time.perf_counter() - start,
+                            "sqlite", op=op)
+
+    # Closes every connection opened by this process
+    def close(self):
+        with self._lock:
+            holders = list(self._connections)
+        for holder in holders:
+            holder.close()
+
     # Adds a username/userkey combination.
     # Returns False if the user already exists.
     def create_user(self, username: str, userkey: str):
-        connection = sqlite3.connect(self.database)
-        cursor = connection.cursor()
+        with self._cursor("create_user") as cursor:
+            # Let's add the user, unless it already exists
+            cursor.execute('''INSERT INTO users VALUES (?, ?)
+                              ON CONFLICT (username) DO NOTHING''',
+                           (username, hash_userkey(userkey)))
+            created = cursor.rowcount == 1
+        self._logins.forget(username)
+        return created
 
-        cursor.execute("SELECT * FROM users WHERE username = ?", (username,))
-        if cursor.fetchone():
-            # Attempted to add a user that already exists
-            return False
+    # Create or update a bookmark
+    def update_bookmark(self, mark: Bookmark):
+        self.update_bookmarks((mark,))
 
-        # Let's add the user:
-        cursor.execute("INSERT INTO users VALUES (?, ?)", (username, userkey))
+    # Create or update many bookmarks in one transaction.
+    # Rows whose title, url and tags are unchanged are left alone.
+    def update_bookmarks(self, marks):
+        with self._cursor("update_bookmarks") as cursor:
+            cursor.executemany('''INSERT INTO bookmarks VALUES (?, ?, ?, ?)
+                                  ON CONFLICT (id) DO UPDATE
+                                  SET title = excluded.title, url = excluded.url,
+                                      tags = excluded.tags
+                                  WHERE title IS NOT excluded.title
+                                     OR url IS NOT excluded.url
+                                     OR tags IS NOT excluded.tags''',
+                               ((mark.id, mark.title, mark.url, mark.tags)
+                                for mark in marks))
 
-        # Cleanup
-        cursor.close()
-        connection.commit()
-        connection.close()
+    # Returns {bookmark id: hash} of an account's stored listing
+    def get_entry_hashes(self, account: str) -> dict:
+        with self._cursor("get_entry_hashes") as cursor:
+            cursor.execute("SELECT id, hash FROM entries WHERE account = ?",
+                           (account,))
+            return dict(cursor.fetchall())
+
+    # Merges new and changed entries into an account's listing and drops
+    # the deleted ids. With `replace`, entries not given are dropped too.
+    def merge_entries(self, account: str, entries, deleted=(), replace=False):
+        entries = list(entries)
+        with self._cursor("merge_entries") as cursor:
+            if replace:
+                cursor.execute("DELETE FROM entries WHERE account = ?", (account,))
+            cursor.executemany("DELETE FROM entries WHERE account = ? AND id = ?",
+                               ((account, id) for id in deleted))
+            cursor.executemany('''INSERT INTO entries VALUES (?, ?, ?, ?, ?)
+                                  ON CONFLICT (account, id) DO UPDATE
+                                  SET hash = excluded.hash, time = excluded.time,
+                                      entry = excluded.entry''',
+                               ((account, e.id, e.hash, e.time, e.entry)
+                                for e in entries))
 
+    # Returns (total, entries) for one page of an account's listing,
+    # newest first.
+    def get_entries(self, account: str, offset: int, limit: int) -> tuple:
+        with self._cursor("get_entries") as cursor:
+            cursor.execute("SELECT count(*) FROM entries WHERE account = ?",
+                           (account,))
+            total = cursor.fetchone()[0]
+            cursor.execute('''SELECT id, hash, time, entry FROM entries
+                              WHERE account = ?
+                              ORDER BY time DESC, id DESC
+                              LIMIT ? OFFSET ?''',
+                           (account, limit, offset))
+            return total, [Entry(*row) for row in cursor.fetchall()]
+
+    # Returns the cached Postlight result for a url, or None
+    def get_enrichment(self, url: str) -> Enrichment:
+        with self._cursor("get_enrichment") as cursor:
+            cursor.execute("SELECT * FROM enrichments WHERE url = ?", (url,))
+            row = cursor.fetchone()
+        if not row:
+            return None
+        return Enrichment(row[0], row[1], bool(row[2]), row[3])
+
+    def put_enrichment(self, enrichment: Enrichment):
+        with self._cursor("put_enrichment") as cursor:
+            cursor.execute('''INSERT INTO enrichments VALUES (?, ?, ?, ?)
+                              ON CONFLICT (url) DO UPDATE
+                              SET data = excluded.data, ok = excluded.ok,
+                                  fetched_at = excluded.fetched_at''',
+                           (enrichment.url, enrichment.data, int(enrichment.ok),
+                            enrichment.fetched_at))
+
+    # Adds a call to the outbox, due right away. With `replace`, pending
+    # calls to the same path for the same bookmark are dropped first, and
+    # the new call takes over the attempts and retry time of a failing
+    # one, so replacing it doesn't skip its backoff. With `unless`, nothing
+    # happens if the bookmark has a pending call to that path. Returns
+    # whether the call was added.
+    def enqueue_operation(self, op: Operation, replace=False, unless=None) -> bool:
+        attempts, next_attempt = 0, op.created_at
+        with self._cursor("enqueue_operation") as cursor:
+            if unless is not None:
+                cursor.execute('''SELECT 1 FROM outbox
+                                  WHERE account = ? AND bookmark = ? AND path = ?''',
+                               (op.account, op.bookmark, unless))
+                if cursor.fetchone():
+                    return False
+            if replace:
+                cursor.execute('''DELETE FROM outbox
+                                  WHERE account = ? AND bookmark = ? AND path = ?
+                                  RETURNING attempts, next_attempt''',
+                               (op.account, op.bookmark, op.path))
+                for row in cursor.fetchall():
+                    if row[0]:
+                        attempts = max(attempts, row[0])
+                        next_attempt = max(next_attempt, row[1])
+            cursor.execute('''INSERT INTO outbox (account, secret, bookmark, path,
+                                                 parameters, created_at, attempts,
+                                                 next_attempt)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                           (op.account, op.secret, op.bookmark, op.path,
+                            op.parameters, op.created_at, attempts, next_attempt))
         return True
 
-    # Create or update a bookmark
-    def update_bookmark(self, mark: Bookmark):
-        connection = sqlite3.connect(self.database)
-        cursor = connection.cursor()
+    # Claims up to `limit` calls due by `now`, oldest first, by pushing
+    # their next attempt out to `lease_until`. Calls for a bookmark go out
+    # in order, so one waiting behind an earlier call for the same
+    # bookmark that isn't due (or is claimed) isn't claimed either.
+    def claim_operations(self, now: float, lease_until: float, limit: int) -> list:
+        with self._cursor("claim_operations") as cursor:
+            cursor.execute('''UPDATE outbox SET next_attempt = ?
+                              WHERE id IN (SELECT id FROM outbox AS op
+                                           WHERE next_attempt <= ?
+                                           AND NOT EXISTS (
+                                               SELECT 1 FROM outbox AS earlier
+                                               WHERE earlier.account = op.account
+                                               AND earlier.bookmark = op.bookmark
+                                               AND earlier.id < op.id
+                                               AND earlier.next_attempt > ?)
+                                           ORDER BY id LIMIT ?)
+                              RETURNING id, account, secret, bookmark, path,
+                                        parameters, created_at, attempts''',
+                           (lease_until, now, now, limit))
+            ops = [Operation(*row) for row in cursor.fetchall()]
+        return sorted(ops, key=lambda op: op.id)
 
-        print(vars(mark))
-        cursor.execute("SELECT * FROM bookmarks where id = ?", (mark.id,))
-        if cursor.fetchone():
-            cursor.execute('''UPDATE bookmarks
-                              SET title = ?, url = ?, tags = ?
-                              WHERE id = ?''',
-                           (mark.title, mark.url, mark.tags, mark.id))
-        else:
-            cursor.execute("INSERT INTO bookmarks VALUES (?, ?, ?, ?)",
-                           (mark.id, mark.title, mark.url, mark.tags))
-        # Cleanup
-        cursor.close()
-        connection.commit()
-        connection.close()
+    # Drops the `done` ids, reschedules `retries`, a list of
+    # (id, next attempt, error) tuples, and makes the `released` ids due
+    # again without counting an attempt, in one transaction
+    def finish_operations(self, done, retries, released=()):
+        now = time.time()
+        with self._cursor("finish_operations") as cursor:
+            cursor.executemany("UPDATE outbox SET next_attempt = ? WHERE id = ?",
+                               ((now, id) for id in released))
+            cursor.executemany("DELETE FROM outbox WHERE id = ?",
+                               ((id,) for id in done))
+            cursor.executemany('''UPDATE outbox
+                                  SET attempts = attempts + 1,
+                                      next_attempt = ?, error = ?
+                                  WHERE id = ?''',
+                               ((next_attempt, error, id)
+                                for id, next_attempt, error in retries))
 
-# class Bookmark:
-#    id: int
-#    title: str
-#    url: str
+    # Returns the ids of an account's bookmarks with a pending call to path
+    def get_pending_bookmarks(self, account: str, path: str) -> set:
+        with self._cursor("get_pending_bookmarks") as cursor:
+            cursor.execute('''SELECT DISTINCT bookmark FROM outbox
+                              WHERE account = ? AND path = ?''',
+                           (account, path))
+            return {row[0] for row in cursor.fetchall()}
 
-    # Updates a document, creating if it does not exist.
+    # Returns (pending, retrying, created_at of the oldest) for the outbox
+    def get_outbox_stats(self) -> tuple:
+        with self._cursor("get_outbox_stats") as cursor:
+            cursor.execute('''SELECT count(*), ifnull(sum(attempts > 0), 0),
+                                     min(created_at)
+                              FROM outbox''')
+            return cursor.fetchone()
+
+    # Remembers the document hashes of books. Of the builds of a bookmark
+    # for one account and image profile, only the latest `keep` are
+    # kept; devices may still hold any of those.
+    def put_books(self, books, keep: int = 3):
+        books = list(books)
+        with self._cursor("put_books") as cursor:
+            cursor.executemany("INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?)",
+                               ((book.document, book.bookmark, book.account,
+                                 book.profile, book.built_at)
+                                for book in books))
+            cursor.executemany('''DELETE FROM books
+                                  WHERE account = ? AND bookmark = ? AND profile = ?
+                                  AND built_at NOT IN (
+                                      SELECT DISTINCT built_at FROM books
+                                      WHERE account = ? AND bookmark = ? AND profile = ?
+                                      ORDER BY built_at DESC LIMIT ?)''',
+                               {(book.account, book.bookmark, book.profile) * 2 + (keep,)
+                                for book in books})
+
+    # Returns the book KOReader knows as `document`, or None
+    def get_book(self, document: str) -> Book:
+        with self._cursor("get_book") as cursor:
+            cursor.execute("SELECT * FROM books WHERE document = ?", (document,))
+            row = cursor.fetchone()
+        return Book(*row) if row else None
+
+    # Links a progress sync user to an account, keeping the account's
+    # oauth token to send the user's progress with
+    def link_sync_user(self, username: str, account: str, secret: str):
+        with self._cursor("link_sync_user") as cursor:
+            cursor.execute("INSERT OR REPLACE INTO sync_links VALUES (?, ?, ?)",
+                           (username, account, secret))
+
+    def unlink_sync_user(self, username: str, account: str):
+        with self._cursor("unlink_sync_user") as cursor:
+            cursor.execute("DELETE FROM sync_links WHERE username = ? AND account = ?",
+                           (username, account))
+
+    # Returns the token secret linking a sync user to an account, or None
+    # if they aren't linked
+    def get_sync_secret(self, username: str, account: str) -> str:
+        with self._cursor("get_sync_secret") as cursor:
+            cursor.execute('''SELECT secret FROM sync_links
+                              WHERE username = ? AND account = ?''',
+                           (username, account))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    # Returns the sync users linked to an account
+    def get_sync_users(self, account: str) -> list:
+        with self._cursor("get_sync_users") as cursor:
+            cursor.execute('''SELECT username FROM sync_links WHERE account = ?
+                              ORDER BY username''', (account,))
+            return [row[0] for row in cursor.fetchall()]
+
+    # Replaces the token secret kept with an account's links
+    def update_sync_links(self, account: str, secret: str):
+        with self._cursor("update_sync_links") as cursor:
+            cursor.execute("UPDATE sync_links SET secret = ? WHERE account = ?",
+                           (secret, account))
+
+    # Returns the image profile an account chose, or None
+    def get_profile(self, account: str) -> str:
+        with self._cursor("get_profile") as cursor:
+            cursor.execute("SELECT profile FROM profiles WHERE account = ?",
+                           (account,))
+            row = cursor.fetchone()
+        return row[0] if row else None
 
+    # Saves an account's image profile, None forgets it
+    def set_profile(self, account: str, profile: str):
+        with self._cursor("set_profile") as cursor:
+            if profile is None:
+                cursor.execute("DELETE FROM profiles WHERE account = ?",
+                               (account,))
+            else:
+                cursor.execute('''INSERT INTO profiles VALUES (?, ?)
+                                  ON CONFLICT (account) DO UPDATE
+                                  SET profile = excluded.profile''',
+                               (account, profile))
+
+    # Updates a document, creating if it does not exist.
     def update_document(self, username: str, document: Document):
-        connection = sqlite3.connect(self.database)
-        cursor = connection.cursor()
+        self.update_documents(((username, document),))
 
-        # If the document doesn't exist, let's create it.
-        cursor.execute("SELECT * FROM documents WHERE username = ? AND document = ?",
-                       (username, document.document))
-        if not cursor.fetchone():
-            cursor.execute("INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)",
-                           (username, document.document, document.progress, document.percentage,
-                            document.device, document.device_id, document.timestamp))
-
-        # If the document _does_ exist, update it.
-        cursor.execute('''UPDATE documents
-                          SET progress = ?, percentage = ?, device = ?, device_id = ?, timestamp = ?
-                          WHERE username = ? AND document = ?''',
-                       (document.progress, document.percentage, document.device, document.device_id,
-                        document.timestamp, username, document.document))
-
-        # Cleanup
-        cursor.close()
-        connection.commit()
-        connection.close()
+    # Updates many (username, document) pairs in one transaction
+    def update_documents(self, updates):
+        with self._cursor("update_documents") as cursor:
+            cursor.executemany('''INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)
+                                  ON CONFLICT (username, document) DO UPDATE
+                                  SET progress = excluded.progress,
+                                      percentage = excluded.percentage,
+                                      device = excluded.device,
+                                      device_id = excluded.device_id,
+                                      timestamp = excluded.timestamp''',
+                               ((username, document.document, document.progress, document.percentage,
+                                 document.device, document.device_id, document.timestamp)
+                                for username, document in updates))
 
     # Checks if a login is valid.
     # Returns True if it is, False if not.
     def check_login(self, username: str, userkey: str) -> bool:
-        connection = sqlite3.connect(self.database)
-        cursor = connection.cursor()
-
-        # Check if the username/userkey combo exists.
-        cursor.execute(
-            "SELECT * FROM users WHERE username = ? AND userkey = ?", (username, userkey))
-        exists = bool(cursor.fetchone())
+        if not username or not userkey:
+            return False
+        if self._logins.hit(username, userkey):
+            return True
 
-        # Cleanup
-        cursor.close()
-        connection.commit()
-        connection.close()
+        with self._cursor("check_login") as cursor:
+            # Check if the username/userkey combo exists.
+            cursor.execute(
+                "SELECT userkey FROM users WHERE username = ?", (username,))
+            row = cursor.fetchone()
+        exists = bool(row) and verify_userkey(userkey, row[0])
+        if exists:
+            self._logins.add(username, userkey)
 
         # Return our result
         return exists
 
     def get_bookmark(self, mark_id: int) -> Bookmark:
-        connection = sqlite3.connect(self.database)
-        cursor = connection.cursor()
-        cursor.execute("SELECT * from bookmarks WHERE id = ?", (mark_id,))
-        row = cursor.fetchone()
+        with self._cursor("get_bookmark") as cursor:
+            cursor.execute("SELECT * from bookmarks WHERE id = ?", (mark_id,))
+            row = cursor.fetchone()
         if not row:
             return None
-        mark = Bookmark(row[0], row[1], row[2], row[3])
-        # Cleanup
-        cursor.close()
-        connection.commit()
-        connection.close()
-        return mark
+        return Bookmark(row[0], row[1], row[2], row[3])
 
     # Gets the details of a document present in the database.
     # Returns None if it doesn't exist.
     def get_document(self, username: str, document: str) -> Document:
-        connection = sqlite3.connect(self.database)
-        cursor = connection.cursor()
-
-        # Get the relevant row in the table
-        cursor.execute(
-            "SELECT * FROM documents WHERE username = ? AND document = ?", (username, document))
-        row = cursor.fetchone()
+        with self._cursor("get_document") as cursor:
+            # Get the relevant row in the table
+            cursor.execute(
+                "SELECT * FROM documents WHERE username = ? AND document = ?", (username, document))
+            row = cursor.fetchone()
         if not row:
             # Document isn't present in the database
             return None
 
         # Create a document instance from it
-        resultdoc = Document(row[1], row[2], row[3], row[4], row[5], row[6])
-
-        # Cleanup
-        cursor.close()
-        connection.commit()
-        connection.close()
-
-        return resultdoc
+        return Document(row[1], row[2], row[3], row[4], row[5], row[6])
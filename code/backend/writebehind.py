@@ -0,0 +1,50 @@
+import flusher
+from backend.common import Document
+
+# Write-behind wrapper around a storage backend.
+# KOReader sends a progress update on nearly every page turn. Updates are
+# kept in memory per (username, document), the last one winning, and a
+# background thread writes them in one batch every `interval` seconds or
+# once `max_pending` documents are waiting. Everything else is passed
+# straight through to the wrapped backend.
+#
+# Each worker process buffers on its own, so a GET answered by another
+# worker can lag behind by up to `interval` seconds.
+
+
+class WriteBehindBackend:
+    # Seconds between flushes
+    interval: float
+    # Flush early once this many documents are buffered
+    max_pending: int
+
+    def __init__(self, backend, interval: float = 2.0, max_pending: int = 100):
+        self.backend = backend
+        self.interval = interval
+        self.max_pending = max_pending
+        self._flusher = flusher.Flusher("write-behind", self._write,
+                                        interval, max_pending)
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def update_document(self, username: str, document: Document):
+        self._flusher.put((username, document.document), document)
+
+    # Buffered updates are returned before they reach the database
+    def get_document(self, username: str, document: str) -> Document:
+        pending = self._flusher.get((username, document))
+        if pending is not None:
+            return pending
+        return self.backend.get_document(username, document)
+
+    def _write(self, batch: dict):
+        self.backend.update_documents(
+            (username, document) for (username, _), document in batch.items())
+
+    # Writes everything buffered so far
+    def flush(self):
+        self._flusher.flush()
+
+    def close(self):
+        self._flusher.close()
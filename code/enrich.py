@@ -0,0 +1,133 @@
+import json
+import logging
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from backend.common import Enrichment
+
+# Cached Postlight enrichment of article metadata.
+# Postlight results (author, domain, ...) are kept per url in the storage
+# backend for `ttl` seconds; pages Postlight can't parse are remembered
+# for `negative_ttl` so a broken page isn't re-parsed on every build.
+# Postlight itself failing (unreachable, a 5xx or an answer that isn't
+# JSON) is not cached against the page; after `max_failures` such
+# failures in a row the breaker opens and Postlight is skipped for
+# `cooldown` seconds. Concurrent lookups of one url wait for a single
+# request. Callers always get a dict, empty when there's nothing.
+
+logger = logging.getLogger(__name__)
+
+# Postlight fields we don't want in the metadata
+DROPPED_KEYS = ('content', 'title', 'dek', 'next_page_url', 'url', 'message')
+
+
+class Enricher:
+    url: str
+    # Seconds before a cached result is fetched again
+    ttl: float
+    # Seconds before a failed url is tried again
+    negative_ttl: float
+    # Seconds to wait on Postlight
+    timeout: float
+
+    def __init__(self, backend, url: str = "http://postlight:3000/parse-html",
+                 ttl: float = 30 * 24 * 3600, negative_ttl: float = 3600,
+                 timeout: float = 10.0, max_failures: int = 3,
+                 cooldown: float = 60.0, max_concurrency: int = 4):
+        self.backend = backend
+        self.url = url
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+        self.session = requests.Session()
+        self.session.mount(url, HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=max_concurrency))
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._failures = 0
+        self._open_until = 0.0
+
+    # Returns the metadata for an article url
+    def enrich(self, article_url: str) -> dict:
+        cached = self.backend.get_enrichment(article_url)
+        if cached and time.time() - cached.fetched_at < (
+                self.ttl if cached.ok else self.negative_ttl):
+            metrics.inc("wbip_cache_total", cache="postlight", result="hit")
+            return json.loads(cached.data) if cached.ok else {}
+        metrics.inc("wbip_cache_total", cache="postlight", result="miss")
+
+        # Single flight: the first caller fetches, the others wait for it
+        with self._lock:
+            waiter = self._inflight.get(article_url)
+            if waiter is None:
+                self._inflight[article_url] = done = threading.Event()
+        if waiter is not None:
+            waiter.wait(self.timeout)
+            cached = self.backend.get_enrichment(article_url)
+            return json.loads(cached.data) if cached and cached.ok else {}
+
+        try:
+            return self._fetch(article_url)
+        finally:
+            with self._lock:
+                del self._inflight[article_url]
+            done.set()
+
+    def _fetch(self, article_url: str) -> dict:
+        if time.monotonic() < self._open_until:
+            logger.info(f"Postlight breaker open, not enriching {article_url}")
+            return {}
+        try:
+            with self._slots, metrics.timer("wbip_upstream_seconds", "postlight",
+                                            service="postlight", path="/parse-html"):
+                response = self.session.post(self.url, json={'url': article_url},
+                                             timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            metrics.inc("wbip_upstream_requests_total", service="postlight",
+                        status="error")
+            logger.warning(f"couldn't reach postlight for {article_url}: {e}")
+            self._failed()
+            return {}
+        metrics.inc("wbip_upstream_requests_total", service="postlight",
+                    status=str(response.status_code))
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        if response.status_code >= 500 or data is None:
+            logger.warning(f"postlight failed on {article_url}: "
+                           f"status {response.status_code}")
+            self._failed()
+            return {}
+        with self._lock:
+            self._failures = 0
+
+        # Postlight answered, so any problem is with the page itself
+        if not response.ok or not isinstance(data, dict) or data.get('error'):
+            logger.warning(f"couldn't enrich {article_url} with postlight: "
+                           f"no usable result (status {response.status_code})")
+            self.backend.put_enrichment(
+                Enrichment(article_url, "{}", False, int(time.time())))
+            return {}
+
+        for k in DROPPED_KEYS:
+            data.pop(k, None)
+        self.backend.put_enrichment(
+            Enrichment(article_url, json.dumps(data), True, int(time.time())))
+        return data
+
+    def _failed(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.max_failures:
+                self._open_until = time.monotonic() + self.cooldown
+                self._failures = 0
+                logger.warning(f"Postlight failing, skipping it for {self.cooldown}s")
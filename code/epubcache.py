@@ -0,0 +1,271 @@
+import contextvars
+import fcntl
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from backend.common import Bookmark
+
+# On-disk cache of built EPUBs.
+# Files are named `<id>-<profile>-<version>.epub`, where the version
+# hashes the bookmark metadata that ends up in the book and the image
+# profile's settings, so a renamed or retagged bookmark gets a fresh
+# build. Each image profile keeps its own copy, so devices on different
+# profiles don't replace each other's books. Builds are written to a
+# temporary file and renamed into place, and a file lock per id and
+# profile makes sure only one worker (or thread) builds a book at a time.
+# Lock files only exist while a book is being built.
+# A file's mtime is when it was built, which makes it part of its ETag;
+# use is tracked in its atime for eviction.
+#
+# A build can also be streamed: the client is sent each part of the file
+# as soon as the builder reports it final, while the same file goes into
+# the cache.
+
+logger = logging.getLogger(__name__)
+
+# Bump whenever the EPUB layout changes so old builds are not served
+BUILD_VERSION = 3
+
+
+# Returns the cache version for a bookmark's current metadata, built
+# with the given image settings
+def version(mark: Bookmark, images: str = "") -> str:
+    ident = f"{BUILD_VERSION}\n{mark.title}\n{mark.url}\n{mark.tags}\n{images}"
+    return hashlib.sha256(ident.encode()).hexdigest()[:16]
+
+
+# Returns a strong validator for the cached EPUB at `path`: the same
+# bytes always have the same one, and a rebuild gets a new one
+def etag(path: str, version: str) -> str:
+    st = os.stat(path)
+    return f"{version}-{st.st_mtime_ns:x}-{st.st_size:x}"
+
+
+class EpubCache:
+    # The directory holding the cached EPUBs
+    directory: str
+    # Evict least recently used EPUBs beyond this many bytes
+    max_bytes: int
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, id: int, profile: str, version: str) -> str:
+        return os.path.join(self.directory, f"{id}-{profile}-{version}.epub")
+
+    # Returns the path of a cached EPUB, or None on a miss.
+    def lookup(self, id: int, profile: str, version: str) -> str:
+        path = self.path(id, profile, version)
+        try:
+            # Bump the atime so eviction sees it as recently used
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        except OSError:
+            return None
+        return path
+
+    # Whether an EPUB is cached, without counting this as a use of it
+    def contains(self, id: int, profile: str, version: str) -> bool:
+        return os.path.exists(self.path(id, profile, version))
+
+    # Returns the path of the EPUB for this id, profile and version,
+    # calling `builder(path)` to write it if it isn't cached yet.
+    # Concurrent calls for the same book wait for the first build instead
+    # of repeating it. On a miss, the context manager returned by `admit()`
+    # is entered before the book's lock is taken, so whatever it waits for
+    # it doesn't wait for with the lock held. Exceptions from the builder
+    # and from `admit` are propagated.
+    def get_or_build(self, id: int, profile: str, version: str, builder,
+                     admit=nullcontext) -> str:
+        path = self.lookup(id, profile, version)
+        if path:
+            return path
+
+        with admit(), self._locked(id, profile):
+            # Someone else may have built it while we waited
+            path = self.lookup(id, profile, version)
+            if path:
+                return path
+
+            fd, tmp = tempfile.mkstemp(
+                dir=self.directory, prefix=f"{id}-", suffix=".tmp")
+            os.close(fd)
+            try:
+                builder(tmp)
+                path = self.path(id, profile, version)
+                os.replace(tmp, path)
+            finally:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+            self._drop_stale(id, profile, version)
+
+        self._evict()
+        return path
+
+    # Holds the build lock of a book. The holder removes the lock file
+    # when done, so lock files don't pile up; a lock taken on a file that
+    # is no longer in the directory doesn't count and is taken again.
+    @contextmanager
+    def _locked(self, id: int, profile: str):
+        path = os.path.join(self.directory, f"{id}-{profile}.lock")
+        while True:
+            # The directory may have been cleaned out from under us
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    try:
+                        current = os.stat(path).st_ino == os.fstat(lock.fileno()).st_ino
+                    except FileNotFoundError:
+                        current = False
+                    if current:
+                        try:
+                            yield
+                        finally:
+                            try:
+                                os.unlink(path)
+                            except OSError:
+                                pass
+                        return
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    # Like get_or_build, but returns an iterator over the EPUB's bytes that
+    # starts yielding while the build is still running on a background
+    # thread. `builder(path, commit)` must call `commit(offset)` whenever
+    # the first `offset` bytes of the file are final. Builder exceptions
+    # are raised from the iterator.
+    def stream_or_build(self, id: int, profile: str, version: str, builder,
+                        admit=nullcontext):
+        stream = _Stream()
+
+        def build(path):
+            stream.start(path)
+            builder(path, stream.commit)
+
+        def run():
+            try:
+                stream.finish(self.get_or_build(id, profile, version, build, admit))
+            except Exception as e:
+                stream.fail(e)
+
+        # The build runs in the caller's context so its timings are
+        # traced with the request
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run,), name=f"epub-{id}",
+                         daemon=True).start()
+        return stream.chunks()
+
+    # Remove older versions of an id built for the same profile. Versions
+    # have no "-", so this leaves profiles whose name extends this one's
+    # alone.
+    def _drop_stale(self, id: int, profile: str, version: str):
+        keep = os.path.basename(self.path(id, profile, version))
+        prefix = f"{id}-{profile}-"
+        for filename in os.listdir(self.directory):
+            if (filename.startswith(prefix) and filename.endswith(".epub")
+                    and "-" not in filename[len(prefix):]
+                    and filename != keep):
+                try:
+                    os.unlink(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".epub"):
+                continue
+            path = os.path.join(self.directory, filename)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_atime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            logger.info(f"Evicting {path} from epub cache")
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+
+# Hands the bytes of a file being built to a reader on another thread.
+# The reader keeps its own file descriptor, so the build's final rename
+# doesn't disturb it.
+class _Stream:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._reader = None
+        self._committed = 0
+        self._done = False
+        self._error = None
+        self._closed = False
+
+    def start(self, path: str):
+        with self._cond:
+            if self._closed:
+                return
+            self._reader = open(path, "rb")
+            self._cond.notify_all()
+
+    def commit(self, offset: int):
+        with self._cond:
+            self._committed = offset
+            self._cond.notify_all()
+
+    # The build finished (or was already cached) at `path`
+    def finish(self, path: str):
+        with self._cond:
+            if self._closed:
+                return
+            if self._reader is None:
+                self._reader = open(path, "rb")
+            self._committed = os.fstat(self._reader.fileno()).st_size
+            self._done = True
+            self._cond.notify_all()
+
+    def fail(self, error: Exception):
+        with self._cond:
+            self._error = error
+            self._done = True
+            self._cond.notify_all()
+
+    def chunks(self, size: int = 64 * 1024):
+        sent = 0
+        try:
+            while True:
+                with self._cond:
+                    while (self._error is None and not self._done
+                           and (self._reader is None or sent >= self._committed)):
+                        self._cond.wait()
+                    if self._error is not None:
+                        raise self._error
+                    available = self._committed - sent
+                    done = self._done
+                while available > 0:
+                    data = self._reader.read(min(size, available))
+                    if not data:
+                        break
+                    sent += len(data)
+                    available -= len(data)
+                    yield data
+                if done and sent >= self._committed:
+                    return
+        finally:
+            with self._cond:
+                self._closed = True
+                if self._reader is not None:
+                    self._reader.close()
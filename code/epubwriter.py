@@ -0,0 +1,172 @@
+import time
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+# Minimal streaming EPUB 3 writer.
+# Every part is written into the zip container as soon as it is added, so
+# images never pile up in memory, and `on_entry(offset)` is told after
+# each part how many leading bytes of the file are final. The package
+# document, nav and NCX only need the manifest and go in last.
+# lxml is imported when the first chapter is written.
+
+XHTML_NS = "http://www.w3.org/1999/xhtml"
+
+CONTAINER = """<?xml version="1.0" encoding="UTF-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="EPUB/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+OPF = """<?xml version='1.0' encoding='utf-8'?>
+<package xmlns="http://www.idpf.org/2007/opf" unique-identifier="id" version="3.0">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <meta property="dcterms:modified">{modified}</meta>
+    <dc:identifier id="id">{identifier}</dc:identifier>
+    <dc:title>{title}</dc:title>
+    <dc:language>{language}</dc:language>
+    <dc:creator id="creator">{author}</dc:creator>
+  </metadata>
+  <manifest>
+{manifest}
+  </manifest>
+  <spine toc="ncx">
+{spine}
+  </spine>
+</package>
+"""
+
+NAV = """<?xml version='1.0' encoding='utf-8'?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="{language}" xml:lang="{language}">
+  <head>
+    <title>{title}</title>
+  </head>
+  <body>
+    <nav epub:type="toc" id="toc" role="doc-toc">
+      <h2>{title}</h2>
+      <ol>
+{points}
+      </ol>
+    </nav>
+  </body>
+</html>
+"""
+
+NCX = """<?xml version='1.0' encoding='utf-8'?>
+<ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">
+  <head>
+    <meta content={identifier} name="dtb:uid"/>
+    <meta content="1" name="dtb:depth"/>
+    <meta content="0" name="dtb:totalPageCount"/>
+    <meta content="0" name="dtb:maxPageNumber"/>
+  </head>
+  <docTitle>
+    <text>{title}</text>
+  </docTitle>
+  <navMap>
+{points}
+  </navMap>
+</ncx>
+"""
+
+
+# Turns an HTML body fragment, or an already parsed <body> element, into
+# a complete XHTML document
+def xhtml_document(title: str, body, stylesheets=(), language="en") -> bytes:
+    from lxml import etree
+    from lxml import html as lxml_html
+    root = etree.Element(f"{{{XHTML_NS}}}html", nsmap={None: XHTML_NS})
+    root.set("lang", language)
+    root.set("{http://www.w3.org/XML/1998/namespace}lang", language)
+    head = etree.SubElement(root, "head")
+    etree.SubElement(head, "title").text = title
+    for href in stylesheets:
+        etree.SubElement(head, "link", rel="stylesheet", href=href,
+                         type="text/css")
+    body_el = etree.SubElement(root, "body")
+    if isinstance(body, str):
+        body = lxml_html.document_fromstring(
+            f"<html><body>{body}</body></html>").find("body")
+    body_el.text = body.text
+    for child in list(body):
+        body_el.append(child)
+    return etree.tostring(root, encoding="utf-8", xml_declaration=True,
+                          doctype="<!DOCTYPE html>")
+
+
+class EpubWriter:
+    def __init__(self, fileobj, identifier: str, title: str, author: str,
+                 language: str = "en", on_entry=None):
+        self.identifier = identifier
+        self.title = title
+        self.author = author
+        self.language = language
+        self.on_entry = on_entry
+
+        self._fileobj = fileobj
+        self._zip = zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED)
+        self._manifest = []
+        self._spine = []
+
+        # The mimetype must come first and uncompressed
+        self._write("mimetype", b"application/epub+zip", zipfile.ZIP_STORED)
+        self._write("META-INF/container.xml", CONTAINER.encode())
+
+    def _write(self, name: str, data: bytes, compress_type=zipfile.ZIP_DEFLATED):
+        info = zipfile.ZipInfo(name, time.localtime()[:6])
+        info.compress_type = compress_type
+        self._zip.writestr(info, data)
+        self._fileobj.flush()
+        if self.on_entry:
+            self.on_entry(self._fileobj.tell())
+
+    def add_item(self, uid: str, href: str, media_type: str, data: bytes):
+        self._write(f"EPUB/{href}", data)
+        self._manifest.append((uid, href, media_type, None))
+
+    # Images are already compressed, deflating them again only costs CPU
+    def add_image(self, uid: str, href: str, media_type: str, data: bytes):
+        self._write(f"EPUB/{href}", data, zipfile.ZIP_STORED)
+        self._manifest.append((uid, href, media_type, None))
+
+    def add_chapter(self, uid: str, href: str, title: str, body,
+                    stylesheets=()):
+        self.add_item(uid, href, "application/xhtml+xml",
+                      xhtml_document(title, body, stylesheets, self.language))
+        self._spine.append((uid, href, title))
+
+    # Writes the package document and navigation, then the zip directory
+    def close(self):
+        title = escape(self.title)
+        self._manifest.append(("nav", "nav.xhtml", "application/xhtml+xml", "nav"))
+        self._manifest.append(("ncx", "toc.ncx", "application/x-dtbncx+xml", None))
+        manifest = "\n".join(
+            f'    <item href={quoteattr(href)} id={quoteattr(uid)} media-type="{media_type}"'
+            + (f' properties="{properties}"' if properties else "") + "/>"
+            for uid, href, media_type, properties in self._manifest)
+        spine = "\n".join(f'    <itemref idref={quoteattr(uid)}/>'
+                          for uid, _, _ in self._spine)
+        self._write("EPUB/content.opf", OPF.format(
+            modified=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            identifier=escape(self.identifier), title=title,
+            language=self.language, author=escape(self.author),
+            manifest=manifest, spine=spine).encode())
+
+        self._write("EPUB/nav.xhtml", NAV.format(
+            title=title, language=self.language,
+            points="\n".join(
+                f'        <li><a href={quoteattr(href)}>{escape(label)}</a></li>'
+                for _, href, label in self._spine)).encode())
+        self._write("EPUB/toc.ncx", NCX.format(
+            identifier=quoteattr(self.identifier), title=title,
+            points="\n".join(
+                f'    <navPoint id="np{n}"><navLabel><text>{escape(label)}</text></navLabel>'
+                f'<content src={quoteattr(href)}/></navPoint>'
+                for n, (_, href, label) in enumerate(self._spine, 1))).encode())
+
+        self._zip.close()
+        self._fileobj.flush()
+        if self.on_entry:
+            self.on_entry(self._fileobj.tell())
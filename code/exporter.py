@@ -0,0 +1,149 @@
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Bulk EPUB export.
+# Many books go out as one ZIP streamed while it is written: the books
+# are built (or taken from the EPUB cache) on a pool shared by every
+# export of the worker, a few ahead of the one being sent, and stored in
+# the archive in the order given. EPUBs are already compressed, so they
+# are stored as is. A `manifest.json` member closes the archive with
+# what was exported, what failed and where to resume.
+#
+# Each running export's progress is kept for /exports/status, for the
+# worker that serves it.
+
+logger = logging.getLogger(__name__)
+
+# Bytes read from a built EPUB per chunk sent
+CHUNK_SIZE = 64 * 1024
+
+# Finished exports kept for status
+MAX_FINISHED = 20
+
+
+# Collects what the ZIP writer produces until the stream picks it up.
+# Having no tell() or seek() makes zipfile write a streamable archive.
+class _Sink:
+    def __init__(self):
+        self._parts = []
+        self.sent = 0
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def __len__(self):
+        return sum(map(len, self._parts))
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        self.sent += len(data)
+        return data
+
+
+def _close_book(future):
+    if not future.exception():
+        future.result().close()
+
+
+class Exporter:
+    # Books built at the same time across all exports
+    workers: int
+    # Books of one export built ahead of the one being sent
+    lookahead: int
+
+    def __init__(self, workers: int = 4, lookahead: int = 4):
+        self.workers = workers
+        self.lookahead = lookahead
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="export")
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._running = {}
+        self._finished = deque(maxlen=MAX_FINISHED)
+
+    # Returns an export id and an iterator over the ZIP of `books`, a list
+    # of (id, filename). `open_book(id)` runs on the pool and returns the
+    # built EPUB opened for reading, or raises.
+    def stream(self, books: list, open_book) -> tuple:
+        with self._lock:
+            export_id = next(self._ids)
+            progress = dict(id=export_id, total=len(books), exported=0,
+                            failed=0, bytes=0, started=time.time(),
+                            complete=False)
+            self._running[export_id] = progress
+        return export_id, self._write(progress, books, open_book)
+
+    def _write(self, progress, books, open_book):
+        sink = _Sink()
+        archive = zipfile.ZipFile(sink, "w", zipfile.ZIP_STORED)
+        pending = deque()
+        upcoming = iter(books)
+        exported = []
+        failed = []
+        try:
+            while True:
+                while len(pending) < self.lookahead:
+                    book = next(upcoming, None)
+                    if book is None:
+                        break
+                    pending.append((book, self._pool.submit(open_book, book[0])))
+                if not pending:
+                    break
+                (id, filename), future = pending.popleft()
+                try:
+                    fh = future.result()
+                except Exception as e:
+                    logger.warning(f"Export {progress['id']}: cannot build {id}: {e}")
+                    failed.append(id)
+                    progress["failed"] += 1
+                    continue
+                with fh:
+                    info = zipfile.ZipInfo(filename, time.localtime()[:6])
+                    info.file_size = os.fstat(fh.fileno()).st_size
+                    with archive.open(info, "w") as member:
+                        while chunk := fh.read(CHUNK_SIZE):
+                            member.write(chunk)
+                            if len(sink) >= CHUNK_SIZE:
+                                yield sink.take()
+                if len(sink):
+                    yield sink.take()
+                exported.append(id)
+                progress["exported"] += 1
+                progress["bytes"] = sink.sent
+
+            manifest = dict(exported=exported, failed=failed,
+                            after=books[-1][0] if books else None)
+            archive.writestr("manifest.json", json.dumps(manifest))
+            archive.close()
+            yield sink.take()
+            progress["bytes"] = sink.sent
+            progress["complete"] = True
+            logger.info(f"Export {progress['id']}: {len(exported)} books, "
+                        f"{len(failed)} failed, {sink.sent} bytes")
+        finally:
+            # The client may have gone away
+            for _, future in pending:
+                if not future.cancel():
+                    future.add_done_callback(_close_book)
+            progress["seconds"] = time.time() - progress["started"]
+            with self._lock:
+                self._running.pop(progress["id"], None)
+                self._finished.append(progress)
+
+    def status(self) -> dict:
+        with self._lock:
+            return dict(workers=self.workers,
+                        lookahead=self.lookahead,
+                        running=[dict(p) for p in self._running.values()],
+                        finished=[dict(p) for p in self._finished])
@@ -0,0 +1,98 @@
+import atexit
+import logging
+import os
+import threading
+
+# Coalesces writes in memory and hands them to a background thread.
+# Values are kept per key, the last one winning, and `write(batch)` gets
+# all of them, as a dict, every `interval` seconds, or as soon as
+# `max_pending` keys are waiting. A batch `write` fails on is kept for the
+# next flush, except for keys that got a newer value meanwhile.
+#
+# The thread is started on first use, in the process that uses it, and
+# whatever is still waiting when the process exits is flushed on the way
+# out.
+
+logger = logging.getLogger(__name__)
+
+
+class Flusher:
+    # Seconds between flushes
+    interval: float
+    # Flush early once this many keys are waiting, never if None
+    max_pending: int
+
+    def __init__(self, name: str, write, interval: float,
+                 max_pending: int = None):
+        self.name = name
+        self.write = write
+        self.interval = interval
+        self.max_pending = max_pending
+
+        self._pending = {}
+        self._wakeup = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        self._pid = None
+        # Only one flush at a time keeps batches in order
+        self._lock = threading.Lock()
+        atexit.register(self.close)
+
+    def put(self, key, value):
+        with self._wakeup:
+            self._start()
+            self._pending[key] = value
+            if self._full():
+                self._wakeup.notify()
+
+    # Returns the value waiting for `key`, or None
+    def get(self, key):
+        with self._wakeup:
+            return self._pending.get(key)
+
+    def _full(self) -> bool:
+        return self.max_pending is not None and len(self._pending) >= self.max_pending
+
+    def _start(self):
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name=self.name,
+                                        daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                if not self._stopped and not self._full():
+                    self._wakeup.wait(self.interval)
+                stopped = self._stopped
+            self.flush()
+            if stopped:
+                return
+
+    # Writes everything waiting so far
+    def flush(self):
+        with self._lock:
+            with self._wakeup:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return
+            try:
+                self.write(batch)
+            except Exception as e:
+                logger.warning(f"{self.name}: writing {len(batch)} updates failed: {e}")
+                with self._wakeup:
+                    # Keep anything newer that arrived meanwhile
+                    for key, value in batch.items():
+                        self._pending.setdefault(key, value)
+
+    def close(self):
+        with self._wakeup:
+            self._stopped = True
+            self._wakeup.notify()
+        if (self._thread is not None and self._pid == os.getpid()
+                and self._thread.is_alive()):
+            self._thread.join()
+        else:
+            self.flush()
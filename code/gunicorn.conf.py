@@ -0,0 +1,25 @@
+import os
+
+# Gunicorn settings, picked up from the working directory at startup.
+# The default is the original single sync worker. Setting
+# WBIP_WORKER_CLASS=gthread serves each worker's requests on
+# WBIP_THREADS threads, so requests waiting on Instapaper, Postlight or
+# image hosts no longer hold up everyone else. Calls to each upstream
+# stay bounded per worker by WBIP_INSTAPAPER_CONCURRENCY,
+# WBIP_POSTLIGHT_CONCURRENCY and WBIP_IMAGE_FETCH_WORKERS.
+
+workers = int(os.environ.get("WBIP_WORKERS", 1))
+worker_class = os.environ.get("WBIP_WORKER_CLASS", "sync")
+threads = int(os.environ.get("WBIP_THREADS", 1 if worker_class == "sync" else 16))
+timeout = int(os.environ.get("WBIP_WORKER_TIMEOUT", 30))
+
+# WBIP_PRELOAD=true loads the app once in the master, so workers start
+# in an instant and share its memory, at the price of restarting the
+# whole server to pick up code changes
+preload_app = os.environ.get("WBIP_PRELOAD", "false") == "true"
+
+
+def post_fork(server, worker):
+    if preload_app:
+        import wbip_wrapper
+        wbip_wrapper.start_background()
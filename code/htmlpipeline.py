@@ -0,0 +1,166 @@
+import re
+import warnings
+
+# Turns an article's HTML into the body of an EPUB chapter.
+# The fragment is parsed into an lxml tree by one of PARSERS, then a single
+# walk over it drops junk images (no src, `denied:`, `data:`, or every
+# image for `_noimg` bookmarks) and those past the cap, collects the rest
+# for download, and removes what would not survive as well-formed XHTML:
+# characters XML doesn't allow, comments, processing instructions and
+# elements with a namespace prefix, whose content is kept. Once the
+# images are fetched, `finish` points each kept <img> at its file in the
+# book and drops the others.
+# The parsers are imported on first use, keeping them out of processes
+# that never build a book.
+
+# Images embedded per article, later ones are dropped
+MAX_IMAGES = 25
+
+# Attribute names that are valid XML names: unprefixed, or namespaced
+# the way lxml spells it
+XML_NAME = re.compile(r"^(\{[^}]*\})?[A-Za-z_][\w.\-]*$")
+
+# A character html5lib had to escape in an element or attribute name
+ESCAPED_CHAR = re.compile(r"U([0-9A-F]{5})")
+
+# Characters XML 1.0 doesn't allow, such as the vertical tab pasted in
+# from word processors. lxml won't take them in a tree, and libxml2
+# turns them into U+FFFD.
+XML_ILLEGAL = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ud800-\udfff\ufffe\uffff]")
+
+
+# The fragment as a document of its own, without characters XML
+# doesn't allow
+def _document(html: str) -> str:
+    return f"<html><body>{XML_ILLEGAL.sub('', html)}</body></html>"
+
+
+# libxml2's HTML parser: fast and forgiving
+def parse_lxml(html: str):
+    from lxml import html as lxml_html
+    return lxml_html.document_fromstring(_document(html)).find("body")
+
+
+# html5lib builds the same tree a browser would, at a fraction of the speed
+def parse_html5lib(html: str):
+    import html5lib
+    from html5lib.constants import DataLossWarning
+    with warnings.catch_warnings():
+        # Names it can't put in an lxml tree, fixed up below
+        warnings.simplefilter("ignore", DataLossWarning)
+        document = html5lib.parse(_document(html), treebuilder="lxml",
+                                  namespaceHTMLElements=False)
+    body = document.getroot().find("body")
+    # Its lxml tree builder spells characters that aren't allowed in XML
+    # names as U + 5 hex digits, turning <o:p> into <oU0003Ap>. Such
+    # elements are unwrapped, like lxml's prefixed ones are in Article,
+    # and such attributes are dropped, like lxml's are.
+    # HTML names are lower case, so an upper case U is always an escape.
+    escaped = []
+    for el in body.iter():
+        if not isinstance(el.tag, str):
+            continue
+        if ESCAPED_CHAR.search(el.tag):
+            escaped.append(el)
+        for name in el.attrib.keys():
+            if ESCAPED_CHAR.search(name):
+                del el.attrib[name]
+    for el in escaped:
+        _unwrap(el)
+    return body
+
+
+PARSERS = {
+    "lxml": parse_lxml,
+    "html5lib": parse_html5lib,
+}
+
+
+# Removes an element, keeping the text that follows it
+def _drop(el):
+    parent = el.getparent()
+    if el.tail:
+        previous = el.getprevious()
+        if previous is not None:
+            previous.tail = (previous.tail or "") + el.tail
+        else:
+            parent.text = (parent.text or "") + el.tail
+    parent.remove(el)
+
+
+# Replaces an element with its text and children. Unknown elements such
+# as Word's <o:p> sit inside paragraphs, so renaming them would nest a
+# <p> in a <p>.
+def _unwrap(el):
+    parent = el.getparent()
+    children = list(el)
+    text = el.text or ""
+    if children:
+        children[-1].tail = (children[-1].tail or "") + (el.tail or "")
+    else:
+        text += el.tail or ""
+    previous = el.getprevious()
+    if previous is not None:
+        previous.tail = (previous.tail or "") + text
+    else:
+        parent.text = (parent.text or "") + text
+    el.tail = None
+    index = parent.index(el)
+    parent[index:index + 1] = children
+
+
+class Article:
+    # The parsed <body>, handed to EpubWriter.add_chapter once finished
+    body: object
+    # Source url of each image to embed, in document order
+    images: list
+
+    def __init__(self, html: str, parser: str = "lxml",
+                 keep_images: bool = True, max_images: int = MAX_IMAGES):
+        self.body = PARSERS[parser](html)
+        self.images = []
+        self._tags = []
+
+        dropped, unwrapped = [], []
+        for el in self.body.iter():
+            if not isinstance(el.tag, str):
+                # Comments, processing instructions and entities
+                dropped.append(el)
+                continue
+            if ":" in el.tag and el.tag[0] != "{":
+                unwrapped.append(el)
+            for name in el.attrib.keys():
+                if not XML_NAME.match(name):
+                    del el.attrib[name]
+            if el.tag != "img":
+                continue
+
+            src = el.get("src")
+            if (not keep_images or not src or src.startswith("denied:")
+                    or src.startswith("data:")
+                    or len(self.images) >= max_images):
+                dropped.append(el)
+                continue
+            src = re.sub("%2C$", "", src)
+            self.images.append(src)
+            self._tags.append((el, src))
+
+        for el in dropped:
+            _drop(el)
+        for el in unwrapped:
+            _unwrap(el)
+
+    # Points every collected image at `hrefs[src]`, its file inside the
+    # book, dropping those without one
+    def finish(self, hrefs: dict):
+        for el, src in self._tags:
+            href = hrefs.get(src)
+            if href is None:
+                _drop(el)
+                continue
+            el.set("src", href)
+            el.set("style", "max-width: 100%")
+            # Alternatives would point back at the web
+            el.attrib.pop("srcset", None)
+            el.attrib.pop("sizes", None)
+        self._tags = []
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass
+
+# Persistent cache of processed images, shared by every EPUB build.
+# Each entry is a processed image file `<key>.img` next to a `<key>.meta`
+# JSON sidecar holding the HTTP validators. The index of all entries is
+# kept in memory, so lookups never touch the filesystem; the disk is only
+# read when an entry's bytes are actually needed.
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CachedImage:
+    key: str
+    size: int
+    fetched_at: float
+    etag: str = None
+    last_modified: str = None
+
+
+class ImageCache:
+    # The directory holding the cached files
+    directory: str
+    # Evict least recently used entries beyond this many bytes
+    max_bytes: int
+    # Entries older than this many seconds are revalidated upstream
+    revalidate_after: float
+
+    def __init__(self, directory: str, max_bytes: int,
+                 revalidate_after: float = 7 * 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.revalidate_after = revalidate_after
+        self._lock = threading.Lock()
+        self._index = OrderedDict()
+        self._bytes = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.directory, f"{key}.{suffix}")
+
+    # Rebuild the in-memory index from the sidecars, oldest use first
+    def _load_index(self):
+        entries = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(".meta"):
+                continue
+            try:
+                with open(os.path.join(self.directory, filename)) as fh:
+                    entry = CachedImage(**json.load(fh))
+                used = os.stat(self._path(entry.key, "img")).st_mtime
+            except (OSError, ValueError, TypeError):
+                continue
+            entries.append((used, entry))
+        for _, entry in sorted(entries, key=lambda x: x[0]):
+            self._index[entry.key] = entry
+            self._bytes += entry.size
+        logger.info(f"Image cache: {len(self._index)} entries, {self._bytes} bytes")
+        self._evict()
+
+    # Returns the index entry for a key, or None.
+    def lookup(self, key: str) -> CachedImage:
+        with self._lock:
+            entry = self._index.get(key)
+            if entry:
+                self._index.move_to_end(key)
+            return entry
+
+    def is_fresh(self, entry: CachedImage) -> bool:
+        return time.time() - entry.fetched_at < self.revalidate_after
+
+    # Returns the cached bytes, or None if another worker evicted them.
+    def read(self, key: str) -> bytes:
+        try:
+            with open(self._path(key, "img"), "rb") as fh:
+                return fh.read()
+        except OSError:
+            self._forget(key)
+            return None
+
+    def put(self, key: str, data: bytes, etag: str = None,
+            last_modified: str = None):
+        entry = CachedImage(key, len(data), time.time(), etag, last_modified)
+        try:
+            self._write(self._path(key, "img"), data)
+            self._write(self._path(key, "meta"),
+                        json.dumps(asdict(entry)).encode())
+        except OSError as e:
+            logger.warning(f"Image cache: cannot store {key} ({e})")
+            return
+        with self._lock:
+            old = self._index.pop(key, None)
+            if old:
+                self._bytes -= old.size
+            self._index[key] = entry
+            self._bytes += entry.size
+        self._evict()
+
+    # Upstream answered 304 Not Modified, restart the freshness clock
+    def revalidated(self, key: str):
+        with self._lock:
+            entry = self._index.get(key)
+            if not entry:
+                return
+            entry.fetched_at = time.time()
+        try:
+            self._write(self._path(key, "meta"),
+                        json.dumps(asdict(entry)).encode())
+        except OSError:
+            pass
+
+    def _write(self, path: str, data: bytes):
+        # Write then rename so other workers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def _forget(self, key: str):
+        with self._lock:
+            entry = self._index.pop(key, None)
+            if entry:
+                self._bytes -= entry.size
+
+    def _evict(self):
+        victims = []
+        with self._lock:
+            while self._bytes > self.max_bytes and self._index:
+                key, entry = self._index.popitem(last=False)
+                self._bytes -= entry.size
+                victims.append(key)
+        for key in victims:
+            for suffix in ("img", "meta"):
+                try:
+                    os.unlink(self._path(key, suffix))
+                except OSError:
+                    pass
@@ -0,0 +1,503 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import (FIRST_COMPLETED, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
+from dataclasses import dataclass
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Concurrent image pipeline used while building EPUBs.
+# Downloads run on a thread pool sharing one pooled HTTP session, the
+# Pillow decode/resize/convert step runs on a process pool, and the
+# whole article is bounded by a single deadline. How images are scaled
+# and encoded is set by the device profile the book is built for.
+# Downloads are streamed and abandoned as soon as they turn out not to
+# be an image or to exceed the per-image or per-article byte budget, and
+# images are only decoded when they fit a pixel budget, so one huge or
+# malicious image can't take a worker down.
+# Pillow is imported by the functions using it, so processes that never
+# build a book don't load it.
+
+logger = logging.getLogger(__name__)
+
+# Per-request timeout for a single image download
+FETCH_TIMEOUT = 3.05
+
+# Bytes read from a download at a time
+CHUNK_SIZE = 64 * 1024
+
+# Content types some servers send for any file; Pillow decides for those
+GENERIC_TYPES = {"", "application/octet-stream", "binary/octet-stream"}
+
+FETCH_ERRORS = (requests.exceptions.ContentDecodingError,
+                requests.exceptions.ConnectionError,
+                requests.exceptions.ReadTimeout,
+                requests.exceptions.InvalidSchema,
+                requests.exceptions.MissingSchema)
+
+# Source formats the fast path can pass through unchanged
+SOURCE_FORMATS = {"JPEG": "jpeg", "MPO": "jpeg", "PNG": "png"}
+
+# JPEGs above this many bytes per pixel are recompressed anyway
+FAST_PATH_JPEG_BPP = 0.3
+
+# "auto" keeps images with at most this many colors (a palette's worth)
+# as PNG
+AUTO_PNG_COLORS = 256
+
+
+# An image left out of a book on purpose; `reason` labels the metric
+class SkippedImage(Exception):
+    def __init__(self, reason: str, message: str):
+        super().__init__(reason, message)
+        self.reason = reason
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+# Image settings for one kind of reading device
+@dataclass(frozen=True)
+class Profile:
+    name: str
+    # Images are scaled down to fit in this box
+    max_size: tuple = (1000, 1000)
+    greyscale: bool = True
+    # "jpeg", "png", or "auto": PNG for images with transparency, a
+    # palette or only a few colors, JPEG for everything else
+    format: str = "auto"
+    # JPEG quality
+    quality: int = 75
+    # PNGs keep 2**bits gray levels, optionally dithered to hide banding
+    bits: int = 8
+    dither: bool = False
+
+    # Everything that affects the output, without the name
+    @property
+    def settings(self) -> str:
+        return (f"{self.max_size[0]}x{self.max_size[1]}|{int(self.greyscale)}|"
+                f"{self.format}|{self.quality}|{self.bits}|{int(self.dither)}")
+
+
+PROFILES = {
+    # What every build used before profiles existed
+    "default": Profile("default"),
+    # 6-7" 300 ppi e-ink (Nook GlowLight 3, Kobo Clara, Kindle Paperwhite):
+    # full screen resolution, 16 dithered gray levels for drawings
+    "eink-hd": Profile("eink-hd", (1072, 1448), quality=70, bits=4, dither=True),
+    # Older 167 ppi e-ink and slow connections
+    "eink-small": Profile("eink-small", (600, 800), quality=60, bits=4),
+    # Color e-ink and tablets
+    "color": Profile("color", (1200, 1600), greyscale=False, quality=80),
+}
+
+
+# Reads extra profiles from a JSON file of {name: {field: value}} and
+# returns them merged over the built-in ones
+def load_profiles(path: str) -> dict:
+    with open(path) as f:
+        extra = json.load(f)
+    profiles = dict(PROFILES)
+    for name, fields in extra.items():
+        # The name is part of cached EPUB file names
+        if not name or not all(c.isascii() and (c.isalnum() or c in "-_")
+                               for c in name):
+            raise ValueError(f"Profile {name!r}: use only letters, digits, - and _")
+        if "max_size" in fields:
+            fields["max_size"] = tuple(fields["max_size"])
+        profile = Profile(name, **fields)
+        if profile.format not in ("auto", "jpeg", "png"):
+            raise ValueError(f"Profile {name}: unknown format {profile.format}")
+        if not 1 <= profile.bits <= 8:
+            raise ValueError(f"Profile {name}: bits must be between 1 and 8")
+        profiles[name] = profile
+    return profiles
+
+
+# Returns the file extension and media type of processed image data
+def describe(data: bytes) -> tuple:
+    if data.startswith(b"\x89PNG"):
+        return ".png", "image/png"
+    return ".jpg", "image/jpeg"
+
+
+# Stable cache key for a source url and the processing applied to it.
+# Also used for the image's file name inside the EPUB.
+def cache_key(src: str, profile: Profile) -> str:
+    ident = f"{src}\n{profile.settings}"
+    return hashlib.sha256(ident.encode()).hexdigest()[:32]
+
+
+# True if the source can go into the book as it is
+def _fits(im, content: bytes, profile: Profile) -> bool:
+    fmt = SOURCE_FORMATS.get(im.format)
+    if fmt is None or profile.format not in ("auto", fmt):
+        return False
+    if im.width > profile.max_size[0] or im.height > profile.max_size[1]:
+        return False
+    if "transparency" in im.info:
+        return False
+    if profile.greyscale:
+        if im.mode != "L" or (fmt == "png" and profile.bits < 8):
+            return False
+    elif im.mode not in ("L", "RGB"):
+        return False
+    # Leave generously encoded JPEGs to be recompressed
+    return fmt != "jpeg" or len(content) <= im.width * im.height * FAST_PATH_JPEG_BPP
+
+
+# Reduces an L image to 2**bits gray levels, as a palette image
+def _reduce_grays(im, bits: int, dither: bool):
+    from PIL import Image
+    levels = 2 ** bits
+    palette = Image.new("P", (1, 1))
+    palette.putpalette([i * 255 // (levels - 1)
+                        for i in range(levels) for _ in range(3)])
+    return im.convert("RGB").quantize(
+        palette=palette,
+        dither=Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE)
+
+
+# Scale and convert an image for a profile.
+# Runs in a worker process, so it must stay a plain module-level function.
+# Returns None if Pillow can't make sense of the data, and raises
+# SkippedImage if it would decode to more than `max_pixels` pixels.
+def transcode(content: bytes, profile: Profile, max_pixels: int = 40_000_000):
+    from PIL import Image
+    mode = "L" if profile.greyscale else "RGB"
+    output = io.BytesIO()
+    try:
+        im = Image.open(io.BytesIO(content))
+        if _fits(im, content, profile):
+            return content
+
+        # JPEGs can be decoded straight to 1/2, 1/4 or 1/8 of their size,
+        # and to a single channel for greyscale profiles
+        ratio = min(profile.max_size[0] / im.width,
+                    profile.max_size[1] / im.height, 1)
+        im.draft(mode, (max(1, int(im.width * ratio)),
+                        max(1, int(im.height * ratio))))
+        # Only the header has been read so far; other formats decode at
+        # full size
+        if im.width * im.height > max_pixels:
+            raise SkippedImage("pixels", f"{im.width}x{im.height} pixels")
+
+        keep_png = im.mode in ("1", "P", "LA", "PA", "RGBA") or "transparency" in im.info
+        if profile.format == "auto" and not keep_png and im.format != "JPEG":
+            # Drawings, counted before scaling blends in new colors
+            keep_png = im.getcolors(AUTO_PNG_COLORS) is not None
+        if im.mode in ("LA", "PA", "RGBA") or "transparency" in im.info:
+            # Transparent areas would turn black, put them on white paper
+            im = im.convert("RGBA")
+            paper = Image.new("RGBA", im.size, "white")
+            paper.alpha_composite(im)
+            im = paper
+        im = im.convert(mode)
+        im.thumbnail(profile.max_size)
+
+        fmt = profile.format
+        if fmt == "auto":
+            fmt = "png" if keep_png else "jpeg"
+        if fmt == "png":
+            if profile.greyscale and profile.bits < 8:
+                im = _reduce_grays(im, profile.bits, profile.dither)
+                im.save(output, "PNG", bits=profile.bits)
+            else:
+                im.save(output, "PNG")
+        else:
+            im.save(output, "JPEG", quality=profile.quality)
+    except Image.DecompressionBombError as e:
+        raise SkippedImage("pixels", str(e))
+    except OSError:
+        return None
+    return output.getvalue()
+
+
+# Bytes an article's downloads may still use, shared by its fetch threads
+class _Budget:
+    def __init__(self, total: int):
+        self.left = total
+        self._lock = threading.Lock()
+
+    def take(self, size: int) -> bool:
+        with self._lock:
+            if size > self.left:
+                return False
+            self.left -= size
+            return True
+
+    def give(self, size: int):
+        with self._lock:
+            self.left += size
+
+
+class ImagePipeline:
+    # Number of concurrent downloads
+    fetch_workers: int
+    # Number of transcode processes, 0 transcodes on the fetch threads
+    transcode_workers: int
+    # Total time budget for all images of one article, in seconds
+    deadline: float
+    # Largest download accepted for one image, in bytes
+    max_bytes: int
+    # Largest image decoded, in pixels after any reduced JPEG decode
+    max_pixels: int
+    # Bytes downloaded for all images of one article
+    article_bytes: int
+
+    def __init__(self, fetch_workers: int = 8, transcode_workers: int = 2,
+                 deadline: float = 20.0, cache=None,
+                 max_bytes: int = 10 * 1024 * 1024, max_pixels: int = 40_000_000,
+                 article_bytes: int = 50 * 1024 * 1024):
+        self.cache = cache
+        self.fetch_workers = fetch_workers
+        self.transcode_workers = transcode_workers
+        self.deadline = deadline
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.article_bytes = article_bytes
+
+        # One keep-alive session shared by every download
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=fetch_workers,
+                              pool_maxsize=fetch_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._fetch_pool = ThreadPoolExecutor(
+            fetch_workers, thread_name_prefix="image-fetch")
+        # Decoded images are large, so without a process pool only a
+        # couple are transcoded on the fetch threads at a time
+        self._transcode_slots = threading.BoundedSemaphore(2)
+        self._slots = threading.BoundedSemaphore(fetch_workers)
+        # Started lazily so gunicorn forks the workers before any
+        # process pool exists.
+        self._transcode_pool = None
+        self._transcode_pid = None
+        self._pool_lock = threading.Lock()
+
+    def _get_transcode_pool(self):
+        if self.transcode_workers <= 0:
+            return None
+        with self._pool_lock:
+            if self._transcode_pool is None or self._transcode_pid != os.getpid():
+                self._transcode_pool = ProcessPoolExecutor(self.transcode_workers)
+                self._transcode_pid = os.getpid()
+            return self._transcode_pool
+
+    # Starts a download; the body is left to be streamed, so the caller
+    # must close the response
+    def fetch(self, src: str, headers: dict = None) -> requests.Response:
+        logger.debug(f"Downloading image {src}")
+        try:
+            with metrics.timer("wbip_upstream_seconds", service="image"):
+                response = self.session.get(src, timeout=FETCH_TIMEOUT,
+                                            headers=headers, stream=True)
+        except Exception:
+            metrics.inc("wbip_upstream_requests_total", service="image",
+                        status="error")
+            raise
+        metrics.inc("wbip_upstream_requests_total", service="image",
+                    status=str(response.status_code))
+        return response
+
+    # Runs on a fetch thread. Returns (data, validators, transcoded):
+    # cached or transcoded bytes come back with transcoded set, raw
+    # downloads come back with the validators to store once processed.
+    # A slot is held from the download until the image is transcoded, so
+    # at most `fetch_workers` raw images are in memory at once; for raw
+    # results the caller releases it when the transcode finishes.
+    def _fetch_and_maybe_transcode(self, key, src, profile, budget):
+        self._slots.acquire()
+        result = None
+        try:
+            result = self._fetch(key, src, profile, budget)
+            return result
+        finally:
+            if result is None or result[2]:
+                self._slots.release()
+
+    # Reads a download's body, giving up as soon as it can't be an image
+    # or goes over a byte budget
+    def _read(self, response, budget) -> bytes:
+        if not response.ok:
+            raise SkippedImage("status", f"HTTP {response.status_code}")
+        kind = response.headers.get("Content-Type", "").split(";")[0].strip().lower()
+        if not kind.startswith("image/") and kind not in GENERIC_TYPES:
+            raise SkippedImage("type", f"not an image: {kind}")
+        length = response.headers.get("Content-Length", "")
+        if length.isdigit():
+            if int(length) > self.max_bytes:
+                raise SkippedImage("size", f"{length} bytes")
+            if int(length) > budget.left:
+                raise SkippedImage("budget", "article image budget spent")
+
+        chunks = []
+        size = 0
+        try:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if size + len(chunk) > self.max_bytes:
+                    raise SkippedImage("size", f"over {self.max_bytes} bytes")
+                if not budget.take(len(chunk)):
+                    raise SkippedImage("budget", "article image budget spent")
+                size += len(chunk)
+                chunks.append(chunk)
+        except SkippedImage:
+            # What was read is dropped, later images may use it
+            budget.give(size)
+            raise
+        return b"".join(chunks)
+
+    def _fetch(self, key, src, profile, budget):
+        headers = {}
+        entry = self.cache.lookup(key) if self.cache else None
+        if entry:
+            if self.cache.is_fresh(entry):
+                data = self.cache.read(key)
+                if data is not None:
+                    metrics.inc("wbip_cache_total", cache="image", result="hit")
+                    return data, None, True
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        response = self.fetch(src, headers)
+        if response.status_code == 304 and entry:
+            response.close()
+            data = self.cache.read(key)
+            if data is not None:
+                self.cache.revalidated(key)
+                metrics.inc("wbip_cache_total", cache="image", result="revalidated")
+                return data, None, True
+            response = self.fetch(src)
+        if self.cache:
+            metrics.inc("wbip_cache_total", cache="image", result="miss")
+
+        with response:
+            content = self._read(response, budget)
+            validators = (response.headers.get('ETag'),
+                          response.headers.get('Last-Modified'))
+        if self._get_transcode_pool() is None:
+            try:
+                with self._transcode_slots, metrics.timer(
+                        "wbip_stage_seconds", stage="image_transcode"):
+                    data = transcode(content, profile, self.max_pixels)
+            except Exception:
+                budget.give(len(content))
+                raise
+            if data is None:
+                # Dropped, later images may use its bytes
+                budget.give(len(content))
+            self._store(key, data, validators)
+            return data, None, True
+        return content, validators, False
+
+    # Done callback for a transcode submitted at `start`
+    def _transcoded(self, start):
+        def done(future):
+            self._slots.release()
+            # Includes time spent waiting for a free process
+            metrics.observe("wbip_stage_seconds", time.perf_counter() - start,
+                            stage="image_transcode")
+        return done
+
+    # Done callback for a fetch left running at the deadline: nobody will
+    # transcode a raw download, so its slot is released here
+    def _abandoned(self, future):
+        if (not future.cancelled() and future.exception() is None
+                and not future.result()[2]):
+            self._slots.release()
+
+    def _store(self, key, data, validators):
+        if self.cache and data is not None and validators is not None:
+            self.cache.put(key, data, *validators)
+
+    def _skip(self, src, reason, message):
+        logger.warning(f"Skipping image {src} ({message})")
+        metrics.inc("wbip_images_skipped_total", reason=reason)
+
+    # Fetch and transcode a batch of images for a profile.
+    # `images` maps a cache key (see `cache_key`) to its source url.
+    # Each processed image is handed to `sink(key, data)` on the calling
+    # thread as soon as it is ready, and not kept afterwards.
+    # Returns the set of keys delivered; images that failed, went over a
+    # budget or missed the deadline are logged and simply absent. The
+    # download of an image that fails to transcode no longer counts
+    # against the article's byte budget.
+    def process(self, images: dict, profile: Profile, sink) -> set:
+        if not images:
+            return set()
+        expires = time.monotonic() + self.deadline
+        pool = self._get_transcode_pool()
+        budget = _Budget(self.article_bytes)
+
+        pending = {}
+        for key, src in images.items():
+            future = self._fetch_pool.submit(
+                self._fetch_and_maybe_transcode, key, src, profile, budget)
+            pending[future] = ("fetch", key, src, None, 0)
+
+        results = set()
+        while pending:
+            remaining = expires - time.monotonic()
+            if remaining <= 0:
+                break
+            done, _ = wait(pending, timeout=remaining,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, key, src, validators, charged = pending.pop(future)
+                try:
+                    data = future.result()
+                except SkippedImage as e:
+                    budget.give(charged)
+                    self._skip(src, e.reason, e)
+                    continue
+                except FETCH_ERRORS as e:
+                    self._skip(src, "error", f"ERROR: {e}")
+                    continue
+                except Exception as e:
+                    budget.give(charged)
+                    self._skip(src, "error", e)
+                    continue
+                if stage == "fetch":
+                    data, validators, transcoded = data
+                    if not transcoded:
+                        try:
+                            transcoding = pool.submit(transcode, data, profile,
+                                                      self.max_pixels)
+                        except Exception as e:
+                            self._slots.release()
+                            budget.give(len(data))
+                            self._skip(src, "error", e)
+                            continue
+                        transcoding.add_done_callback(
+                            self._transcoded(time.perf_counter()))
+                        pending[transcoding] = ("transcode", key, src, validators,
+                                                len(data))
+                        continue
+                else:
+                    self._store(key, data, validators)
+                if data is None:
+                    budget.give(charged)
+                    self._skip(src, "decode", "cannot decode")
+                    continue
+                sink(key, data)
+                results.add(key)
+
+        # The budget ends with the article, so what these downloaded
+        # doesn't need to be given back
+        for future, (stage, key, src, _, _) in pending.items():
+            if not future.cancel() and stage == "fetch":
+                future.add_done_callback(self._abandoned)
+            self._skip(src, "deadline", f"missed deadline in {stage}")
+        return results
@@ -0,0 +1,127 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from urllib.parse import parse_qsl
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+# Pooled HTTP transport for the Instapaper API.
+# Requests are signed with oauth2 exactly like `oauth.Client` does, but
+# sent over one keep-alive requests session, so consecutive calls reuse
+# the TLS connection to www.instapaper.com. Tokens parsed from the
+# Authorization header are kept in a small LRU so each user's token is
+# only parsed once.
+# oauth2 is slow to import (it loads setuptools for its version number),
+# so it is only imported when the first call is signed.
+
+logger = logging.getLogger(__name__)
+
+# Status codes worth another try
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+
+# An oauth consumer or access token, all oauth2 needs of either
+@dataclass(frozen=True)
+class Token:
+    key: str
+    secret: str
+    verifier: str = None
+
+
+class InstapaperClient:
+    base_url: str
+    # Seconds to wait for a connection and for a response
+    timeout: float
+    # Extra attempts on connection errors, 5xx and 429
+    retries: int
+    # First retry waits this long, doubling afterwards
+    backoff: float
+    # Calls in flight at once from this worker, across all threads
+    max_concurrency: int
+
+    def __init__(self, consumer: Token,
+                 base_url: str = "https://www.instapaper.com",
+                 timeout: float = 10.0, retries: int = 2,
+                 backoff: float = 0.5, max_tokens: int = 64,
+                 max_concurrency: int = 10):
+        self.consumer = consumer
+        self.base_url = base_url
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_tokens = max_tokens
+        self.max_concurrency = max_concurrency
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount(base_url, adapter)
+
+        self._signature = None
+        self._tokens = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Returns the oauth token for a wallabag style
+    # "Bearer oauth_token=...&oauth_token_secret=..." Authorization header.
+    def token(self, authorization: str) -> Token:
+        with self._lock:
+            token = self._tokens.get(authorization)
+            if token:
+                self._tokens.move_to_end(authorization)
+                return token
+        params = dict(parse_qsl(authorization.split(" ", 2)[1]))
+        token = Token(params.get("oauth_token"),
+                      params.get("oauth_token_secret"))
+        with self._lock:
+            self._tokens[authorization] = token
+            while len(self._tokens) > self.max_tokens:
+                self._tokens.popitem(last=False)
+        return token
+
+    def _sign(self, url: str, parameters: dict, token: Token) -> bytes:
+        import oauth2 as oauth
+        if self._signature is None:
+            self._signature = oauth.SignatureMethod_HMAC_SHA1()
+        req = oauth.Request.from_consumer_and_token(
+            self.consumer, token=token, http_method="POST", http_url=url,
+            parameters=parameters, is_form_encoded=True)
+        req.sign_request(self._signature, self.consumer, token)
+        return req.to_postdata().encode()
+
+    # POSTs to an API path as the owner of `token` (None for xAuth).
+    # Returns (status code, body bytes); status is 0 if no response arrived.
+    # `retries` overrides the client's default for this call.
+    def post(self, path: str, parameters: dict = {},
+             token: Token = None, retries: int = None) -> tuple:
+        url = f"{self.base_url}{path}"
+        if retries is None:
+            retries = self.retries
+        status, body = 0, b""
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            # Sign every attempt, Instapaper rejects reused nonces
+            data = self._sign(url, dict(parameters), token)
+            try:
+                with self._slots, metrics.timer("wbip_upstream_seconds", "instapaper",
+                                                service="instapaper", path=path):
+                    response = self.session.post(
+                        url, data=data, timeout=self.timeout,
+                        headers={"Content-Type": "application/x-www-form-urlencoded"})
+            except requests.exceptions.RequestException as e:
+                metrics.inc("wbip_upstream_requests_total", service="instapaper",
+                            path=path, status="error")
+                logger.warning(f"Instapaper {path} failed: {e}")
+                continue
+            status, body = response.status_code, response.content
+            metrics.inc("wbip_upstream_requests_total", service="instapaper",
+                        path=path, status=str(status))
+            if status not in RETRY_STATUS:
+                break
+            logger.warning(f"Instapaper {path} returned {status}")
+        return status, body
@@ -0,0 +1,231 @@
+import bisect
+import contextvars
+import glob
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+# In-process counters and latency histograms for /metrics, in the
+# Prometheus text format.
+# Recording one value is a dict update under a lock, cheap enough to leave
+# on everywhere. Each gunicorn worker counts on its own; when `share(dir)`
+# is called every worker also writes a snapshot there every few seconds,
+# and /metrics adds up all snapshots.
+#
+# While a request is traced (see `start_trace`), timings recorded with a
+# `trace` key on the request's thread, or on threads started with its
+# context, are also summed into a per-request dict for the timing log.
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket bounds in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+           5.0, 10.0, 30.0)
+
+# Type and help text of every metric
+METRICS = {
+    "wbip_requests_total":
+        ("counter", "HTTP requests answered, by endpoint and status"),
+    "wbip_request_seconds":
+        ("histogram", "Time to answer a request, by endpoint"),
+    "wbip_response_bytes_total":
+        ("counter", "Response body bytes sent, by endpoint"),
+    "wbip_upstream_requests_total":
+        ("counter", "Calls to Instapaper, Postlight and image hosts, by status "
+                    "(error when no response arrived)"),
+    "wbip_upstream_seconds":
+        ("histogram", "Latency of calls to Instapaper, Postlight and image hosts"),
+    "wbip_stage_seconds":
+        ("histogram", "Time spent in each EPUB build stage"),
+    "wbip_sqlite_seconds":
+        ("histogram", "Time spent in each database operation"),
+    "wbip_cache_total":
+        ("counter", "EPUB and image cache lookups, by result"),
+    "wbip_images_skipped_total":
+        ("counter", "Images left out of books, by reason"),
+    "wbip_build_wait_seconds":
+        ("histogram", "Time EPUB builds waited for a slot, by lane"),
+    "wbip_build_rejected_total":
+        ("counter", "EPUB builds refused with a 503, by reason"),
+}
+
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_gauges = {}
+_trace = contextvars.ContextVar("wbip_trace", default=None)
+_shared = None
+_shared_interval = 5.0
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+# Records a duration. With `trace`, it is also added to the current
+# request's timings under that name.
+def observe(name: str, seconds: float, trace: str = None, **labels):
+    key = _key(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [0, 0.0, [0] * (len(BUCKETS) + 1)]
+        histogram[0] += 1
+        histogram[1] += seconds
+        histogram[2][bisect.bisect_left(BUCKETS, seconds)] += 1
+        if trace is not None:
+            timings = _trace.get()
+            if timings is not None:
+                timings[trace] = timings.get(trace, 0.0) + seconds
+
+
+@contextmanager
+def timer(name: str, trace: str = None, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, trace, **labels)
+
+
+# Reports `fn()` as a gauge, read when /metrics is rendered
+def gauge(name: str, help: str, fn):
+    _gauges[name] = (help, fn)
+
+
+# Starts collecting timings for the current request; returns the dict
+# they are summed into, in seconds per trace name
+def start_trace() -> dict:
+    timings = {}
+    _trace.set(timings)
+    return timings
+
+
+def stop_trace():
+    _trace.set(None)
+
+
+def _snapshot() -> dict:
+    with _lock:
+        return {
+            "counters": [[name, labels, value]
+                         for (name, labels), value in _counters.items()],
+            "histograms": [[name, labels, count, total, list(buckets)]
+                           for (name, labels), (count, total, buckets)
+                           in _histograms.items()],
+        }
+
+
+# Makes this process write its numbers into `directory` every `interval`
+# seconds, and /metrics include those of every process doing the same
+def share(directory: str, interval: float = 5.0):
+    global _shared, _shared_interval
+    os.makedirs(directory, exist_ok=True)
+    _shared = directory
+    _shared_interval = interval
+
+    def run():
+        while True:
+            time.sleep(interval)
+            _write_snapshot()
+
+    threading.Thread(target=run, name="metrics", daemon=True).start()
+
+
+def _write_snapshot():
+    fd, tmp = tempfile.mkstemp(dir=_shared, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(_snapshot(), f)
+        os.replace(tmp, os.path.join(_shared, f"{os.getpid()}.json"))
+    except OSError as e:
+        logger.warning(f"Cannot write metrics snapshot: {e}")
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+
+
+def _merged() -> tuple:
+    snapshots = [_snapshot()]
+    if _shared:
+        mine = os.path.join(_shared, f"{os.getpid()}.json")
+        # Snapshots not refreshed for a while are from exited workers
+        stale = time.time() - max(60.0, 10 * _shared_interval)
+        for path in glob.glob(os.path.join(_shared, "*.json")):
+            if path == mine:
+                continue
+            try:
+                if os.path.getmtime(path) < stale:
+                    os.unlink(path)
+                    continue
+                with open(path) as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    counters = {}
+    histograms = {}
+    for snapshot in snapshots:
+        for name, labels, value in snapshot["counters"]:
+            key = (name, tuple(map(tuple, labels)))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, count, total, buckets in snapshot["histograms"]:
+            key = (name, tuple(map(tuple, labels)))
+            merged = histograms.setdefault(key, [0, 0.0, [0] * len(buckets)])
+            merged[0] += count
+            merged[1] += total
+            merged[2] = [a + b for a, b in zip(merged[2], buckets)]
+    return counters, histograms
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels, extra=()) -> str:
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"'
+                          for name, value in pairs) + "}"
+
+
+# Returns everything recorded, in the Prometheus text exposition format
+def render() -> str:
+    counters, histograms = _merged()
+    lines = []
+    for name, (kind, help) in METRICS.items():
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        if kind == "counter":
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_labels(labels)} {value}")
+            continue
+        for (metric, labels), (count, total, buckets) in sorted(histograms.items()):
+            if metric != name:
+                continue
+            cumulative = 0
+            for bound, n in zip(BUCKETS + ("+Inf",), buckets):
+                cumulative += n
+                lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+    for name, (help, fn) in _gauges.items():
+        try:
+            value = fn()
+        except Exception as e:
+            logger.warning(f"Cannot read gauge {name}: {e}")
+            continue
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {value}")
+    return "\n".join(lines) + "\n"
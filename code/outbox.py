@@ -0,0 +1,200 @@
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from backend.common import Operation
+from instapaper import RETRY_STATUS, Token
+
+# Durable queue of Instapaper writes.
+# Archive and progress calls are stored in the database and acknowledged
+# to KOReader right away. A background thread in each worker claims due
+# calls in batches, sends them concurrently and deletes them once
+# Instapaper accepts them. Calls that fail with a connection error, 5xx
+# or 429 are retried with exponential backoff, so an archive made while
+# Instapaper is down goes through once it is back.
+#
+# Claiming a call pushes its next attempt `lease` seconds out, so two
+# workers never send the same call at once and a worker dying mid-send
+# only delays it. Calls for the same bookmark, such as the progress and
+# archive calls of an archive, are sent one after the other in the order
+# they were made; one that has to be retried holds back the later ones.
+
+logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    # Calls claimed per round
+    batch_size: int
+    # Calls sent at the same time
+    concurrency: int
+    # Seconds between checks for due retries
+    interval: float
+    # First retry waits this long, doubling per attempt up to max_backoff
+    backoff: float
+    max_backoff: float
+    # Give up on a call after this many failed attempts
+    max_attempts: int
+    # Seconds a claimed call stays reserved for its sender
+    lease: float
+
+    def __init__(self, backend, client, batch_size: int = 20,
+                 concurrency: int = 4, interval: float = 5.0,
+                 backoff: float = 5.0, max_backoff: float = 3600.0,
+                 max_attempts: int = 50, lease: float = 300.0):
+        self.backend = backend
+        self.client = client
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.interval = interval
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_attempts = max_attempts
+        self.lease = lease
+
+        self._wakeup = threading.Condition()
+        self._kicked = False
+        self._thread = None
+        self._pool = None
+        self._pid = None
+        self._counters = {"enqueued": 0, "sent": 0, "retried": 0, "dropped": 0}
+        self._latency = 0.0
+        self._send_seconds = 0.0
+
+    def start(self):
+        with self._wakeup:
+            self._start()
+
+    def _start(self):
+        # The thread and pool belong to the process that started them
+        if self._pid == os.getpid() and self._thread.is_alive():
+            return
+        self._pid = os.getpid()
+        self._pool = ThreadPoolExecutor(self.concurrency,
+                                        thread_name_prefix="outbox")
+        self._thread = threading.Thread(target=self._run, name="outbox",
+                                        daemon=True)
+        self._thread.start()
+
+    # Stores a call to send as the owner of `token`. With `replace`,
+    # pending calls to the same path for the same bookmark are dropped,
+    # so only the newest is sent. With `unless`, the call is left out if
+    # the bookmark has a pending call to that path. Returns whether it
+    # was stored.
+    def enqueue(self, token: Token, path: str, parameters: dict,
+                replace: bool = False, unless: str = None) -> bool:
+        if not self.backend.enqueue_operation(Operation(
+                None, token.key, token.secret, int(parameters["bookmark_id"]),
+                path, json.dumps(parameters), time.time(), 0), replace, unless):
+            return False
+        with self._wakeup:
+            self._counters["enqueued"] += 1
+            self._start()
+            self._kicked = True
+            self._wakeup.notify()
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                claimed = self.dispatch()
+            except Exception as e:
+                logger.warning(f"Outbox dispatch failed: {e}")
+                claimed = 0
+            # A full batch means there is probably more waiting
+            if claimed >= self.batch_size:
+                continue
+            with self._wakeup:
+                if not self._kicked:
+                    self._wakeup.wait(self.interval)
+                self._kicked = False
+
+    # Sends one batch of due calls. Returns how many were claimed.
+    def dispatch(self) -> int:
+        now = time.time()
+        batch = self.backend.claim_operations(now, now + self.lease,
+                                              self.batch_size)
+        if not batch:
+            return 0
+
+        # Bookmarks are sent concurrently, each one's calls in order
+        bookmarks = {}
+        for op in batch:
+            bookmarks.setdefault((op.account, op.bookmark), []).append(op)
+        results = {}
+        for sent_in_order in self._pool.map(self._send_in_order, bookmarks.values()):
+            results.update(sent_in_order)
+
+        done, retries, released = [], [], []
+        sent = dropped = 0
+        latency = send_seconds = 0.0
+        for op in batch:
+            if op.id not in results:
+                # Held back by an earlier call that is retried
+                released.append(op.id)
+                continue
+            status, body, seconds = results[op.id]
+            send_seconds += seconds
+            if status == 200:
+                done.append(op.id)
+                sent += 1
+                latency += time.time() - op.created_at
+            elif status and status not in RETRY_STATUS:
+                logger.warning(f"Dropping {op.path} for {op.bookmark}: "
+                               f"Instapaper returned {status} {body[:200]!r}")
+                done.append(op.id)
+                dropped += 1
+            elif op.attempts + 1 >= self.max_attempts:
+                logger.warning(f"Dropping {op.path} for {op.bookmark} "
+                               f"after {op.attempts + 1} attempts")
+                done.append(op.id)
+                dropped += 1
+            else:
+                delay = min(self.backoff * 2 ** op.attempts, self.max_backoff)
+                retries.append((op.id, time.time() + delay,
+                                f"status {status}" if status else "unreachable"))
+        self.backend.finish_operations(done, retries, released)
+
+        with self._wakeup:
+            self._counters["sent"] += sent
+            self._counters["dropped"] += dropped
+            self._counters["retried"] += len(retries)
+            self._latency += latency
+            self._send_seconds += send_seconds
+        if retries:
+            logger.info(f"Outbox: {sent} sent, {len(retries)} to retry")
+        return len(batch)
+
+    # Sends calls one after the other until one has to be retried.
+    # Returns {id: (status, body, seconds)} of those sent.
+    def _send_in_order(self, ops: list) -> dict:
+        results = {}
+        for op in ops:
+            status, body, seconds = results[op.id] = self._send(op)
+            if status != 200 and (not status or status in RETRY_STATUS):
+                break
+        return results
+
+    def _send(self, op: Operation) -> tuple:
+        start = time.monotonic()
+        # Failures are retried from the outbox, not in a blocking loop here
+        status, body = self.client.post(
+            op.path, json.loads(op.parameters),
+            Token(op.account, op.secret), retries=0)
+        return status, body, time.monotonic() - start
+
+    def status(self) -> dict:
+        pending, retrying, oldest = self.backend.get_outbox_stats()
+        with self._wakeup:
+            sent = self._counters["sent"]
+            attempts = sent + self._counters["retried"] + self._counters["dropped"]
+            return dict(
+                pending=pending,
+                retrying=retrying,
+                oldest_seconds=time.time() - oldest if oldest else 0.0,
+                avg_latency_seconds=self._latency / sent if sent else 0.0,
+                avg_send_seconds=(self._send_seconds / attempts
+                                  if attempts else 0.0),
+                **self._counters)
@@ -0,0 +1,71 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Background EPUB builder.
+# Listing entries queues the bookmarks that have no cached EPUB yet, so
+# the build is usually done by the time KOReader asks for the file.
+# Each worker process has its own prefetcher; the EPUB cache's file lock
+# keeps workers from building the same id twice.
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+    # Number of EPUBs built at the same time
+    workers: int
+    # Jobs beyond this many queued ids are dropped
+    max_queue: int
+
+    def __init__(self, workers: int = 2, max_queue: int = 100):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._running = 0
+        self._counters = {"queued": 0, "built": 0, "failed": 0, "dropped": 0}
+        self._build_seconds = 0.0
+
+    # Queue `job()` to run for this id in the background.
+    # Returns False if the id is already queued or the queue is full.
+    def submit(self, id: int, job) -> bool:
+        with self._lock:
+            if id in self._pending:
+                return False
+            if len(self._pending) >= self.max_queue:
+                self._counters["dropped"] += 1
+                return False
+            self._pending.add(id)
+            self._counters["queued"] += 1
+        self._pool.submit(self._run, id, job)
+        return True
+
+    def _run(self, id: int, job):
+        with self._lock:
+            self._running += 1
+        start = time.monotonic()
+        try:
+            job()
+            outcome = "built"
+        except Exception as e:
+            logger.warning(f"Prefetch of {id} failed: {e}")
+            outcome = "failed"
+        with self._lock:
+            self._running -= 1
+            self._pending.discard(id)
+            self._counters[outcome] += 1
+            self._build_seconds += time.monotonic() - start
+
+    def status(self) -> dict:
+        with self._lock:
+            finished = self._counters["built"] + self._counters["failed"]
+            return dict(
+                workers=self.workers,
+                max_queue=self.max_queue,
+                waiting=len(self._pending) - self._running,
+                running=self._running,
+                avg_build_seconds=(self._build_seconds / finished
+                                   if finished else 0.0),
+                **self._counters)
@@ -0,0 +1,131 @@
+import hashlib
+import logging
+import time
+
+import flusher
+from backend.common import Book, Document
+from instapaper import Token
+
+# Sends KOReader reading progress back to Instapaper.
+# KOReader names a book in /syncs/progress by a hash of the file: by
+# default an MD5 of a few 1 KiB samples spread over it, or the MD5 of its
+# file name. Both hashes of every EPUB we build are stored with the
+# bookmark and the Instapaper account it was built for.
+#
+# Anyone can register a sync user, and a file name hash is easy to guess,
+# so progress only goes to an account whose owner linked the sync user
+# that reported it (link_user, with the sync login). The link keeps the
+# oauth token the progress is sent with.
+#
+# Devices report progress on nearly every page turn, so a report only
+# replaces the document's latest progress in memory. Every `interval`
+# seconds a background thread looks the reported documents up and puts
+# one update_read_progress call per book into the outbox, so neither the
+# database nor Instapaper sees more than one write per book per interval.
+# Each worker process keeps its own reports; progress not yet flushed
+# when a worker exits is flushed on the way out.
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_PATH = "/api/1/bookmarks/update_read_progress"
+ARCHIVE_PATH = "/api/1/bookmarks/archive"
+
+# Builds of a bookmark remembered per account and image profile. A
+# rebuild, say after the book was evicted from the cache, has other
+# bytes than the copy a device may still be reading.
+BUILDS_KEPT = 3
+
+
+# KOReader's "binary" document hash (util.partialMD5)
+def partial_md5(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as fh:
+        # Samples at 0 and 1 KiB * 4**i; LuaJIT wraps the shift for i = -1
+        for offset in [0] + [1024 << (2 * i) for i in range(11)]:
+            fh.seek(offset)
+            sample = fh.read(1024)
+            if not sample:
+                break
+            md5.update(sample)
+    return md5.hexdigest()
+
+
+# KOReader's "filename" document hash
+def filename_md5(filename: str) -> str:
+    return hashlib.md5(filename.encode()).hexdigest()
+
+
+class ProgressBridge:
+    # Seconds between flushes of the reported progress to the outbox
+    interval: float
+
+    def __init__(self, backend, outbox, interval: float = 60.0):
+        self.backend = backend
+        self.outbox = outbox
+        self.interval = interval
+        self._flusher = flusher.Flusher("progress-bridge", self._write, interval)
+
+    # Remembers the EPUB at `path`, downloaded as `filename`, as the book
+    # of `bookmark` for the owner of `token`, built with the image profile
+    # named `profile`
+    def register(self, path: str, filename: str, bookmark: int, token: Token,
+                 profile: str):
+        try:
+            documents = (partial_md5(path), filename_md5(filename))
+        except OSError as e:
+            logger.warning(f"Cannot hash the book of {bookmark}: {e}")
+            return
+        built_at = time.time()
+        self.backend.put_books(
+            (Book(document, bookmark, token.key, profile, built_at)
+             for document in documents), keep=BUILDS_KEPT)
+        # Links send with the account's latest token
+        self.backend.update_sync_links(token.key, token.secret)
+
+    # Lets the progress sync user `username` reports reach the account of
+    # `token`
+    def link_user(self, username: str, token: Token):
+        self.backend.link_sync_user(username, token.key, token.secret)
+
+    def unlink_user(self, username: str, token: Token):
+        self.backend.unlink_sync_user(username, token.key)
+
+    # The sync users linked to the account of `token`
+    def linked_users(self, token: Token) -> list:
+        return self.backend.get_sync_users(token.key)
+
+    # Notes the progress sync user `username` reported on a document, to
+    # be sent with the next flush if it is one of our books and the user
+    # is linked to its account
+    def push(self, username: str, document: Document):
+        self._flusher.put((username, document.document), document)
+
+    # Queues the latest progress of every reported book
+    def flush(self):
+        self._flusher.flush()
+
+    def close(self):
+        self._flusher.close()
+
+    def _write(self, batch: dict):
+        for (username, _), document in batch.items():
+            try:
+                self._send(username, document)
+            except Exception as e:
+                logger.warning(f"Queueing progress of {document.document} failed: {e}")
+
+    def _send(self, username: str, document: Document):
+        book = self.backend.get_book(document.document)
+        if book is None:
+            return
+        secret = self.backend.get_sync_secret(username, book.account)
+        if secret is None:
+            logger.debug(f"{username} is not linked to the account of {book.bookmark}")
+            return
+        self.outbox.enqueue(
+            Token(book.account, secret), PROGRESS_PATH,
+            {"bookmark_id": book.bookmark,
+             "progress": min(max(float(document.percentage), 0.0), 1.0),
+             "progress_timestamp": int(document.timestamp)},
+            # An archive already set the progress to the end
+            replace=True, unless=ARCHIVE_PATH)
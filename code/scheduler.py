@@ -0,0 +1,261 @@
+import fcntl
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+import metrics
+
+# Admission control for EPUB builds.
+# A build is the most expensive thing a request can do, so at most
+# `max_running` run at the same time per worker. Everything that doesn't
+# build (cache hits, /syncs/*, listings) never waits here, and because
+# the builds waiting for a slot are bounded too, they can't tie up all
+# of a worker's threads.
+#
+# With `slot_dir`, the cap holds across worker processes too: a build
+# admitted in its worker also takes one of `max_running` slot files in
+# that directory, and polls for one until its wait runs out. Slots are
+# POSIX record locks (lockf), which processes forked during a build,
+# such as the image transcoding pool, don't inherit; they belong to the
+# whole process, so which slots its threads hold is tracked here. The queue below is kept per worker, so the lanes and the
+# turns between users only order the builds of one worker; under sync
+# workers, which serve one request at a time, there is nothing to order
+# and builds get shared slots first come, first served.
+#
+# Waiting builds are in two lanes: "interactive" for a device waiting on
+# export.epub, served first, and "background" for prefetches and bulk
+# exports, which run on their own pools. Within a lane users take turns,
+# one build each, so a user with a long queue doesn't hold up the next
+# user's single book. An interactive build is refused with Busy when too
+# many are waiting, in total or for its user, or when it has waited too
+# long.
+
+LANES = ("interactive", "background")
+
+# Seconds between tries for a slot shared with other worker processes
+SHARED_POLL = 0.05
+
+
+class Busy(Exception):
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class _Ticket:
+    def __init__(self, user: str, lane: str):
+        self.user = user
+        self.lane = lane
+        self.granted = False
+
+
+class BuildScheduler:
+    # Builds running at the same time
+    max_running: int
+    # Interactive builds waiting before more are refused
+    max_waiting: int
+    # Interactive builds one user may have waiting
+    max_waiting_per_user: int
+    # Seconds an interactive build waits for a slot before giving up
+    max_wait: float
+    # Directory of the slot files shared by the worker processes, None to
+    # cap builds per worker only
+    slot_dir: str
+
+    def __init__(self, max_running: int = 2, max_waiting: int = 8,
+                 max_waiting_per_user: int = 4, max_wait: float = 30.0,
+                 slot_dir: str = None):
+        self.max_running = max_running
+        self.max_waiting = max_waiting
+        self.max_waiting_per_user = max_waiting_per_user
+        self.max_wait = max_wait
+        self.slot_dir = slot_dir
+
+        self._cond = threading.Condition()
+        self._running = 0
+        # Per lane, the waiting tickets of each user in turn order
+        self._queues = {lane: OrderedDict() for lane in LANES}
+        self._waiting = {lane: 0 for lane in LANES}
+        # Admitted builds waiting for a shared slot
+        self._waiting_shared = 0
+        # Shared slots held, or being tried, by this process
+        self._held_shared = set()
+        self._counters = {"admitted": 0, "rejected": 0, "timed_out": 0}
+        self._wait_seconds = 0.0
+        self._build_seconds = 0.0
+        self._built = 0
+
+    # Runs the body once a build slot is free for `user`. Raises Busy
+    # instead for an interactive build that can't be admitted.
+    @contextmanager
+    def slot(self, user: str, lane: str = "interactive"):
+        requested = time.monotonic()
+        self._acquire(user, lane, requested)
+        try:
+            shared = self._acquire_shared(lane, requested)
+        except Busy:
+            self._release(None)
+            raise
+        waited = time.monotonic() - requested
+        with self._cond:
+            self._counters["admitted"] += 1
+            self._wait_seconds += waited
+        metrics.observe("wbip_build_wait_seconds", waited, "build_wait", lane=lane)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            if shared is not None:
+                self._release_shared(*shared)
+            self._release(time.monotonic() - start)
+
+    def _acquire(self, user, lane, start):
+        with self._cond:
+            if self._running < self.max_running and not any(self._waiting.values()):
+                self._running += 1
+                return
+
+            users = self._queues[lane]
+            if lane == "interactive":
+                reason = None
+                if self._waiting[lane] >= self.max_waiting:
+                    reason = "queue"
+                elif len(users.get(user, ())) >= self.max_waiting_per_user:
+                    reason = "user"
+                if reason:
+                    self._counters["rejected"] += 1
+                    metrics.inc("wbip_build_rejected_total", reason=reason)
+                    raise Busy("Too many books are being built", self._retry_after())
+
+            ticket = _Ticket(user, lane)
+            users.setdefault(user, deque()).append(ticket)
+            self._waiting[lane] += 1
+            expires = start + self.max_wait if lane == "interactive" else None
+            while not ticket.granted:
+                timeout = None if expires is None else expires - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    self._remove(ticket)
+                    self._counters["timed_out"] += 1
+                    metrics.inc("wbip_build_rejected_total", reason="wait")
+                    raise Busy("Waited too long for a build slot", self._retry_after())
+                self._cond.wait(timeout)
+
+    # Locks a free one of the slot files shared by the worker processes,
+    # trying again until the build's wait runs out. Returns the slot's
+    # number and open file, or None without `slot_dir`.
+    def _acquire_shared(self, lane, start):
+        if self.slot_dir is None:
+            return None
+        expires = start + self.max_wait if lane == "interactive" else None
+        with self._cond:
+            self._waiting_shared += 1
+        try:
+            while True:
+                shared = self._try_shared()
+                if shared is not None:
+                    return shared
+                if expires is not None and time.monotonic() >= expires:
+                    with self._cond:
+                        self._counters["timed_out"] += 1
+                    metrics.inc("wbip_build_rejected_total", reason="wait")
+                    raise Busy("Waited too long for a build slot", self._retry_after())
+                time.sleep(SHARED_POLL)
+        finally:
+            with self._cond:
+                self._waiting_shared -= 1
+
+    def _try_shared(self):
+        # The directory may have been cleaned out from under us
+        os.makedirs(self.slot_dir, exist_ok=True)
+        for n in range(self.max_running):
+            # Another thread's lock wouldn't keep this one out
+            with self._cond:
+                if n in self._held_shared:
+                    continue
+                self._held_shared.add(n)
+            path = os.path.join(self.slot_dir, f"build-slot-{n}.lock")
+            shared = open(path, "a")
+            try:
+                fcntl.lockf(shared, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # A slot file removed and created again isn't the one
+                # the other workers lock
+                if os.stat(path).st_ino == os.fstat(shared.fileno()).st_ino:
+                    return n, shared
+            except OSError:
+                pass
+            self._release_shared(n, shared)
+        return None
+
+    # Closing the file drops the lock
+    def _release_shared(self, n, shared):
+        shared.close()
+        with self._cond:
+            self._held_shared.discard(n)
+
+    # Gives the slot back, counting a build that ran for `seconds`
+    def _release(self, seconds):
+        with self._cond:
+            if seconds is not None:
+                self._build_seconds += seconds
+                self._built += 1
+            self._running -= 1
+            self._grant()
+
+    # Hands free slots to the next users in turn, interactive lane first
+    def _grant(self):
+        granted = False
+        for lane in LANES:
+            users = self._queues[lane]
+            while users and self._running < self.max_running:
+                user, tickets = next(iter(users.items()))
+                ticket = tickets.popleft()
+                if tickets:
+                    users.move_to_end(user)
+                else:
+                    del users[user]
+                self._waiting[lane] -= 1
+                self._running += 1
+                ticket.granted = True
+                granted = True
+        if granted:
+            self._cond.notify_all()
+
+    def _remove(self, ticket):
+        users = self._queues[ticket.lane]
+        tickets = users[ticket.user]
+        tickets.remove(ticket)
+        if not tickets:
+            del users[ticket.user]
+        self._waiting[ticket.lane] -= 1
+
+    # Seconds until the waiting builds are likely done, for Retry-After,
+    # but no longer than a build would wait
+    def _retry_after(self) -> int:
+        average = self._build_seconds / self._built if self._built else 5.0
+        waiting = sum(self._waiting.values())
+        estimate = math.ceil(average * (waiting / self.max_running + 1))
+        return max(1, min(estimate, math.ceil(self.max_wait)))
+
+    # Builds waiting for a slot, in all lanes
+    def depth(self) -> int:
+        with self._cond:
+            return sum(self._waiting.values())
+
+    def status(self) -> dict:
+        with self._cond:
+            waited = self._counters["admitted"]
+            return dict(
+                max_running=self.max_running,
+                max_waiting=self.max_waiting,
+                running=self._running,
+                waiting=dict(self._waiting),
+                waiting_shared=self._waiting_shared,
+                waiting_users=len({user for users in self._queues.values()
+                                   for user in users}),
+                avg_wait_seconds=self._wait_seconds / waited if waited else 0.0,
+                avg_build_seconds=(self._build_seconds / self._built
+                                   if self._built else 0.0),
+                **self._counters)
@@ -1,20 +1,32 @@
-import io
+import hashlib
+import html
+import itertools
 import json
 import logging
+import math
 import os
-import re
+import threading
 import time
-from urllib.parse import parse_qsl, urlencode, urlparse
 
+import assets
 import backend.sqlite
-import oauth2 as oauth
-import requests
-from backend.common import Bookmark, Document
-from bs4 import BeautifulSoup
-from ebooklib import epub
-from flask import Flask, jsonify, request, send_file
+import backend.writebehind
+import epubcache
+import enrich
+import epubwriter
+import exporter
+import htmlpipeline
+import imagecache
+import images
+import instapaper
+import metrics
+import outbox
+import prefetch
+import progress
+import scheduler
+from backend.common import Bookmark, Document, Entry
+from flask import Flask, Response, g, jsonify, request, send_file
 from my_secrets import oauth_creds
-from PIL import Image
 from werkzeug.middleware.proxy_fix import ProxyFix
 
 config = {
@@ -32,33 +44,81 @@ app.logger.setLevel(logging.INFO)
 BASE_URL = "https://www.instapaper.com"
 API_VERSION = "/api/1"
 
-consumer = oauth.Consumer(
-    oauth_creds['key'], oauth_creds['secret'])
-client = oauth.Client(consumer)
-
-try:
-    with open("domain_map.json") as fh:
-        domain_map = json.load(fh)
-except:
-    domain_map = {}
-app.logger.debug(f"domain_map: {domain_map}")
-
 
 @app.route("/")
 def hello_world():
     return "Here there be dragons."
 
 
+@app.before_request
+def start_timing():
+    g.start = time.perf_counter()
+    g.timings = metrics.start_trace()
+
+
+# Requests are counted and timed once their body has been sent, so a
+# streamed EPUB counts in full
+@app.after_request
+def record_timing(response):
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    # The request context is gone by the time the body has been sent
+    start = g.start
+    timings = g.timings
+    method = request.method
+    path = request.path
+    sent = [0]
+
+    def finished():
+        elapsed = time.perf_counter() - start
+        metrics.inc("wbip_requests_total", endpoint=endpoint,
+                    status=response.status_code)
+        metrics.observe("wbip_request_seconds", elapsed, endpoint=endpoint)
+        metrics.inc("wbip_response_bytes_total", sent[0], endpoint=endpoint)
+        metrics.stop_trace()
+        if g_timing_log:
+            app.logger.info("timing " + json.dumps(dict(
+                method=method, endpoint=endpoint, path=path,
+                status=response.status_code, bytes=sent[0],
+                seconds=round(elapsed, 4),
+                **{name: round(value, 4) for name, value in timings.items()})))
+
+    if method == "HEAD" or response.status_code in (204, 304):
+        pass
+    elif response.is_streamed and not response.direct_passthrough:
+        body = response.response
+
+        def counted():
+            for chunk in body:
+                sent[0] += len(chunk)
+                yield chunk
+        response.response = counted()
+    else:
+        sent[0] = response.content_length or 0
+
+    if response.direct_passthrough:
+        # Files go to the server untouched so it can use sendfile, and
+        # only the file wrapper gets closed
+        body = response.response
+        close = getattr(body, "close", lambda: None)
+
+        def close_and_record():
+            close()
+            finished()
+        body.close = close_and_record
+    else:
+        response.call_on_close(finished)
+    return response
+
+
 @app.post("/oauth/v2/token")
 def get_token():
     params = json.loads(request.get_data())
     app.logger.info(f"Logging in {params['username']}")
-    access_token_url = f"{BASE_URL}{API_VERSION}/oauth/access_token"
-    response, content = client.request(access_token_url, "POST", urlencode({
+    status, content = g_instapaper.post(f"{API_VERSION}/oauth/access_token", {
         'x_auth_mode': 'client_auth',
         'x_auth_username': params['username'],
-        'x_auth_password': params['password']}))
-    if response.status == 200:
+        'x_auth_password': params['password']})
+    if status == 200:
         return jsonify({"expires_in": 1800,
                         "scope": None,
                         "access_token": content.decode('utf-8')
@@ -78,34 +138,113 @@ def get_entries():
             app.logger.info(f"Adding URL {url}: {result}")
             return jsonify(result[0])
     else:
-        if int(request.args.get('page', 1)) > 1:
-            return "only one page plz", 404
-        entries = []
-        done = True
-        app.logger.debug("get entries")
-        instapaper = get_api_data(
-            "/bookmarks/list",
-        #    parameters={
-        #        "limit": request.args.get('perPage', 10) * request.args.get('page', 1),
-        #        "have": ",".join([x['id'] for x in entries])
-        #        })
-            parameters={"limit": request.args.get('perPage', 30)})
-        for mark in instapaper:
-            if mark['type'] != "bookmark":
-                continue
-            done = False
-            mark['tags'] = [x['name'] for x in mark['tags']]
-            mark['id'] = mark['bookmark_id']
-            del mark['bookmark_id']
-            del mark['type']
-            mark['mimetype'] = "text/html"
-            # TODO
-            # mark['updated_at'] = parse_somehow_mumble(mark['time']) like :   "updated_at": "2023-01-24T15:21:09+0000",
-            bookmark = Bookmark(int(mark['id']), mark['title'], mark['url'], ",".join(mark['tags']))
-            app.logger.debug(f"Bookmark: {bookmark.title}")
-            g_storage_backend.update_bookmark(bookmark)
-            entries.append(mark)
-        return jsonify({"_embedded": {"items": entries}}), 200
+        page = int(request.args.get('page', 1))
+        per_page = int(request.args.get('perPage', 30))
+        if page < 1 or per_page < 1:
+            return "Invalid Request", 400
+        account = request_token().key
+        # Later pages are served from the copy synced for page 1
+        if page == 1:
+            sync_entries(account)
+        total, rows = g_storage_backend.get_entries(
+            account, (page - 1) * per_page, per_page)
+        pages = max(1, math.ceil(total / per_page))
+        if page > pages:
+            return "No such page", 404
+        entries = [json.loads(row.entry) for row in rows]
+        profile = request_profile()
+        for mark in entries:
+            prefetch_epub(Bookmark(int(mark['id']), mark['title'], mark['url'],
+                                   ",".join(mark['tags'])), profile)
+        return jsonify({"page": page,
+                        "limit": per_page,
+                        "pages": pages,
+                        "total": total,
+                        "_embedded": {"items": entries}}), 200
+
+
+# Brings the local copy of an account's unread listing up to date.
+# In delta mode the ids and hashes we already have are sent as `have`,
+# so Instapaper only returns new or changed bookmarks plus deleted ids.
+def sync_entries(account):
+    known = g_storage_backend.get_entry_hashes(account) if g_delta_sync else {}
+    parameters = {"limit": 500}
+    if known:
+        parameters["have"] = ",".join(f"{id}:{hash}" for id, hash in known.items())
+    app.logger.debug(f"get entries, have {len(known)}")
+    instapaper = get_api_data("/bookmarks/list", parameters=parameters)
+    if isinstance(instapaper, dict):
+        if not instapaper:
+            # Instapaper failed, keep serving what we have
+            return
+        instapaper = instapaper.get("bookmarks", []) + [instapaper]
+    if not isinstance(instapaper, list):
+        return
+
+    entries = []
+    bookmarks = []
+    deleted = []
+    for mark in instapaper:
+        if mark.get('delete_ids'):
+            ids = mark['delete_ids']
+            if isinstance(ids, str):
+                ids = ids.split(",")
+            deleted.extend(int(x) for x in ids)
+        if mark.get('type') != "bookmark":
+            continue
+        mark['tags'] = [x['name'] for x in mark['tags']]
+        mark['id'] = mark['bookmark_id']
+        del mark['bookmark_id']
+        del mark['type']
+        mark['mimetype'] = "text/html"
+        # TODO
+        # mark['updated_at'] = parse_somehow_mumble(mark['time']) like :   "updated_at": "2023-01-24T15:21:09+0000",
+        bookmark = Bookmark(int(mark['id']), mark['title'], mark['url'], ",".join(mark['tags']))
+        app.logger.debug(f"Bookmark: {bookmark.title}")
+        bookmarks.append(bookmark)
+        entries.append(Entry(bookmark.id, mark.get('hash', ""),
+                             int(mark.get('time', 0)), json.dumps(mark)))
+    # Archives still in the outbox stay hidden
+    pending = g_storage_backend.get_pending_bookmarks(account, progress.ARCHIVE_PATH)
+    if pending:
+        entries = [e for e in entries if e.id not in pending]
+        deleted.extend(pending)
+    g_storage_backend.update_bookmarks(bookmarks)
+    g_storage_backend.merge_entries(account, entries, deleted,
+                                    replace=not known)
+    app.logger.info(f"Synced entries: {len(entries)} changed, {len(deleted)} deleted")
+
+
+# Queue a background build if this bookmark's EPUB isn't cached yet
+def prefetch_epub(mark, profile):
+    if g_prefetcher is None:
+        return
+    version = epubcache.version(mark, profile.settings)
+    if g_epub_cache.contains(mark.id, profile.name, version):
+        return
+    token = request_token()
+    g_prefetcher.submit(mark.id, lambda: g_epub_cache.get_or_build(
+        mark.id, profile.name, version,
+        lambda path: build_epub(mark.id, mark, path, token, profile=profile),
+        admit=build_slot(token, "background")))
+
+
+@app.route("/prefetch/status")
+def prefetch_status():
+    if g_prefetcher is None:
+        return jsonify({"enabled": False}), 200
+    return jsonify(dict(enabled=True, **g_prefetcher.status())), 200
+
+
+@app.route("/outbox/status")
+def outbox_status():
+    return jsonify(g_outbox.status()), 200
+
+
+@app.route("/metrics")
+def get_metrics():
+    return Response(metrics.render(),
+                    mimetype="text/plain; version=0.0.4"), 200
 
 
 @app.route("/api/entries/<int:id>.json", methods=['PATCH', 'DELETE'])
@@ -114,12 +253,15 @@ def archive_article(id):
         if request.get_json().get("archive") != 1:
             return jsonify({}), 200
     app.logger.info(f"Archiving {id}")
-    get_api_data("/bookmarks/update_read_progress",
-                 parameters={"bookmark_id": id,
-                             "progress": 1,
-                             "progress_timestamp": int(time.time())})
-    get_api_data(f"/bookmarks/archive",
-                 parameters={"bookmark_id": id})
+    token = request_token()
+    # Sent in the background, retried until Instapaper takes them
+    g_outbox.enqueue(token, progress.PROGRESS_PATH,
+                     {"bookmark_id": id,
+                      "progress": 1,
+                      "progress_timestamp": int(time.time())},
+                     replace=True)
+    g_outbox.enqueue(token, progress.ARCHIVE_PATH, {"bookmark_id": id})
+    g_storage_backend.merge_entries(token.key, (), deleted=(id,))
     return jsonify({"id": id, "archive": 1}), 200
 
 
@@ -132,40 +274,180 @@ def post_tags(id):
 @app.route("/api/entries/<int:id>/export.epub", methods=['GET', 'HEAD'])
 def get_epub(id):
     global g_storage_backend
-    if os.path.exists(f"/tmp/{id}.epub"):
-        if request.method == "HEAD":
-            return jsonify({"id": id}, 200)
-        return send_file(
-            f"/tmp/{id}.epub",
-            mimetype='application/epub+zip'
-        ), 200
-
-    page_content = get_api_data("/bookmarks/get_text",
-                                parameters={"bookmark_id": id})
-    if not page_content:
-        return "No content?", 500
     mark = g_storage_backend.get_bookmark(id)
-    app.logger.info(f"Building epub for {id}: {mark.title}")
     if not mark:
         get_entries()
         mark = g_storage_backend.get_bookmark(id)
     if not mark:
         return "No article?", 500
+
+    profile = request_profile()
+    version = epubcache.version(mark, profile.settings)
+    path = g_epub_cache.lookup(id, profile.name, version)
+    metrics.inc("wbip_cache_total", cache="epub",
+                result="miss" if path is None else "hit")
+    if path is None and request.method == "HEAD":
+        # Not built yet, and a HEAD isn't worth building for. Like the
+        # streamed GET it would get, the answer has no length or ETag.
+        return Response(iter(()), mimetype='application/epub+zip'), 200
+    if path is None and not request.range and "If-Range" not in request.headers:
+        # Send the book while it is being built and written to the cache
+        token = request_token()
+        chunks = g_epub_cache.stream_or_build(
+            id, profile.name, version,
+            lambda path, commit: build_epub(id, mark, path, token, commit, profile),
+            admit=build_slot(token))
+        try:
+            first = next(chunks)
+        except BuildError as e:
+            return str(e), 500
+        except scheduler.Busy as e:
+            return busy(e)
+        return Response(itertools.chain([first], chunks),
+                        mimetype='application/epub+zip'), 200
+    if path is None:
+        # A range can only be cut from the finished book
+        token = request_token()
+        try:
+            path = g_epub_cache.get_or_build(
+                id, profile.name, version,
+                lambda path: build_epub(id, mark, path, token, profile=profile),
+                admit=build_slot(token))
+        except BuildError as e:
+            return str(e), 500
+        except scheduler.Busy as e:
+            return busy(e)
+
+    # Answers HEAD, If-None-Match and Range from the cached file
+    return send_file(
+        path,
+        mimetype='application/epub+zip',
+        etag=epubcache.etag(path, version),
+        conditional=True
+    )
+
+
+# Streams the EPUBs of many bookmarks as one ZIP: those in `ids` (comma
+# separated, or a JSON list when POSTed), or all unread entries without
+# it. Books go out by ascending id and `after` skips the ids up to it, so
+# an interrupted download can resume after the last book it got.
+@app.route("/api/entries/export.zip", methods=["GET", "POST"])
+def export_entries():
+    token = request_token()
+    if request.method == "POST":
+        ids = (request.get_json(silent=True) or {}).get("ids")
+    else:
+        ids = request.args.get("ids")
+        if ids is not None:
+            ids = ids.split(",")
+    if ids == ["unread"] or ids == "unread":
+        ids = None
+    try:
+        if ids is not None:
+            ids = sorted({int(id) for id in ids})
+        after = int(request.args.get("after", 0))
+    except (TypeError, ValueError):
+        return "Invalid Request", 400
+
+    if ids is None:
+        sync_entries(token.key)
+        ids = sorted(g_storage_backend.get_entry_hashes(token.key))
+    ids = [id for id in ids if id > after]
+    marks = {id: g_storage_backend.get_bookmark(id) for id in ids}
+    if not all(marks.values()):
+        sync_entries(token.key)
+        marks = {id: mark or g_storage_backend.get_bookmark(id)
+                 for id, mark in marks.items()}
+    profile = request_profile()
+
+    def open_book(id):
+        mark = marks[id]
+        if not mark:
+            raise BuildError(f"No bookmark {id}")
+        version = epubcache.version(mark, profile.settings)
+        path = g_epub_cache.lookup(id, profile.name, version)
+        metrics.inc("wbip_cache_total", cache="epub",
+                    result="miss" if path is None else "hit")
+        if path is None:
+            path = g_epub_cache.get_or_build(
+                id, profile.name, version,
+                lambda path: build_epub(id, mark, path, token, profile=profile),
+                admit=build_slot(token, "background"))
+        return open(path, "rb")
+
+    books = [(id, export_filename(id, marks[id])) for id in ids]
+    export_id, chunks = g_exporter.stream(books, open_book)
+    app.logger.info(f"Export {export_id}: {len(books)} books after {after}")
+    return Response(chunks, mimetype="application/zip", headers={
+        "Content-Disposition": 'attachment; filename="instapaper.zip"',
+        "X-Export-Id": str(export_id),
+        "X-Export-Count": str(len(books))}), 200
+
+
+# The name of a book inside an export, the way KOReader's wallabag
+# plugin names its downloads: the title through util.getSafeFilename
+# with a 230 byte limit. Like KOReader on FAT storage, which e-readers
+# use, characters that aren't allowed there become "_"; elsewhere
+# KOReader only replaces "/", so titles with those characters get other
+# names and only the binary document hash finds them.
+def export_filename(id, mark):
+    title = html.unescape(mark.title if mark else "")
+    title = title.encode()[:230].decode(errors="ignore")
+    title = "".join("_" if ord(c) < 32 or ord(c) == 127 or c in '\\/:*?"<>|' else c
+                    for c in title)
+    return f"[w-id_{id}] {title}.epub"
+
+
+@app.route("/exports/status")
+def exports_status():
+    return jsonify(g_exporter.status()), 200
+
+
+class BuildError(Exception):
+    pass
+
+
+# Tells a device to come back when the builds ahead of it are done
+def busy(e):
+    return Response(str(e), 503, headers={"Retry-After": str(e.retry_after)})
+
+
+@app.route("/builds/status")
+def builds_status():
+    return jsonify(g_scheduler.status()), 200
+
+
+# Returns the admission to the build scheduler for `token`'s builds in
+# `lane`, for the EPUB cache to enter before it takes a book's build
+# lock, so a build waiting for a slot never holds up another request for
+# the same book. Entering it raises scheduler.Busy if the build isn't
+# admitted.
+def build_slot(token, lane="interactive"):
+    return lambda: g_scheduler.slot(token.key, lane)
+
+
+# Builds the EPUB for a bookmark into `path`, calling `commit(offset)`
+# whenever a leading part of the file is final. Images are processed
+# for `profile`, the default profile if None.
+# Raises BuildError if it can't.
+def build_epub(id, mark, path, token=None, commit=None, profile=None):
+    if profile is None:
+        profile = g_profiles[g_default_profile]
+    if token is None:
+        token = request_token()
+    start = time.perf_counter()
+    page_content = get_api_data("/bookmarks/get_text",
+                                parameters={"bookmark_id": id},
+                                token=token)
+    if not page_content:
+        raise BuildError("No content?")
+    app.logger.info(f"Building epub for {id}: {mark.title}")
     app.logger.debug(f"mark: {mark}")
     r_data = {}
     if mark.url.startswith('http'):
         app.logger.debug(f"enriching {id} with readable data")
-        try:
-            r_data = requests.post(
-                'http://postlight:3000/parse-html', json={'url': mark.url}).json()
-            for k in ['content', 'title', 'dek', 'next_page_url', 'url', 'message']:
-                try:
-                    r_data.pop(k)
-                except:
-                    pass
-        except Exception as e:
-            app.logger.warning(f"couldn't enrich {mark.title} with postlight: {e}")
-            pass
+        with metrics.timer("wbip_stage_seconds", "enrich", stage="enrich"):
+            r_data = g_enricher.enrich(mark.url)
     else:
         r_data['author'] = "email"
     r_data.update(mark.__dict__)
@@ -173,7 +455,7 @@ def get_epub(id):
     if 'author' in r_data:
         author = r_data['author']
     elif 'domain' in r_data:
-        author = domain_map.get(r_data['domain'], r_data['domain'])
+        author = g_assets.domain_map.get(r_data['domain'], r_data['domain'])
     if not author:
         author = ""
     title = r_data.get('title', "No Title")
@@ -181,7 +463,7 @@ def get_epub(id):
     author_line = ""
     if r_data.get('url', "").startswith("http"):
         domain = r_data['url'].split("/")[2].replace("www.", "", 1)
-        domain = domain_map.get(domain, domain)
+        domain = g_assets.domain_map.get(domain, domain)
         header_line += f'<a href="{r_data.get("url", "")}">{domain}</a>'
         author_line = domain
     if author:
@@ -193,131 +475,138 @@ def get_epub(id):
         else:
             author_line = author
     page_content = f'<h1>{title}</h1><div>{header_line}</div>\n' + page_content
-    book = epub.EpubBook()
-    chapters = []
-    book.set_title(r_data['title'])
-    book.add_author(author_line)
-    chapter = epub.EpubHtml(
-        uid="0", title=r_data['title'], file_name=f"0.xhtml")
-    chapter.content = '<html><head>' + \
-        '<link rel="stylesheet" href="style/default.css" />' + \
-        '</head><body>' + \
-        page_content + \
-        '</body></html>'
-    book.add_item(chapter)
-    chapters.append(chapter)
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
-    with open("nook-glowlight-3.css") as f:
-        nav_css = epub.EpubItem(
-            uid="style_nav", file_name="style/default.css",
-            media_type="text/css", content=f.read())
-    book.add_item(nav_css)
-    book.spine = chapters
-
-    IMAGE_GREYSCALE = True
-
-    # Maximum dimensions of embedded images
-    IMAGE_MAX_SIZE = (1000, 1000)
-
-    # now cache images into the book
-    for item in book.items:
-        if type(item) is not epub.EpubHtml:
-            continue
-        soup = BeautifulSoup('<html><body>%s</body></html>' %
-                             item.content, 'html5lib')
-        image_names = set()
-        img_count = 0
-        for img in soup.find_all('img'):
-            src = img.get('src')
-
-            # Remove junk images
-            if not src or "_noimg" in mark.tags:
-                img.decompose()
-                continue
-            if src.startswith('denied:'):
-                img.decompose()
-                continue
-            if src.startswith('data:'):
-                img.decompose()
-                continue
-            img_count += 1
-            if img_count > 25:
-                break
-            src_parts = urlparse(src)
-            ext = os.path.splitext(src_parts.path)[1]
-            name = str(hash(src)) + ext
-
-            if name not in image_names:
-                # Create `EpubImage` wrapper object
-                image = epub.EpubImage()
-                image.id = str(hash(src))
-                image.file_name = name
-
-                thumbnail = io.BytesIO()
-
-                img['src'] = re.sub("%2C$", "", img['src'])
-                try:
-                    app.logger.debug(f"Downloading image {img['src']}")
-                    content = requests.get(
-                        img['src'], timeout=3.05).content
-                except (requests.exceptions.ContentDecodingError,
-                        requests.exceptions.ConnectionError,
-                        requests.exceptions.ReadTimeout,
-                        requests.exceptions.InvalidSchema,
-                        requests.exceptions.MissingSchema) as e:
-                    app.logger.warning('ERROR: Skipping image %s (%s)' %
-                                       (img['src'], e))
-                    continue
-
-                original = io.BytesIO()
-                original.write(content)
-
-                try:
-                    # Create smaller, greyscale image from source image
-                    # convert to `RGBA` before `L` or Pillow will complain
-                    im = Image.open(original).convert('RGBA')
-                    im.thumbnail(IMAGE_MAX_SIZE)
-                    if IMAGE_GREYSCALE:
-                        im = im.convert('L')
-                    im.save(thumbnail, 'png' if ext == '.png' else 'jpeg')
-
-                except OSError as e:
-                    app.logger.warning('Skipping image %s (%s)' %
-                                       (img['src'], e))
-                    continue
-
-                thumbnail.seek(0)
-
-                image.content = thumbnail.read()
-                book.add_item(image)
-                image_names.add(name)
-
-            img['style'] = 'max-width: 100%'
-            img['src'] = name
-        item.content = str(soup.body)
+
     try:
-        epub.write_epub(f"/tmp/{r_data['id']}.epub", book)
-    except:
-        return f"Cannot build epub for {id}", 500
+        with metrics.timer("wbip_stage_seconds", "html", stage="html"):
+            article = htmlpipeline.Article(page_content, parser=g_html_parser,
+                                           keep_images="_noimg" not in mark.tags)
+        keys = {src: images.cache_key(src, profile) for src in article.images}
+        wanted = {key: src for src, key in keys.items()}
+        hrefs = {}
+
+        with open(path, "wb") as fh:
+            book = epubwriter.EpubWriter(
+                fh, f"wbip-{id}", r_data['title'], author_line, on_entry=commit)
+            book.add_item("style_nav", "style/default.css", "text/css",
+                          g_assets.stylesheet)
+
+            # Images go straight into the book as they finish downloading
+            def add_image(key, content):
+                ext, media_type = images.describe(content)
+                hrefs[key] = key + ext
+                book.add_image(f"img_{key}", hrefs[key], media_type, content)
+
+            with metrics.timer("wbip_stage_seconds", "images", stage="images"):
+                g_image_pipeline.process(wanted, profile, add_image)
+            article.finish({src: hrefs[key]
+                            for src, key in keys.items() if key in hrefs})
+
+            with metrics.timer("wbip_stage_seconds", "epub_write", stage="epub_write"):
+                book.add_chapter("chapter_0", "0.xhtml", r_data['title'],
+                                 article.body, ["style/default.css"])
+                book.close()
+            size = fh.tell()
+    except Exception as e:
+        app.logger.warning(f"Cannot build epub for {id}: {e}")
+        raise BuildError(f"Cannot build epub for {id}")
+    if g_progress_bridge is not None:
+        g_progress_bridge.register(path, export_filename(id, mark), id, token,
+                                   profile.name)
+    elapsed = time.perf_counter() - start
+    metrics.observe("wbip_stage_seconds", elapsed, "build", stage="build")
+    record_build(profile, elapsed, size)
+
+
+# Builds, seconds and bytes of the EPUBs built per profile
+g_build_stats = {}
+g_build_stats_lock = threading.Lock()
+
+
+def record_build(profile, seconds, size):
+    with g_build_stats_lock:
+        stats = g_build_stats.setdefault(profile.name, [0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] += size
+
+
+# The image profile for this request: the `profile` query parameter,
+# else the caller's saved choice, else the default
+def request_profile():
+    name = request.args.get("profile")
+    if name is None and 'Authorization' in request.headers:
+        name = g_storage_backend.get_profile(request_token().key)
+    if name is not None and name not in g_profiles:
+        app.logger.warning(f"Unknown image profile {name}")
+        name = None
+    return g_profiles[name or g_default_profile]
+
+
+@app.route("/profiles")
+def list_profiles():
+    profiles = {}
+    with g_build_stats_lock:
+        for name, profile in g_profiles.items():
+            builds, seconds, size = g_build_stats.get(name, (0, 0.0, 0))
+            profiles[name] = dict(
+                max_size=list(profile.max_size), greyscale=profile.greyscale,
+                format=profile.format, quality=profile.quality,
+                bits=profile.bits, dither=profile.dither, builds=builds,
+                avg_build_seconds=seconds / builds if builds else 0.0,
+                avg_epub_bytes=size // builds if builds else 0)
+    return jsonify({"default": g_default_profile, "profiles": profiles}), 200
+
+
+# Reads or saves the caller's image profile, `null` returns to the default
+@app.route("/profile", methods=['GET', 'PUT'])
+def user_profile():
+    account = request_token().key
+    if request.method == "PUT":
+        name = (request.get_json(silent=True) or {}).get("profile")
+        if name is not None and name not in g_profiles:
+            return jsonify({"message": f"Unknown profile {name}"}), 400
+        g_storage_backend.set_profile(account, name)
+    return jsonify({"profile": g_storage_backend.get_profile(account)
+                    or g_default_profile}), 200
+
+
+# Lets the progress a KOReader sync user reports reach the caller's
+# Instapaper account. PUT links {"username": ..., "password": ...}, the
+# sync login, DELETE unlinks {"username": ...}; all answer with the
+# linked users.
+@app.route("/progress/link", methods=['GET', 'PUT', 'DELETE'])
+def progress_link():
+    if g_progress_bridge is None:
+        return jsonify({"message": "Progress is not sent to Instapaper"}), 404
+    token = request_token()
+    if request.method != "GET":
+        body = request.get_json(silent=True) or {}
+        username = body.get("username")
+        if not username:
+            return jsonify({"message": "username is required"}), 400
+        if request.method == "PUT":
+            # KOReader logs in with the MD5 of the password
+            userkey = hashlib.md5(str(body.get("password", "")).encode()).hexdigest()
+            if not g_storage_backend.check_login(username, userkey):
+                return "Incorrect username or password.", 401
+            g_progress_bridge.link_user(username, token)
+        else:
+            g_progress_bridge.unlink_user(username, token)
+    return jsonify({"users": g_progress_bridge.linked_users(token)}), 200
 
-    if request.method == "HEAD":
-        return jsonify({"id": id}, 200)
-    return send_file(
-        f"/tmp/{r_data['id']}.epub",
-        mimetype='application/epub+zip'
-    ), 200
-
-
-def get_api_data(url, parameters={}):
-    token = request.headers['Authorization'].split(" ", 2)[1]
-    token = dict(parse_qsl(token))
-    token = oauth.Token(token.get("oauth_token"),
-                        token.get('oauth_token_secret'))
-    http = oauth.Client(consumer, token)
-    response, data = http.request(
-        f"{BASE_URL}{API_VERSION}{url}", "POST", urlencode(parameters))
-    if response.get("status") == '200':
+
+# The caller's Instapaper token, from the Authorization header
+def request_token():
+    return g_instapaper.token(request.headers['Authorization'])
+
+
+# Calls the Instapaper API as the current request's user, or as the owner
+# of `token` when running outside of a request.
+def get_api_data(url, parameters={}, token=None):
+    if token is None:
+        token = request_token()
+    status, data = g_instapaper.post(f"{API_VERSION}{url}", parameters, token)
+    if status == 200:
         try:
             return json.loads(data.decode())
         except Exception as e:
@@ -407,6 +696,9 @@ def sync_progress():
 
     # Add the document to the database
     g_storage_backend.update_document(username, doc)
+    # and pass it on to Instapaper if it is one of our books
+    if g_progress_bridge is not None:
+        g_progress_bridge.push(username, doc)
 
     return jsonify(dict(document=document, timestamp=timestamp))
 
@@ -443,9 +735,173 @@ def initialize():
     if ("KOSYNC_SQLITE3_DB" in os.environ) and (os.environ["KOSYNC_SQLITE3_DB"] == "false"):
         g_allow_registration = False
 
+    # With WBIP_PRELOAD gunicorn loads the app once in the master and
+    # forks the workers from it
+    global g_preload
+    g_preload = os.environ.get("WBIP_PRELOAD", "false") == "true"
+
+    # Stylesheet and domain names, shared by all builds
+    global g_assets
+    g_assets = assets.load()
+
+    # One pooled, retrying connection to Instapaper per worker
+    global g_instapaper
+    g_instapaper = instapaper.InstapaperClient(
+        instapaper.Token(oauth_creds['key'], oauth_creds['secret']),
+        os.environ.get("WBIP_INSTAPAPER_URL", BASE_URL),
+        timeout=float(os.environ.get("WBIP_INSTAPAPER_TIMEOUT", 10.0)),
+        retries=int(os.environ.get("WBIP_INSTAPAPER_RETRIES", 2)),
+        max_concurrency=int(os.environ.get("WBIP_INSTAPAPER_CONCURRENCY", 10)))
+
+    # Send the bookmarks we already have when listing entries
+    global g_delta_sync
+    g_delta_sync = os.environ.get("WBIP_DELTA_SYNC", "true") != "false"
+
     # Initialize the database
     global g_storage_backend
-    g_storage_backend = backend.sqlite.BackendSQLite(db)
+    database = backend.sqlite.BackendSQLite(
+        db, login_ttl=float(os.environ.get("KOSYNC_LOGIN_CACHE_TTL", 300)))
+    g_storage_backend = database
+
+    # Optionally coalesce progress updates in memory before writing them
+    write_behind = float(os.environ.get("KOSYNC_WRITE_BEHIND", 0))
+    if write_behind > 0:
+        g_storage_backend = backend.writebehind.WriteBehindBackend(
+            g_storage_backend, write_behind,
+            int(os.environ.get("KOSYNC_WRITE_BEHIND_MAX", 100)))
+
+    # Archive and progress calls are queued in the database and sent
+    # in the background
+    global g_outbox
+    g_outbox = outbox.Outbox(
+        g_storage_backend, g_instapaper,
+        batch_size=int(os.environ.get("WBIP_OUTBOX_BATCH", 20)),
+        concurrency=int(os.environ.get("WBIP_OUTBOX_CONCURRENCY", 4)),
+        interval=float(os.environ.get("WBIP_OUTBOX_INTERVAL", 5.0)),
+        max_attempts=int(os.environ.get("WBIP_OUTBOX_MAX_ATTEMPTS", 50)))
+
+    # Progress synced on books we built goes back to Instapaper, once
+    # per interval
+    global g_progress_bridge
+    g_progress_bridge = None
+    if os.environ.get("WBIP_PROGRESS_BRIDGE", "true") == "true":
+        g_progress_bridge = progress.ProgressBridge(
+            g_storage_backend, g_outbox,
+            interval=float(os.environ.get("WBIP_PROGRESS_INTERVAL", 60.0)))
+
+    # Postlight metadata is cached in the database
+    global g_enricher
+    g_enricher = enrich.Enricher(
+        g_storage_backend,
+        os.environ.get("WBIP_POSTLIGHT_URL", "http://postlight:3000/parse-html"),
+        ttl=float(os.environ.get("WBIP_POSTLIGHT_TTL", 30 * 24 * 3600)),
+        negative_ttl=float(os.environ.get("WBIP_POSTLIGHT_NEGATIVE_TTL", 3600)),
+        timeout=float(os.environ.get("WBIP_POSTLIGHT_TIMEOUT", 10.0)),
+        max_concurrency=int(os.environ.get("WBIP_POSTLIGHT_CONCURRENCY", 4)))
+
+    # "lxml" parses articles quickly, "html5lib" like a browser would
+    global g_html_parser
+    g_html_parser = os.environ.get("WBIP_HTML_PARSER", "lxml")
+    if g_html_parser not in htmlpipeline.PARSERS:
+        raise ValueError(f"WBIP_HTML_PARSER must be one of {', '.join(htmlpipeline.PARSERS)}")
+
+    # Image profiles books can be built for
+    global g_profiles, g_default_profile
+    g_profiles = images.PROFILES
+    if "WBIP_IMAGE_PROFILES" in os.environ:
+        g_profiles = images.load_profiles(os.environ["WBIP_IMAGE_PROFILES"])
+    g_default_profile = os.environ.get("WBIP_IMAGE_PROFILE", "default")
+    if g_default_profile not in g_profiles:
+        raise ValueError(f"WBIP_IMAGE_PROFILE must be one of {', '.join(g_profiles)}")
+
+    # Built EPUBs are cached on disk until evicted or the bookmark changes
+    global g_epub_cache
+    g_epub_cache = epubcache.EpubCache(
+        os.environ.get("WBIP_EPUB_CACHE_DIR", "/tmp/wbip-epubs"),
+        int(os.environ.get("WBIP_EPUB_CACHE_SIZE", 512 * 1024 * 1024)))
+
+    # Caps the builds running at once across workers, with slot files in
+    # the EPUB cache directory, and queues the rest fairly within each
+    # worker. A sync worker is killed once a request takes gunicorn's
+    # timeout, so by default a build waits a third of it and has the rest
+    # to run.
+    global g_scheduler
+    worker_timeout = float(os.environ.get("WBIP_WORKER_TIMEOUT", 30))
+    g_scheduler = scheduler.BuildScheduler(
+        max_running=int(os.environ.get("WBIP_BUILD_CONCURRENCY", 2)),
+        max_waiting=int(os.environ.get("WBIP_BUILD_QUEUE", 8)),
+        max_waiting_per_user=int(os.environ.get("WBIP_BUILD_QUEUE_PER_USER", 4)),
+        max_wait=float(os.environ.get("WBIP_BUILD_MAX_WAIT", worker_timeout / 3)),
+        slot_dir=g_epub_cache.directory)
+
+    # EPUBs for listed entries are built ahead of time
+    global g_prefetcher
+    g_prefetcher = None
+    prefetch_workers = int(os.environ.get("WBIP_PREFETCH_WORKERS", 2))
+    if prefetch_workers > 0:
+        g_prefetcher = prefetch.Prefetcher(
+            prefetch_workers, int(os.environ.get("WBIP_PREFETCH_QUEUE", 100)))
+
+    # Bulk exports build a few books ahead of the one being sent
+    global g_exporter
+    g_exporter = exporter.Exporter(
+        workers=int(os.environ.get("WBIP_EXPORT_WORKERS", 4)),
+        lookahead=int(os.environ.get("WBIP_EXPORT_LOOKAHEAD", 4)))
+
+    # Processed images are cached on disk across builds and workers
+    image_cache = None
+    image_cache_size = int(os.environ.get("WBIP_IMAGE_CACHE_SIZE", 256 * 1024 * 1024))
+    if image_cache_size > 0:
+        image_cache = imagecache.ImageCache(
+            os.environ.get("WBIP_IMAGE_CACHE_DIR", "/tmp/wbip-images"),
+            image_cache_size,
+            revalidate_after=float(os.environ.get("WBIP_IMAGE_CACHE_REVALIDATE", 7 * 24 * 3600)))
+
+    # Image pipeline shared by all EPUB builds in this worker
+    global g_image_pipeline
+    g_image_pipeline = images.ImagePipeline(
+        fetch_workers=int(os.environ.get("WBIP_IMAGE_FETCH_WORKERS", 8)),
+        transcode_workers=int(os.environ.get("WBIP_IMAGE_TRANSCODE_WORKERS", 2)),
+        deadline=float(os.environ.get("WBIP_IMAGE_DEADLINE", 20.0)),
+        cache=image_cache,
+        max_bytes=int(os.environ.get("WBIP_IMAGE_MAX_BYTES", 10 * 1024 * 1024)),
+        max_pixels=int(os.environ.get("WBIP_IMAGE_MAX_PIXELS", 40_000_000)),
+        article_bytes=int(os.environ.get("WBIP_IMAGE_ARTICLE_BYTES", 50 * 1024 * 1024)))
+
+    # Log a line with the time each request spent per stage
+    global g_timing_log
+    g_timing_log = os.environ.get("WBIP_TIMING_LOG", "false") == "true"
+
+    metrics.gauge("wbip_outbox_pending", "Calls waiting in the outbox",
+                  lambda: g_outbox.status()["pending"])
+    metrics.gauge("wbip_build_queue_depth",
+                  "EPUB builds waiting for a slot in the answering worker",
+                  g_scheduler.depth)
+    if g_prefetcher is not None:
+        metrics.gauge("wbip_prefetch_waiting",
+                      "Prefetch builds queued in the answering worker",
+                      lambda: g_prefetcher.status()["waiting"])
+
+    if g_preload:
+        # Import what builds use now so every worker shares it, and
+        # don't let database connections or threads cross the fork
+        import lxml.html  # noqa: F401
+        import oauth2  # noqa: F401
+        import PIL.Image  # noqa: F401
+        if g_html_parser == "html5lib":
+            import html5lib  # noqa: F401
+        database.close()
+    else:
+        start_background()
+
+
+# Starts the threads working beside the requests. With WBIP_PRELOAD,
+# gunicorn calls this in each worker after forking it.
+def start_background():
+    g_outbox.start()
+    # Workers write their numbers here so /metrics covers all of them
+    if "WBIP_METRICS_DIR" in os.environ:
+        metrics.share(os.environ["WBIP_METRICS_DIR"])
 
 
 initialize()